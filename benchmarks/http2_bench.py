@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+模拟浏览器加载图集页面: 比较HTTP/1.1(最多6个连接)和HTTP/2(单连接多路复用)
+下同时请求大量小图片的整页加载时间. 上游是本地的桩服务, 每个请求延迟
+--delay秒; 每轮使用新的图片路径(缓存未命中), --warm时重复请求同一批
+(缓存命中)
+
+    python benchmarks/http2_bench.py --images 60 --size 30000 --rounds 10
+"""
+import argparse
+import os
+import time
+
+from twisted.internet import reactor, defer, task
+from twisted.internet.protocol import ClientCreator, Protocol
+from twisted.web import server
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.resource import Resource
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.http2 import H2_ENABLED, H2Site, listen_http2
+from pixiv_fetcher.resource import PixivImageProxyResource
+
+if H2_ENABLED:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2.events import DataReceived, StreamEnded, StreamReset
+
+_path = '/img-master/img/2018/01/02/03/04/05/%d_p%d_master1200.jpg'
+
+
+class StubUpstream(Resource):
+
+    isLeaf = True
+
+    def __init__(self, size, delay):
+        Resource.__init__(self)
+        self._body = os.urandom(size)
+        self._delay = delay
+
+    def render_GET(self, request):
+        def _write():
+            request.write(self._body)
+            request.finish()
+        call = reactor.callLater(self._delay, _write)
+        # 对冲请求落败时连接会被断开
+        request.notifyFinish().addErrback(lambda _: call.cancel())
+        return server.NOT_DONE_YET
+
+
+class H2PageClient(Protocol):
+    """
+    在一个连接上同时请求所有图片
+    """
+
+    def __init__(self, paths):
+        self._paths = paths
+        self._streams = set()
+        self.received = 0
+        self.finished = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.setTcpNoDelay(True)
+        self._conn = H2Connection(H2Configuration(client_side=True))
+        self._conn.initiate_connection()
+        for path in self._paths:
+            stream_id = self._conn.get_next_available_stream_id()
+            self._conn.send_headers(stream_id, [
+                (':method', 'GET'), (':path', path), (':scheme', 'http'),
+                (':authority', 'localhost')], end_stream=True)
+            self._streams.add(stream_id)
+        self.transport.write(self._conn.data_to_send())
+
+    def dataReceived(self, data):
+        for event in self._conn.receive_data(data):
+            if isinstance(event, DataReceived):
+                self.received += len(event.data)
+                self._conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, (StreamEnded, StreamReset)):
+                self._streams.discard(event.stream_id)
+                if not self._streams:
+                    self.finished.callback(self.received)
+        self.transport.write(self._conn.data_to_send())
+
+
+@defer.inlineCallbacks
+def load_http11(agent, port, paths, connections):
+    semaphore = defer.DeferredSemaphore(connections)
+
+    def _get(path):
+        url = 'http://127.0.0.1:%d%s' % (port, path)
+        dfd = agent.request(b'GET', url)
+        return dfd.addCallback(readBody)
+
+    bodies = yield defer.gatherResults(
+        [semaphore.run(_get, path) for path in paths])
+    defer.returnValue(sum(len(body) for body in bodies))
+
+
+@defer.inlineCallbacks
+def load_http2(port, paths):
+    client = yield ClientCreator(reactor, H2PageClient, paths) \
+        .connectTCP('127.0.0.1', port)
+    received = yield client.finished
+    client.transport.loseConnection()
+    defer.returnValue(received)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+@defer.inlineCallbacks
+def run(args):
+    upstream = reactor.listenTCP(
+        0, server.Site(StubUpstream(args.size, args.delay)),
+        interface='127.0.0.1')
+    upstream_port = upstream.getHost().port
+    downloader = IllustrationDownloader('127.0.0.1', upstream_port,
+                                        pool_maxsize=args.images)
+    resource = PixivImageProxyResource(
+        '127.0.0.1', '', upstream_port, cache=Cache(SimpleStorage()),
+        downloader=downloader, stream=True)
+    port = listen_http2(H2Site(resource), 0, interface='127.0.0.1')
+    proxy_port = port.getHost().port
+
+    pool = HTTPConnectionPool(reactor)
+    pool.maxPersistentPerHost = args.connections
+    agent = Agent(reactor, pool=pool)
+
+    loaders = [('HTTP/1.1', lambda paths: load_http11(
+        agent, proxy_port, paths, args.connections))]
+    if H2_ENABLED:
+        loaders.append(('HTTP/2', lambda paths: load_http2(proxy_port,
+                                                           paths)))
+
+    page = [0]
+    print('%-10s%10s%10s%10s' % ('', 'median', 'p95', 'MB/s'))
+    for name, load in loaders:
+        timings = []
+        total = 0
+        for _ in range(args.rounds):
+            if not args.warm:
+                page[0] += 1
+            paths = [_path % (page[0], i) for i in range(args.images)]
+            start = time.time()
+            total += yield load(paths)
+            timings.append(time.time() - start)
+        print('%-10s%9.1fms%9.1fms%10.1f' % (
+            name, _percentile(timings, 0.5) * 1000,
+            _percentile(timings, 0.95) * 1000,
+            total / sum(timings) / 1024 / 1024))
+
+    yield pool.closeCachedConnections()
+    yield downloader.agent._pool.closeCachedConnections()
+    yield port.stopListening()
+    yield upstream.stopListening()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=60,
+                        help='每页图片数')
+    parser.add_argument('--size', type=int, default=30000,
+                        help='每张图片大小(字节)')
+    parser.add_argument('--delay', type=float, default=0.02,
+                        help='上游每个请求的延迟(秒)')
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--connections', type=int, default=6,
+                        help='HTTP/1.1的最大连接数')
+    parser.add_argument('--warm', action='store_true',
+                        help='重复请求同一页, 测试缓存命中')
+    args = parser.parse_args()
+    task.react(lambda _: run(args))
+
+
+if __name__ == '__main__':
+    main()
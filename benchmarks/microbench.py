@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+缓存热点路径的微基准: 存储的get/set/delete, 各淘汰策略在10^3~10^6个key下的
+handle_hit/handle_set/remove_keys, DiskRecord的search/insert/pop_idx,
+以及hash_key和parse_pximg_url. 输出每秒操作数和每个条目占用的内存(或磁盘)
+字节数, 可保存为JSON并与之前的结果比较:
+
+    python benchmarks/microbench.py --output base.json
+    python benchmarks/microbench.py --compare base.json --threshold 0.2
+
+--compare时任一项的ops/sec下降或每条目字节数增加超过threshold则以1退出
+"""
+import argparse
+import binascii
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pixiv_fetcher.cache import hash_key
+from pixiv_fetcher.cache.dedup import DedupStorage
+from pixiv_fetcher.cache.storage import SimpleStorage, DiskStorage
+from pixiv_fetcher.cache.strategy import DoNothingStrategy, \
+    FifoMemoryStrategy, LruMemoryStrategy, LfuDiskStrategy, DiskRecord
+from pixiv_fetcher.utils.pixiv import parse_pximg_url
+
+MEMORY = 'memory'
+DISK = 'disk'
+
+
+def _pximg_urls(count=100):
+    urls = []
+    for ext in ('jpg', 'png', 'gif'):
+        urls += ['https://i.pximg.net/img-original/img/2018/01/02/03/04/05/'
+                 '%d_p%d.%s' % (random.randint(1, 10 ** 8),
+                                random.randint(0, 20), ext)
+                 for _ in range(count)]
+    urls += ['https://i.pximg.net/c/600x1200_90/img-master/img/2018/01/02/'
+             '03/04/05/%d_p0_master1200.jpg' % random.randint(1, 10 ** 8)
+             for _ in range(count)]
+    return urls
+
+
+def _deep_size(obj, seen=None):
+    """
+    对象及其引用的容器、实例属性的总大小(字节)
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen)
+                    for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += _deep_size(obj.__dict__, seen)
+    return size
+
+
+def _disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def _keys(count):
+    return [os.urandom(16) for _ in range(count)]
+
+
+def _timeit(func, args, budget):
+    """
+    依次以args中的参数调用func, 超过budget秒后停止(至少调用一次).
+    批量大小从1开始翻倍, 使廉价操作不被计时开销淹没
+
+    :return: 每秒操作数
+    """
+    done = 0
+    batch = 1
+    start = time.time()
+    while done < len(args):
+        for arg in args[done:done + batch]:
+            func(arg)
+        done = min(done + batch, len(args))
+        elapsed = time.time() - start
+        if elapsed >= budget:
+            break
+        batch = min(batch * 2, 4096)
+    elapsed = time.time() - start
+    return done / elapsed if elapsed else float('inf')
+
+
+class _FakeStorage(object):
+    """
+    remove_keys只需要size, count和delete
+    """
+
+    def __init__(self, count):
+        self.size = 0
+        self.count = count
+
+    def delete(self, key):
+        self.count -= 1
+
+
+def _prefill(strategy, keys):
+    """
+    直接构造策略的内部状态: 通过handle_set逐个添加是O(n^2)的,
+    10^6个key时无法在合理时间内完成
+    """
+    if isinstance(strategy, FifoMemoryStrategy):
+        strategy._keys = list(keys)
+    elif isinstance(strategy, LruMemoryStrategy):
+        strategy._keys = list(keys)
+    elif isinstance(strategy, LfuDiskStrategy):
+        _prefill_record(strategy._record, keys)
+
+
+def _prefill_record(record, keys):
+    count = len(keys)
+    record._fp.seek(5)
+    # 访问次数近似Zipf分布, 按从多到少排列
+    record._fp.write(b''.join(record._pack(key, count // (i + 1))
+                              for i, key in enumerate(keys)))
+    record._write_length(count)
+
+
+class Suite(object):
+
+    def __init__(self, sizes, samples, budget, storage_count, disk_count,
+                 value_size, pattern=None):
+        self.sizes = sizes
+        self.samples = samples
+        self.budget = budget
+        self.storage_count = storage_count
+        self.disk_count = disk_count
+        self.value_size = value_size
+        self.pattern = pattern
+        self.results = {}
+        self._tmp = tempfile.mkdtemp()
+
+    def _selected(self, name):
+        return self.pattern is None or self.pattern in name
+
+    def _record(self, name, ops, per_entry=None, kind=MEMORY):
+        self.results[name] = {'ops_per_sec': ops,
+                              'bytes_per_entry': per_entry,
+                              'bytes_kind': kind if per_entry else None}
+        print(('%-52s%14.0f%12s' if ops >= 100 else '%-52s%14.2f%12s') % (
+            name, ops,
+            '-' if per_entry is None else '%.1f%s' % (
+                per_entry, 'D' if kind == DISK else '')))
+        sys.stdout.flush()
+
+    def _path(self, name):
+        path = os.path.join(self._tmp, name)
+        if os.path.exists(path):
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        return path
+
+    def bench_functions(self):
+        urls = _pximg_urls()
+        urls *= self.storage_count // len(urls) + 1
+        if self._selected('hash_key'):
+            self._record('hash_key', _timeit(hash_key, urls, self.budget))
+        if self._selected('parse_pximg_url'):
+            self._record('parse_pximg_url',
+                         _timeit(parse_pximg_url, urls, self.budget))
+
+    def bench_storages(self):
+        factories = [
+            ('SimpleStorage', lambda: SimpleStorage(), self.storage_count,
+             MEMORY),
+            ('DedupStorage', lambda: DedupStorage(SimpleStorage()),
+             self.storage_count, MEMORY),
+            ('DiskStorage',
+             lambda: DiskStorage(self._path('disk'), binascii.hexlify),
+             self.disk_count, DISK),
+        ]
+        value = os.urandom(self.value_size)
+        for name, factory, count, kind in factories:
+            prefix = 'storage.%s' % name
+            if not self._selected(prefix):
+                continue
+            storage = factory()
+            keys = _keys(count)
+            set_ops = _timeit(lambda k: storage.set(k, value), keys,
+                              float('inf'))
+            if kind == MEMORY:
+                per_entry = _deep_size(storage) / float(count)
+            else:
+                per_entry = _disk_size(self._tmp + '/disk') / float(count)
+            shuffled = random.sample(keys, len(keys))
+            get_ops = _timeit(storage.get, shuffled, self.budget)
+            delete_ops = _timeit(storage.delete, shuffled, float('inf'))
+            self._record(prefix + '.set', set_ops, per_entry, kind)
+            self._record(prefix + '.get', get_ops, per_entry, kind)
+            self._record(prefix + '.delete', delete_ops, per_entry, kind)
+
+    def _strategy(self, cls):
+        if cls is LfuDiskStrategy:
+            return cls(self._path('lfu.bin'))
+        return cls()
+
+    def bench_strategies(self):
+        classes = [DoNothingStrategy, FifoMemoryStrategy, LruMemoryStrategy,
+                   LfuDiskStrategy]
+        for cls in classes:
+            for size in self.sizes:
+                prefix = 'strategy.%s[%d]' % (cls.__name__, size)
+                if not self._selected(prefix):
+                    continue
+                keys = _keys(size)
+                samples = min(self.samples, size)
+                per_entry, kind = None, MEMORY
+
+                strategy = self._strategy(cls)
+                _prefill(strategy, keys)
+                if cls is LfuDiskStrategy:
+                    per_entry, kind = _disk_size(self._tmp + '/lfu.bin') \
+                        / float(size), DISK
+                elif cls is not DoNothingStrategy:
+                    per_entry = _deep_size(strategy) / float(size)
+
+                hits = random.sample(keys, samples)
+                hit_ops = _timeit(lambda k: strategy.handle_hit(k, None),
+                                  hits, self.budget)
+                new_keys = _keys(samples)
+                set_ops = _timeit(lambda k: strategy.handle_set(k, None),
+                                  new_keys, self.budget)
+
+                # 超出maxcount samples个, 每次调用remove_keys淘汰一个
+                storage = _FakeStorage(size + samples)
+                strategy.maxsize = float('inf')
+                strategy.maxcount = size + samples
+
+                def _remove(_):
+                    storage.count += 1
+                    strategy.remove_keys(storage)
+                remove_ops = _timeit(_remove, range(samples), self.budget)
+
+                self._record(prefix + '.handle_hit', hit_ops, per_entry, kind)
+                self._record(prefix + '.handle_set', set_ops, per_entry, kind)
+                self._record(prefix + '.remove_keys', remove_ops, per_entry,
+                             kind)
+                if cls is LfuDiskStrategy:
+                    strategy._record.close()
+
+    def bench_disk_record(self):
+        for size in self.sizes:
+            prefix = 'DiskRecord[%d]' % size
+            if not self._selected(prefix):
+                continue
+            path = self._path('record.bin')
+            record = DiskRecord(path)
+            keys = _keys(size)
+            _prefill_record(record, keys)
+            per_entry = _disk_size(path) / float(size)
+            samples = min(self.samples, size)
+
+            search_ops = _timeit(record.search, random.sample(keys, samples),
+                                 self.budget)
+            # 在中间位置插入/删除, 需要移动一半的行
+            insert_ops = _timeit(
+                lambda k: record.insert(record.length() // 2, k, 1),
+                _keys(samples), self.budget)
+            pop_ops = _timeit(lambda _: record.pop_idx(record.length() // 2),
+                              range(samples), self.budget)
+            record.close()
+
+            self._record(prefix + '.search', search_ops, per_entry, DISK)
+            self._record(prefix + '.insert', insert_ops, per_entry, DISK)
+            self._record(prefix + '.pop_idx', pop_ops, per_entry, DISK)
+
+    def run(self):
+        print('%-52s%14s%12s' % ('', 'ops/sec', 'B/entry'))
+        try:
+            self.bench_functions()
+            self.bench_storages()
+            self.bench_strategies()
+            self.bench_disk_record()
+        finally:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+        return self.results
+
+
+def _git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=devnull).strip().decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results, threshold):
+    """
+    :return: 超过阈值的退化项 [(名称, 指标, 旧值, 新值)]
+    """
+    regressions = []
+    print('\n%-52s%10s%10s' % ('compared with baseline', 'ops', 'B/entry'))
+    for name in sorted(set(baseline) & set(results)):
+        old, new = baseline[name], results[name]
+        ops_change = new['ops_per_sec'] / old['ops_per_sec'] - 1 \
+            if old['ops_per_sec'] else 0.0
+        mem_change = None
+        if old.get('bytes_per_entry') and new.get('bytes_per_entry'):
+            mem_change = new['bytes_per_entry'] / old['bytes_per_entry'] - 1
+
+        flags = ''
+        if ops_change < -threshold:
+            regressions.append((name, 'ops_per_sec', old['ops_per_sec'],
+                                new['ops_per_sec']))
+            flags += ' !ops'
+        if mem_change is not None and mem_change > threshold:
+            regressions.append((name, 'bytes_per_entry',
+                                old['bytes_per_entry'],
+                                new['bytes_per_entry']))
+            flags += ' !mem'
+        print('%-52s%+9.1f%%%10s%s' % (
+            name, ops_change * 100,
+            '-' if mem_change is None else '%+.1f%%' % (mem_change * 100),
+            flags))
+    return regressions
+
+
+def _parse_sizes(value):
+    return [int(float(s)) for s in value.split(',') if s]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=_parse_sizes,
+                        default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6],
+                        help='策略和DiskRecord的key数, 逗号分隔, 如1e3,1e4')
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='每项最多测量的操作数')
+    parser.add_argument('--budget', type=float, default=1.0,
+                        help='每项最长测量时间(秒), 至少执行一次操作')
+    parser.add_argument('--storage-count', type=int, default=20000)
+    parser.add_argument('--disk-count', type=int, default=2000)
+    parser.add_argument('--value-size', type=int, default=1024)
+    parser.add_argument('--filter', help='只运行名称包含该字符串的项')
+    parser.add_argument('--output', metavar='FILE', help='保存结果(JSON)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='与之前保存的结果比较')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='允许的退化比例, 默认0.2即20%%')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    suite = Suite(args.sizes, args.samples, args.budget, args.storage_count,
+                  args.disk_count, args.value_size, args.filter)
+    results = suite.run()
+
+    if args.output:
+        data = {'meta': {'revision': _git_revision(), 'time': time.time(),
+                         'python': platform.python_version(),
+                         'value_size': args.value_size},
+                'results': results}
+        with open(args.output, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print('\n%d regression(s) over %.0f%%:' % (len(regressions),
+                                                      args.threshold * 100))
+            for name, metric, old, new in regressions:
+                print('  %s %s: %.1f -> %.1f' % (name, metric, old, new))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
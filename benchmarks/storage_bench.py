@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+比较DiskStorage, GroupCommitDiskStorage和SqliteStorage在大量小图片下的
+读写速度. 分组提交的写入计时包括最后一次flush
+
+    python benchmarks/storage_bench.py --count 2000 --size 20000
+"""
+import argparse
+import binascii
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from pixiv_fetcher.cache.storage import DiskStorage, SqliteStorage, \
+    GroupCommitDiskStorage, SYNC_NONE, SYNC_PERIODIC, SYNC_ALWAYS
+
+
+def _disk(path):
+    return DiskStorage(path, binascii.hexlify)
+
+
+def _group_commit(durability):
+    return lambda path: GroupCommitDiskStorage(path, binascii.hexlify,
+                                               durability=durability)
+
+
+def _sqlite(path):
+    return SqliteStorage(path)
+
+
+BACKENDS = [('DiskStorage', _disk),
+            ('GC(none)', _group_commit(SYNC_NONE)),
+            ('GC(periodic)', _group_commit(SYNC_PERIODIC)),
+            ('GC(always)', _group_commit(SYNC_ALWAYS)),
+            ('SqliteStorage', _sqlite)]
+
+
+def _timeit(func, ops, flush=None):
+    start = time.time()
+    func()
+    if flush is not None:
+        flush()
+    elapsed = time.time() - start
+    return ops / elapsed if elapsed else float('inf')
+
+
+def bench(factory, count, size, batch):
+    path = tempfile.mkdtemp()
+    try:
+        storage = factory(path)
+        flush = getattr(storage, 'flush', None)
+        keys = [os.urandom(16) for _ in range(count)]
+        values = [os.urandom(random.randint(size // 2, size))
+                  for _ in range(count)]
+        items = list(zip(keys, values))
+        shuffled = random.sample(keys, len(keys))
+
+        results = {}
+        results['set'] = _timeit(
+            lambda: [storage.set(k, v) for k, v in items], count, flush)
+        results['get'] = _timeit(
+            lambda: [storage.get(k) for k in shuffled], count)
+        results['get_many'] = _timeit(
+            lambda: [storage.get_many(shuffled[i:i + batch])
+                     for i in range(0, count, batch)], count)
+        results['delete_many'] = _timeit(
+            lambda: [storage.delete_many(keys[i:i + batch])
+                     for i in range(0, count, batch)], count, flush)
+        results['set_many'] = _timeit(
+            lambda: [storage.set_many(items[i:i + batch])
+                     for i in range(0, count, batch)], count, flush)
+        results['delete'] = _timeit(
+            lambda: [storage.delete(k) for k in keys], count, flush)
+        if hasattr(storage, 'close'):
+            storage.close()
+        return results
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=20000,
+                        help='最大值大小(字节), 实际为size/2~size')
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    ops = ['set', 'get', 'get_many', 'set_many', 'delete_many', 'delete']
+    print('%-14s' % 'ops/sec' + ''.join('%12s' % op for op in ops))
+    for name, factory in BACKENDS:
+        results = bench(factory, args.count, args.size, args.batch)
+        print('%-14s' % name + ''.join('%12.0f' % results[op] for op in ops))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,28 @@
 import logging
 
+from OpenSSL import SSL
 from twisted.internet.ssl import ClientContextFactory
 
-from .resource import PixivImageProxyResource
+from .accesslog import AccessLog
+from .cluster import PeerCluster
+from .http2 import H2Site, listen_http2
+from .ratelimit import RateLimitFilter
+from .resource import PixivImageProxyResource, PixivBatchResource, \
+    PixivPurgeResource, PixivAdminResource
+from .tls import UpstreamTLSPolicy
+from .tracing import Tracer, SlowRequestPrinter, StageHistogram
+from .variants import VariantRenderer
 
 
 class WebClientContextFactory(ClientContextFactory):
 
-    def getContext(self, hostname, port):
-        return ClientContextFactory.getContext(self)
+    _context = None
+
+    def getContext(self, hostname=None, port=None):
+        if self._context is None:
+            self._context = ClientContextFactory.getContext(self)
+            self._context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        return self._context
 
 
 _logger = logging.Logger('pixiv_fetcher')
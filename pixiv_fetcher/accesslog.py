@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+from twisted.python.failure import Failure
+
+from pixiv_fetcher.utils.log import get_logger
+
+CACHE_HIT = 'hit'
+CACHE_STALE = 'stale'
+CACHE_MISS = 'miss'
+CACHE_PEER = 'peer'
+
+_FIELDS = ('ts', 'method', 'uri', 'client', 'status', 'bytes', 'cache',
+           'duration', 'aborted')
+
+
+class AccessLog(object):
+    """
+    结构化访问日志: 请求线程只把记录(元组)追加到队列中, 由后台线程批量
+    格式化为JSON行写出.
+
+    队列是deque, append/popleft在GIL下是原子操作, 不需要加锁; 队列满时
+    直接丢弃新记录而不阻塞reactor, 丢弃数见dropped. 缓存命中的请求可按
+    hit_sample比例采样, 采样记录带有sample字段以便统计时还原
+    """
+
+    def __init__(self, path=None, stream=None, max_queue=65536,
+                 batch_size=512, flush_interval=1.0, hit_sample=1.0,
+                 clock=time.time, random_func=random.random):
+        """
+        :param path: 日志文件路径, 未指定时写到stream(默认stdout)
+        :param hit_sample: 缓存命中请求的记录比例, 0~1
+        """
+        self._path = path
+        self._stream = stream
+        self._max_queue = max_queue
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._hit_sample = hit_sample
+        self._clock = clock
+        self._random = random_func
+
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._write_lock = threading.Lock()
+        self._log = get_logger(self)
+
+        self.dropped = 0
+        self.written = 0
+
+    def log(self, method, uri, client, status, size=None, cache=None,
+            duration=None, aborted=False):
+        """
+        :return: 记录是否进入队列(被采样丢弃或队列已满时为False)
+        """
+        sample = None
+        if cache == CACHE_HIT and self._hit_sample < 1:
+            if self._random() >= self._hit_sample:
+                return False
+            sample = self._hit_sample
+
+        queue = self._queue
+        if len(queue) >= self._max_queue:
+            self.dropped += 1
+            return False
+        queue.append((self._clock(), method, uri, client, status, size,
+                      cache, duration, aborted, sample))
+
+        if len(queue) == self._batch_size:
+            self._wakeup.set()
+        return True
+
+    def track(self, request):
+        """
+        请求结束(包括客户端断开)时记录一条日志; 缓存状态取request.cache_status
+        """
+        start = self._clock()
+
+        def _finished(result):
+            self.log(request.method, request.uri, request.getClientIP(),
+                     request.code, request.sentLength,
+                     getattr(request, 'cache_status', None),
+                     self._clock() - start, isinstance(result, Failure))
+
+        request.notifyFinish().addBoth(_finished)
+
+    @staticmethod
+    def _format(record):
+        entry = dict(zip(_FIELDS, record))
+        if entry['duration'] is not None:
+            entry['duration'] = round(entry['duration'] * 1000, 3)
+        if not entry['aborted']:
+            del entry['aborted']
+        if record[-1] is not None:
+            entry['sample'] = record[-1]
+        return json.dumps(entry, separators=(',', ':'), sort_keys=True)
+
+    def _drain(self):
+        queue = self._queue
+        batch = []
+        while queue and len(batch) < self._batch_size:
+            batch.append(queue.popleft())
+        return batch
+
+    def _write(self, lines):
+        data = '\n'.join(lines) + '\n'
+        if self._path is not None:
+            with open(self._path, 'ab') as fp:
+                fp.write(data.encode('utf-8') if not isinstance(data, bytes)
+                         else data)
+        else:
+            stream = self._stream or sys.stdout
+            stream.write(data)
+            stream.flush()
+
+    def flush(self):
+        """
+        写出队列中的所有记录
+
+        :return: 写出的记录数
+        """
+        total = 0
+        with self._write_lock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    break
+                self._write([self._format(r) for r in batch])
+                total += len(batch)
+            self.written += total
+        return total
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self._log.exception(e)
+        self.flush()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='AccessLog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __len__(self):
+        return len(self._queue)
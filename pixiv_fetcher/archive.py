@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""
+批量下载图片到缓存目录(与代理共用)或普通目录, 中断后重新运行会从进度日志
+继续:
+
+    python -m pixiv_fetcher.archive --cache /data/pixiv ranking.txt
+    cat bookmarks.txt | python -m pixiv_fetcher.archive --output ./mirror
+
+输入每行一个i.pximg.net的图片URL或路径, 或作品id/作品页URL(展开为所有页).
+--cache目录的文件名规则由--path-func指定, 须与代理的DiskStorage相同, 默认
+与DiskStorage的默认规则(safe_path)一致
+"""
+import argparse
+import binascii
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import deque
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from twisted.internet import defer, reactor, task
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.freshness import FreshnessPolicy
+from pixiv_fetcher.cache.storage import DiskStorage, safe_path
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.exceptions import PidResolveError, UnexpectedStatus
+from pixiv_fetcher.scheduler import PRIORITY_PREFETCH
+from pixiv_fetcher.utils.log import get_logger
+from pixiv_fetcher.utils.pixiv import parse_pximg_url
+
+# --path-func的可选值, 须与代理的DiskStorage使用的path_func一致
+PATH_FUNCS = {'safe': safe_path, 'hex': binascii.hexlify}
+
+ITEM_PATH = 'path'
+ITEM_PID = 'pid'
+
+_p_artwork = re.compile(r'(?:/artworks/|illust_id=)(\d+)')
+
+_user_agent = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+               'AppleWebKit/537.36 (KHTML, like Gecko) '
+               'Chrome/90.0.4430.93 Safari/537.36')
+
+
+def parse_item(line):
+    """
+    :return: (ITEM_PATH, 图片路径)或(ITEM_PID, 作品id), 空行、注释或无法
+        识别时为None
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.isdigit():
+        return ITEM_PID, int(line)
+
+    match = _p_artwork.search(line)
+    if match:
+        return ITEM_PID, int(match.group(1))
+
+    parsed = urlparse(line)
+    path = parsed.path if parsed.netloc else line
+    path = path if path.startswith('/') else '/' + path
+    if parse_pximg_url(path) is None:
+        return None
+    return ITEM_PATH, path
+
+
+class Journal(object):
+    """
+    进度日志, 每行一条制表符分隔的记录, 写入后立即flush:
+
+        pid   <作品id>  <路径> [<路径> ...]
+        ok    <路径>    <字节数>
+        skip  <路径>
+        fail  <路径>    <原因>
+
+    重新运行时ok/skip的路径直接跳过, 展开过的作品id不再请求, fail的重试
+    """
+
+    def __init__(self, path=None):
+        self.done = set()
+        self.pids = {}
+        self._fp = None
+        if path is None:
+            return
+        if os.path.isfile(path):
+            self._load(path)
+        self._fp = open(path, 'ab')
+
+    def _load(self, path):
+        with open(path, 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    # 上次中断时写了一半的行
+                    break
+                fields = line.rstrip(b'\n').split(b'\t')
+                kind = fields[0]
+                if kind == b'pid' and len(fields) >= 2:
+                    self.pids[int(fields[1])] = fields[2:]
+                elif kind in (b'ok', b'skip') and len(fields) >= 2:
+                    self.done.add(fields[1])
+                elif kind == b'fail' and len(fields) >= 2:
+                    self.done.discard(fields[1])
+
+    def _write(self, *fields):
+        if self._fp is None:
+            return
+        line = b'\t'.join(str(f).replace('\t', ' ').replace('\n', ' ')
+                          for f in fields)
+        self._fp.write(line + b'\n')
+        self._fp.flush()
+
+    def record_pid(self, pid, paths):
+        self.pids[pid] = list(paths)
+        self._write('pid', pid, *paths)
+
+    def record_done(self, path, size):
+        self.done.add(path)
+        self._write('ok', path, size)
+
+    def record_skip(self, path):
+        self.done.add(path)
+        self._write('skip', path)
+
+    def record_fail(self, path, reason):
+        self._write('fail', path, reason)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+
+class CacheTarget(object):
+    """
+    写入Cache, key与代理相同(图片路径)
+    """
+
+    def __init__(self, cache, freshness=None):
+        """
+        :type cache: pixiv_fetcher.cache.Cache
+        """
+        self._cache = cache
+        self._freshness = freshness or FreshnessPolicy()
+
+    def has(self, path):
+        return self._cache.has(path)
+
+    def save(self, path, response):
+        self._cache.set(path, response.body,
+                        self._freshness.make_meta(response.headers))
+
+
+class DirectoryTarget(object):
+    """
+    按图片路径写入普通目录, 例如 <root>/img-original/img/2018/.../1_p0.jpg
+    """
+
+    def __init__(self, root):
+        self._root = root
+
+    def file_path(self, path):
+        return os.path.join(self._root, *path.strip('/').split('/'))
+
+    def has(self, path):
+        return os.path.isfile(self.file_path(path))
+
+    def save(self, path, response):
+        file_path = self.file_path(path)
+        directory = os.path.dirname(file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(response.body)
+        os.rename(tmp_path, file_path)
+
+
+class PidResolver(object):
+    """
+    通过 /ajax/illust/<pid>/pages 获取作品所有页的图片路径
+    """
+
+    SIZES = ('original', 'regular', 'small', 'thumb_mini')
+
+    def __init__(self, agent=None, base_url='https://www.pixiv.net',
+                 size='original', cookie=None):
+        """
+        :param size: 图片尺寸, SIZES之一, regular为master1200
+        :param cookie: 登录后的Cookie, 部分作品需要登录才能获取
+        """
+        if size not in self.SIZES:
+            raise ValueError('size must be one of %s' % (self.SIZES,))
+        self._agent = agent or Agent(reactor)
+        self._base_url = base_url.rstrip('/')
+        self._size = size
+        self._cookie = cookie
+
+    def resolve(self, pid):
+        """
+        :return: Deferred, 结果为图片路径列表
+        """
+        url = '%s/ajax/illust/%d/pages' % (self._base_url, pid)
+        headers = Headers({'Referer': ['https://www.pixiv.net/'],
+                           'User-Agent': [_user_agent],
+                           'Accept': ['application/json']})
+        if self._cookie:
+            headers.setRawHeaders('Cookie', [self._cookie])
+
+        def _read(response):
+            dfd = readBody(response)
+            dfd.addCallback(self._parse, pid, response.code)
+            return dfd
+
+        return self._agent.request('GET', url, headers).addCallback(_read)
+
+    def _parse(self, body, pid, code):
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise PidResolveError(pid, code, 'invalid response')
+        if code != 200 or data.get('error'):
+            raise PidResolveError(pid, code, data.get('message'))
+        return [str(urlparse(page['urls'][self._size]).path)
+                for page in data['body']]
+
+
+class ArchiveStats(object):
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self.start = clock()
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+        self.retries = 0
+        self.bytes = 0
+
+    @property
+    def elapsed(self):
+        return self._clock() - self.start
+
+    @property
+    def remaining(self):
+        return max(self.total - self.done - self.skipped - self.failed, 0)
+
+    @property
+    def eta(self):
+        """
+        按已下载(不含跳过)的速度估算剩余时间(秒), 无法估算时为None
+        """
+        finished = self.done + self.failed
+        if not finished:
+            return None
+        return self.remaining * self.elapsed / finished
+
+    def format(self):
+        elapsed = self.elapsed or 1e-9
+        eta = self.eta
+        return ('%d/%d done, %d skipped, %d failed, %d retries, '
+                '%.2f MB, %.2f MB/s, %.1f items/s, ETA %s' % (
+                    self.done, self.total, self.skipped, self.failed,
+                    self.retries, self.bytes / 1048576.0,
+                    self.bytes / 1048576.0 / elapsed,
+                    (self.done + self.failed) / elapsed,
+                    '-' if eta is None else _format_seconds(eta)))
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class Archiver(object):
+    """
+    以最多concurrency个并发下载输入中的图片; 作品id先展开为各页路径.
+    失败时按指数退避(带随机抖动)重试, 4xx(429除外)不重试
+    """
+
+    def __init__(self, downloader, target, journal=None, resolver=None,
+                 concurrency=8, retries=3, backoff=1.0, max_backoff=60.0,
+                 clock=reactor):
+        """
+        :type downloader: pixiv_fetcher.downloader.IllustrationDownloader
+        :param target: CacheTarget或DirectoryTarget
+        :type journal: Journal
+        :type resolver: PidResolver
+        """
+        self._downloader = downloader
+        self._target = target
+        self._journal = journal or Journal()
+        self._resolver = resolver
+        self._concurrency = concurrency
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._clock = clock
+        self._pending = deque()
+        self._items = iter(())
+        self._resolving = 0
+        self._waiters = []
+        self._log = get_logger(self)
+
+        self.stats = ArchiveStats(clock.seconds)
+
+    def _next(self):
+        if self._pending:
+            return self._pending.popleft()
+        return next(self._items, None)
+
+    def run(self, items):
+        """
+        :param items: parse_item的结果列表
+        :return: Deferred, 完成时结果为stats
+        """
+        items = [item for item in items if item is not None]
+        self.stats.total += len(items)
+        self._items = iter(items)
+        workers = [self._work() for _ in range(self._concurrency)]
+        dfd = defer.gatherResults(workers, consumeErrors=True)
+        return dfd.addCallback(lambda _: self.stats)
+
+    @defer.inlineCallbacks
+    def _work(self):
+        while True:
+            item = self._next()
+            if item is None:
+                if not self._resolving:
+                    break
+                # 等待正在展开的作品, 以便各页也能并发下载
+                waiter = defer.Deferred()
+                self._waiters.append(waiter)
+                yield waiter
+                continue
+            kind, value = item
+            try:
+                if kind == ITEM_PID:
+                    yield self._expand(value)
+                else:
+                    yield self._archive(value)
+            except Exception as e:
+                self.stats.failed += 1
+                self._journal.record_fail(value, e)
+                self._log.warn(u'%s 失败: %s', value, e)
+
+    @defer.inlineCallbacks
+    def _expand(self, pid):
+        paths = self._journal.pids.get(pid)
+        if paths is None:
+            if self._resolver is None:
+                raise ValueError('No resolver for pid %d' % pid)
+            self._resolving += 1
+            try:
+                paths = yield self._retry(self._resolver.resolve, pid)
+            finally:
+                self._resolving -= 1
+                waiters, self._waiters = self._waiters, []
+                for waiter in waiters:
+                    waiter.callback(None)
+            self._journal.record_pid(pid, paths)
+        # 作品本身不计数, 改为计入其各页
+        self.stats.total += len(paths) - 1
+        self._pending.extendleft((ITEM_PATH, p) for p in reversed(paths))
+
+    @defer.inlineCallbacks
+    def _archive(self, path):
+        if path in self._journal.done:
+            self.stats.skipped += 1
+            return
+        if self._target.has(path):
+            self.stats.skipped += 1
+            self._journal.record_skip(path)
+            return
+
+        response = yield self._retry(self._fetch, path)
+        self._target.save(path, response)
+        self.stats.done += 1
+        self.stats.bytes += len(response.body)
+        self._journal.record_done(path, len(response.body))
+
+    def _fetch(self, path):
+        def _check(response):
+            if response.code != 200:
+                raise UnexpectedStatus(path, response.code)
+            return response
+
+        dfd = self._downloader.fetch(path, priority=PRIORITY_PREFETCH)
+        return dfd.addCallback(_check)
+
+    def _delay(self, attempt, error):
+        delay = min(self._backoff * 2 ** attempt, self._max_backoff)
+        delay = random.uniform(delay / 2.0, delay)
+        # 熔断器打开时至少等到半开
+        return max(delay, getattr(error, 'retry_after', None) or 0)
+
+    @defer.inlineCallbacks
+    def _retry(self, func, arg):
+        attempt = 0
+        while True:
+            try:
+                result = yield func(arg)
+            except Exception as e:
+                if attempt >= self._retries or getattr(e, 'permanent', False):
+                    raise
+                delay = self._delay(attempt, e)
+                attempt += 1
+                self.stats.retries += 1
+                self._log.info(u'%s 失败(%s), %.1f秒后第%d次重试', arg, e,
+                               delay, attempt)
+                yield task.deferLater(self._clock, delay, lambda: None)
+            else:
+                defer.returnValue(result)
+
+
+def _read_items(source):
+    fp = sys.stdin if source == '-' else open(source, 'rb')
+    try:
+        return [parse_item(line) for line in fp]
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+
+def _make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m pixiv_fetcher.archive', description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default='-',
+                        help='输入文件, 默认(-)为标准输入')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--cache', metavar='DIR',
+                        help='写入DiskStorage缓存目录')
+    parser.add_argument('--path-func', choices=sorted(PATH_FUNCS),
+                        default='safe',
+                        help='--cache的文件名规则, 须与代理一致: safe为'
+                             'DiskStorage的默认规则, hex为key的十六进制')
+    target.add_argument('--output', metavar='DIR',
+                        help='按图片路径写入普通目录')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='进度日志, 默认为DIR/.archive-journal')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=1.0,
+                        help='第一次重试前的等待时间(秒), 之后每次翻倍')
+    parser.add_argument('--size', choices=PidResolver.SIZES,
+                        default='original', help='作品id展开的图片尺寸')
+    parser.add_argument('--cookie', help='请求作品信息时使用的Cookie')
+    parser.add_argument('--host', default='i.pximg.net')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--scheme', default='https://')
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help='输出进度的间隔(秒), 0表示不输出')
+    return parser
+
+
+@defer.inlineCallbacks
+def _run(_reactor, args):
+    root = args.cache or args.output
+    if args.cache:
+        target = CacheTarget(Cache(DiskStorage(
+            root, PATH_FUNCS[args.path_func])))
+    else:
+        target = DirectoryTarget(root)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+
+    journal = Journal(args.journal or os.path.join(root, '.archive-journal'))
+    downloader = IllustrationDownloader(
+        args.host, args.port, pool_maxsize=args.concurrency,
+        scheme=args.scheme, max_concurrency=args.concurrency)
+    archiver = Archiver(downloader, target, journal,
+                        PidResolver(size=args.size, cookie=args.cookie),
+                        concurrency=args.concurrency, retries=args.retries,
+                        backoff=args.backoff)
+
+    def _progress():
+        sys.stderr.write(archiver.stats.format() + '\n')
+
+    progress = task.LoopingCall(_progress)
+    if args.progress_interval > 0:
+        progress.start(args.progress_interval, now=False)
+    try:
+        stats = yield archiver.run(_read_items(args.input))
+    finally:
+        if progress.running:
+            progress.stop()
+        journal.close()
+    _progress()
+    sys.stderr.write('Finished in %s\n' % _format_seconds(stats.elapsed))
+    if stats.failed:
+        raise SystemExit(1)
+
+
+def main(argv=None):
+    args = _make_parser().parse_args(argv)
+    task.react(_run, (args,))
+
+
+if __name__ == '__main__':
+    main()
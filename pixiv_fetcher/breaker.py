@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from pixiv_fetcher.exceptions import CircuitOpenError
+from pixiv_fetcher.utils.log import get_logger
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+
+class _Bucket(object):
+
+    __slots__ = ('start', 'total', 'errors', 'slow')
+
+    def __init__(self, start):
+        self.start = start
+        self.total = 0
+        self.errors = 0
+        self.slow = 0
+
+
+class SlidingWindow(object):
+    """
+    按时间分桶的滑动窗口, 统计请求数/错误数/慢请求数
+    """
+
+    def __init__(self, length=30.0, resolution=1.0):
+        self.length = length
+        self.resolution = resolution
+        self._buckets = deque()
+
+    def _bucket(self, now):
+        start = now - now % self.resolution
+        if not self._buckets or self._buckets[-1].start != start:
+            self._buckets.append(_Bucket(start))
+        return self._buckets[-1]
+
+    def _expire(self, now):
+        while self._buckets \
+                and self._buckets[0].start <= now - self.length:
+            self._buckets.popleft()
+
+    def add(self, now, error=False, slow=False):
+        self._expire(now)
+        bucket = self._bucket(now)
+        bucket.total += 1
+        bucket.errors += bool(error)
+        bucket.slow += bool(slow)
+
+    def counts(self, now):
+        self._expire(now)
+        total = errors = slow = 0
+        for bucket in self._buckets:
+            total += bucket.total
+            errors += bucket.errors
+            slow += bucket.slow
+        return total, errors, slow
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class CircuitBreaker(object):
+    """
+    上游熔断器: 滑动窗口内错误率或慢请求率超过阈值时打开, 打开期间请求立即以
+    CircuitOpenError失败; reset_timeout后进入半开状态, 只放行half_open_max个
+    探测请求, 全部成功则关闭, 任一失败则重新打开
+    """
+
+    def __init__(self, window=30.0, min_requests=20, error_threshold=0.5,
+                 slow_threshold=None, slow_rate_threshold=0.5,
+                 reset_timeout=10.0, half_open_max=1, error_func=None,
+                 clock=reactor, max_transitions=100):
+        """
+        :param window: 滑动窗口长度(秒)
+        :param min_requests: 窗口内请求数少于该值时不会打开
+        :param slow_threshold: 超过该耗时(秒)的请求计为慢请求, None表示不统计
+        :param error_func: 判断成功结果是否应视为上游错误
+        """
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.slow_threshold = slow_threshold
+        self.slow_rate_threshold = slow_rate_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max = half_open_max
+
+        self._window = SlidingWindow(window)
+        self._error_func = error_func
+        self._clock = clock
+
+        self._state = STATE_CLOSED
+        self._opened_at = None
+        self._probes = 0
+        self._probe_successes = 0
+        self._rejected = 0
+
+        self._transitions = deque(maxlen=max_transitions)
+        self._listeners = []
+        self._log = get_logger(self)
+
+    def add_listener(self, listener):
+        """
+        :param listener: listener(breaker, old_state, new_state)
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def _transition(self, state):
+        old, self._state = self._state, state
+        if old == state:
+            return
+
+        now = self._clock.seconds()
+        if state == STATE_OPEN:
+            self._opened_at = now
+        elif state == STATE_CLOSED:
+            self._window.clear()
+        self._probes = 0
+        self._probe_successes = 0
+
+        self._transitions.append((now, old, state))
+        self._log.warn(u'熔断器状态变化: %s -> %s', old, state)
+        for listener in self._listeners:
+            listener(self, old, state)
+
+    @property
+    def state(self):
+        if self._state == STATE_OPEN and self.retry_after <= 0:
+            self._transition(STATE_HALF_OPEN)
+        return self._state
+
+    @property
+    def retry_after(self):
+        if self._state != STATE_OPEN:
+            return 0
+        elapsed = self._clock.seconds() - self._opened_at
+        return max(self.reset_timeout - elapsed, 0)
+
+    def allow(self):
+        state = self.state
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_HALF_OPEN and self._probes < self.half_open_max:
+            self._probes += 1
+            return True
+        self._rejected += 1
+        return False
+
+    def record_success(self, latency=0.0):
+        slow = self.slow_threshold is not None \
+            and latency > self.slow_threshold
+        if self._state == STATE_HALF_OPEN:
+            if slow:
+                self._transition(STATE_OPEN)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_max:
+                self._transition(STATE_CLOSED)
+            return
+
+        self._window.add(self._clock.seconds(), slow=slow)
+        self._check()
+
+    def record_failure(self):
+        if self._state == STATE_HALF_OPEN:
+            self._transition(STATE_OPEN)
+            return
+
+        self._window.add(self._clock.seconds(), error=True)
+        self._check()
+
+    def _release(self):
+        if self._state == STATE_HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _check(self):
+        if self._state != STATE_CLOSED:
+            return
+        total, errors, slow = self._window.counts(self._clock.seconds())
+        if total < self.min_requests:
+            return
+        if errors >= total * self.error_threshold \
+                or (self.slow_threshold is not None
+                    and slow >= total * self.slow_rate_threshold):
+            self._transition(STATE_OPEN)
+
+    def call(self, func, *args, **kw):
+        """
+        熔断器打开时立即返回以CircuitOpenError失败的Deferred
+        """
+        if not self.allow():
+            return defer.fail(CircuitOpenError(self.retry_after))
+
+        start = self._clock.seconds()
+
+        def _record(result):
+            if isinstance(result, Failure):
+                if result.check(defer.CancelledError):
+                    self._release()
+                else:
+                    self.record_failure()
+            elif self._error_func is not None and self._error_func(result):
+                self.record_failure()
+            else:
+                self.record_success(self._clock.seconds() - start)
+            return result
+
+        return defer.maybeDeferred(func, *args, **kw).addBoth(_record)
+
+    @property
+    def transitions(self):
+        return list(self._transitions)
+
+    def as_dict(self):
+        total, errors, slow = self._window.counts(self._clock.seconds())
+        return {
+            'state': self.state,
+            'retry_after': self.retry_after,
+            'requests': total,
+            'errors': errors,
+            'slow': slow,
+            'rejected': self._rejected,
+            'transitions': self.transitions,
+        }
+
+    def __str__(self):
+        return '<%s@0x%x [state=%s]>' % (self.__class__.__name__, id(self),
+                                         self.state)
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 import hashlib
 import threading
+import time
 
 from pixiv_fetcher.utils.log import get_logger
+from .expiry import ExpiryIndex
+from .snapshot import save_snapshot, load_snapshot, SnapshotRestorer
 from .strategy import DoNothingStrategy
 
+# ttl参数的默认值, 表示使用default_ttl; ttl=None表示不过期
+DEFAULT_TTL = object()
+
 
 def hash_key(key):
     h = hashlib.md5(key)
@@ -62,25 +68,59 @@ class _CacheRate(object):
                % (self.hit_count, self.hit_rate, self.total)
 
 
+class _EvictionRecorder(object):
+    """
+    传给淘汰策略的存储包装, 记录被淘汰的key, 以便同时从索引中移除
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.evicted = []
+
+    def delete(self, key):
+        self._storage.delete(key)
+        self.evicted.append(key)
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+
 class Cache(object):
 
-    def __init__(self, storage, strategy=None, hash_func=None):
+    def __init__(self, storage, strategy=None, hash_func=None,
+                 default_ttl=None, expiry=None, index=None):
         """
         :param storage:
         :type storage: pixiv_fetcher.cache.storage.BaseStorage
         :param strategy:
         :type strategy: pixiv_fetcher.cache.strategy.BaseStrategy
+        :param default_ttl: set未指定ttl时的默认存活时间(秒), None表示不过期
+        :param expiry: 过期时间索引, 磁盘缓存应使用带path的索引以便重启后保留
+        :type expiry: pixiv_fetcher.cache.expiry.ExpiryIndex
+        :param index: pid索引, 用于purge; 被策略淘汰或过期的key立即从索引中
+                      移除
+        :type index: pixiv_fetcher.cache.index.PidIndex
         """
         self._storage = storage
         self._strategy = strategy or DoNothingStrategy()
         self._hash_func = hash_func or hash_key
 
+        self._default_ttl = default_ttl
+        if expiry is None and default_ttl is not None:
+            expiry = ExpiryIndex()
+        self._expiry = expiry
+        self._index = index
+
         self._rate = _CacheRate()
         self._log = get_logger(self)
 
     def get(self, key, default=None):
         k = self._hash_func(key)
-        value = self._storage.get(k, default)
+        if self._expiry is not None and self._expiry.is_expired(k):
+            self._delete(k)
+            value = default
+        else:
+            value = self._storage.get(k, default)
         if value is not None:
             self._rate.hit()
             self._strategy.handle_hit(k, value)
@@ -88,20 +128,228 @@ class Cache(object):
         else:
             self._rate.missing()
             self._strategy.handle_missing(k)
-            self._log.info('缓存缺失: %r [%s]', key, self)
+            self._log.debug('缓存缺失: %r [%s]', key, self)
 
         return value
 
-    def set(self, key, value):
-        key = self._hash_func(key)
+    def has(self, key):
+        """
+        不计入命中率, 也不通知淘汰策略
+        """
+        k = self._hash_func(key)
+        if self._expiry is not None and self._expiry.is_expired(k):
+            return False
+        return self._storage.has(k)
+
+    def set(self, key, value, meta=None, ttl=DEFAULT_TTL):
+        """
+        :param ttl: 存活时间(秒), 默认为default_ttl, None表示不过期
+        """
+        raw_key, key = key, self._hash_func(key)
         result = self._storage.set(key, value)
+        if self._index is not None:
+            self._index.add(raw_key, key)
+        if meta is not None:
+            self._storage.set_meta(key, meta)
+
+        ttl = self._default_ttl if ttl is DEFAULT_TTL else ttl
+        if ttl is not None:
+            if self._expiry is None:
+                self._expiry = ExpiryIndex()
+            self._expiry.set(key, time.time() + ttl)
+        elif self._expiry is not None:
+            self._expiry.discard(key)
 
         self._strategy.handle_set(key, value)
         self._clean_up_storage()
         return result
 
+    def get_many(self, keys):
+        """
+        :return: {key: value}, 不包含未命中的key
+        """
+        hashed = {}
+        for key in keys:
+            k = self._hash_func(key)
+            if self._expiry is not None and self._expiry.is_expired(k):
+                self._delete(k)
+            else:
+                hashed[k] = key
+
+        found = self._storage.get_many(hashed.keys())
+        results = {}
+        for k, key in hashed.items():
+            value = found.get(k)
+            if value is not None:
+                self._rate.hit()
+                self._strategy.handle_hit(k, value)
+                results[key] = value
+            else:
+                self._rate.missing()
+                self._strategy.handle_missing(k)
+        self._log.debug('批量读取: %d/%d [%s]', len(results), len(hashed),
+                        self)
+        return results
+
+    def set_many(self, items, ttl=DEFAULT_TTL):
+        """
+        :param items: [(key, value)]或dict
+        :param ttl: 同set
+        """
+        items = items.items() if isinstance(items, dict) else items
+        items = list(items)
+        hashed = [(self._hash_func(key), value) for key, value in items]
+        result = self._storage.set_many(hashed)
+        if self._index is not None:
+            for (raw_key, _), (key, _) in zip(items, hashed):
+                self._index.add(raw_key, key)
+
+        ttl = self._default_ttl if ttl is DEFAULT_TTL else ttl
+        expires = None if ttl is None else time.time() + ttl
+        if expires is not None and self._expiry is None:
+            self._expiry = ExpiryIndex()
+        for key, value in hashed:
+            if self._expiry is not None:
+                self._expiry.set(key, expires)
+            self._strategy.handle_set(key, value)
+        self._clean_up_storage()
+        return result
+
+    def delete(self, key):
+        return self._delete(self._hash_func(key))
+
+    def delete_many(self, keys):
+        self._delete_many([self._hash_func(key) for key in keys])
+
+    def _delete_many(self, hashed):
+        self._storage.delete_many(hashed)
+        self._strategy.reset_many(hashed)
+        for key in hashed:
+            if self._expiry is not None:
+                self._expiry.discard(key)
+            if self._index is not None:
+                self._index.discard(key)
+
+    def _delete(self, key):
+        self._storage.delete(key)
+        self._strategy.reset(key)
+        if self._expiry is not None:
+            self._expiry.discard(key)
+        if self._index is not None:
+            self._index.discard(key)
+
+    def purge(self, pids):
+        """
+        删除属于指定作品的所有条目
+
+        :param pids: 作品ID列表
+        :return: 实际删除的条目数
+        """
+        if self._index is None:
+            return 0
+        hashed = []
+        for pid in pids:
+            hashed.extend(self._index.pop(pid))
+        if not hashed:
+            return 0
+
+        count = self._storage.count
+        self._delete_many(hashed)
+        self._log.debug('清除作品缓存: %r, %d个 [%s]', pids, len(hashed), self)
+        return count - self._storage.count
+
+    def ttl(self, key):
+        """
+        :return: 剩余存活时间(秒), 不过期时为None
+        """
+        if self._expiry is None:
+            return None
+        expires = self._expiry.get(self._hash_func(key))
+        if expires is None:
+            return None
+        return max(expires - time.time(), 0)
+
+    def expire(self, now=None):
+        """
+        删除所有已过期的条目
+
+        :return: 删除的条目数
+        """
+        if self._expiry is None:
+            return 0
+        expired = self._expiry.advance(now)
+        for key in expired:
+            self._storage.delete(key)
+            self._strategy.reset(key)
+            if self._index is not None:
+                self._index.discard(key)
+        return len(expired)
+
+    def hot_keys(self, limit=None):
+        """
+        :return: 按策略的热度排列的(已哈希的)key
+        """
+        return self._strategy.hot_keys(limit)
+
+    def export_entry(self, key):
+        """
+        按已哈希的key读取条目, 不计入命中率也不更新策略
+
+        :return: (value, meta, 过期时间, pid), 不存在或已过期时为None
+        """
+        expires = None
+        if self._expiry is not None:
+            if self._expiry.is_expired(key):
+                return None
+            expires = self._expiry.get(key)
+        value = self._storage.get(key)
+        if value is None:
+            return None
+        pid = self._index.pid_for(key) if self._index is not None else None
+        return value, self._storage.get_meta(key), expires, pid
+
+    def import_entry(self, key, value, meta=None, expires=None, pid=None):
+        """
+        写入从其他缓存或快照恢复的条目(已哈希的key), 已存在时不覆盖
+
+        :return: 写入后条目是否仍在缓存中(缓存已满时会被立即淘汰)
+        """
+        if self._storage.has(key):
+            return True
+        if expires is not None and expires <= time.time():
+            return False
+
+        self._storage.set(key, value)
+        if meta is not None:
+            self._storage.set_meta(key, meta)
+        if expires is not None:
+            if self._expiry is None:
+                self._expiry = ExpiryIndex()
+            self._expiry.set(key, expires)
+        if self._index is not None:
+            self._index.add_pid(pid, key)
+        self._strategy.handle_restore(key, value)
+        self._clean_up_storage()
+        return self._storage.has(key)
+
+    def get_meta(self, key, default=None):
+        return self._storage.get_meta(self._hash_func(key), default)
+
+    def set_meta(self, key, meta):
+        return self._storage.set_meta(self._hash_func(key), meta)
+
     def _clean_up_storage(self):
-        self._strategy.remove_keys(self._storage)
+        if self._index is None and self._expiry is None:
+            self._strategy.remove_keys(self._storage)
+            return
+
+        recorder = _EvictionRecorder(self._storage)
+        self._strategy.remove_keys(recorder)
+        for key in recorder.evicted:
+            if self._expiry is not None:
+                self._expiry.discard(key)
+            if self._index is not None:
+                self._index.discard(key)
 
     @property
     def count(self):
@@ -115,6 +363,10 @@ class Cache(object):
     def state(self):
         return self._rate
 
+    @property
+    def storage(self):
+        return self._storage
+
     def __str__(self):
         cls_name = self.__class__.__name__
         strategy_name = self._strategy.__class__.__name__
@@ -137,15 +389,88 @@ class CombinationCache(object):
                 self._rate.hit()
                 pre_index = i - 1
                 if pre_index >= 0:
-                    self._caches[pre_index].set(key, value)
+                    self._caches[pre_index].set(key, value,
+                                                cache.get_meta(key),
+                                                cache.ttl(key))
                 return value
 
         self._rate.missing()
         return default
 
-    def set(self, key, value):
+    def set(self, key, value, meta=None, ttl=DEFAULT_TTL):
+        for cache in self._caches:
+            cache.set(key, value, meta, ttl)
+
+    def delete(self, key):
+        for cache in self._caches:
+            cache.delete(key)
+
+    def get_many(self, keys):
+        results = {}
+        remaining = list(keys)
+        for i, cache in enumerate(self._caches):
+            if not remaining:
+                break
+            found = cache.get_many(remaining)
+            if i > 0:
+                # 与get相同, 逐个提升到上一层并保留meta和剩余存活时间
+                upper = self._caches[i - 1]
+                for key, value in found.items():
+                    upper.set(key, value, cache.get_meta(key), cache.ttl(key))
+            results.update(found)
+            remaining = [k for k in remaining if k not in found]
+
+        for _ in range(len(results)):
+            self._rate.hit()
+        for _ in remaining:
+            self._rate.missing()
+        return results
+
+    def set_many(self, items, ttl=DEFAULT_TTL):
+        items = list(items.items() if isinstance(items, dict) else items)
         for cache in self._caches:
-            cache.set(key, value)
+            cache.set_many(items, ttl)
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for cache in self._caches:
+            cache.delete_many(keys)
+
+    def expire(self, now=None):
+        return sum(cache.expire(now) for cache in self._caches)
+
+    def purge(self, pids):
+        pids = list(pids)
+        return sum(cache.purge(pids) for cache in self._caches)
+
+    def save_snapshot(self, path, limit=None):
+        """
+        保存第一层(内存层)最热的key, 应在正常关闭时调用, 例如
+        reactor.addSystemEventTrigger('before', 'shutdown', ...)
+        """
+        return save_snapshot(self._caches[0], path, limit)
+
+    def restore_snapshot(self, path, pause=0.0):
+        """
+        在后台从第二层恢复快照中的条目到第一层
+
+        :rtype: pixiv_fetcher.cache.snapshot.SnapshotRestorer
+        """
+        restorer = SnapshotRestorer(self._caches[0], self._caches[1],
+                                    load_snapshot(path), pause)
+        restorer.start()
+        return restorer
+
+    def get_meta(self, key, default=None):
+        for cache in self._caches:
+            meta = cache.get_meta(key)
+            if meta is not None:
+                return meta
+        return default
+
+    def set_meta(self, key, meta):
+        results = [cache.set_meta(key, meta) for cache in self._caches]
+        return any(results)
 
     @property
     def size(self):
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import struct
+import threading
+
+from pixiv_fetcher.utils.path import make_direct_open
+from .storage import BaseStorage
+
+
+def content_digest(value):
+    return hashlib.sha256(value).digest()
+
+
+class DedupStorage(BaseStorage):
+    """
+    内容寻址去重: 值按内容摘要在blobs中只保存一份, key映射到摘要, 摘要带
+    引用计数, 最后一个引用删除时才从blobs中删除. 同一张图片的不同URL写法,
+    镜像路径和重新上传只占用一份空间.
+
+    count为key数, size为去重后的字节数(即blobs.size), 淘汰策略按实际占用
+    淘汰; 被淘汰的key若与其他key共享内容则不释放空间. meta按key保存.
+
+    指定path时key到摘要的映射和meta以追加日志的形式保存, 重启后重放, 每次
+    追加后flush到系统. 写入时先写blobs再写日志, 删除时先写日志再删blobs:
+    崩溃时至多在blobs中留下没有引用的值, 不会有key指向被删除的值
+    """
+
+    _record_fmt = '<BHIQ'  # 操作, key长度, 数据长度, 值大小
+    _record_size = struct.calcsize(_record_fmt)
+
+    _OP_SET = 1
+    _OP_DELETE = 2
+    _OP_META = 3
+
+    def __init__(self, blobs, path=None, digest_func=None):
+        """
+        :param blobs: 以摘要为key保存值的存储
+        :type blobs: pixiv_fetcher.cache.storage.BaseStorage
+        :param path: 映射日志文件, blobs为磁盘存储时应指定
+        :param digest_func: 默认为SHA-256
+        """
+        self._blobs = blobs
+        self._digest_func = digest_func or content_digest
+
+        self._digests = {}  # key: 摘要
+        self._refs = {}  # 摘要: 引用数
+        self._sizes = {}  # 摘要: 值大小
+        self._meta = {}
+        self._logical_size = 0
+        self._lock = threading.RLock()
+
+        self._path = path
+        self._fp = None
+        self._records = 0
+        if path is not None:
+            self._load()
+
+    # 日志
+
+    def _load(self):
+        if os.path.isfile(self._path):
+            with open(self._path, 'rb') as fp:
+                while True:
+                    raw = fp.read(self._record_size)
+                    if len(raw) < self._record_size:
+                        break
+                    op, key_len, data_len, size = struct.unpack(
+                        self._record_fmt, raw)
+                    key = fp.read(key_len)
+                    data = fp.read(data_len)
+                    if len(key) < key_len or len(data) < data_len:
+                        break
+                    if op == self._OP_SET:
+                        self._link(key, data, size)
+                    elif op == self._OP_DELETE:
+                        self._unlink(key)
+                    elif key in self._digests:
+                        self._meta[key] = json.loads(data.decode('utf-8'))
+        self._compact()
+
+    def _compact(self):
+        if self._fp is not None:
+            self._fp.close()
+        tmp_path = self._path + '.tmp'
+        with make_direct_open(tmp_path, 'wb') as fp:
+            for key, digest in self._digests.items():
+                fp.write(self._pack(self._OP_SET, key, digest,
+                                    self._sizes[digest]))
+                if key in self._meta:
+                    fp.write(self._pack_meta(key, self._meta[key]))
+        os.rename(tmp_path, self._path)
+        self._fp = open(self._path, 'ab')
+        self._records = len(self._digests) + len(self._meta)
+
+    def _pack(self, op, key, data=b'', size=0):
+        return struct.pack(self._record_fmt, op, len(key), len(data),
+                           size) + key + data
+
+    def _pack_meta(self, key, meta):
+        return self._pack(self._OP_META, key,
+                          json.dumps(meta, sort_keys=True).encode('utf-8'))
+
+    def _append(self, raw, records=1):
+        if self._fp is None:
+            return
+        self._fp.write(raw)
+        self._fp.flush()
+        self._records += records
+        if self._records > 2 * (len(self._digests) + len(self._meta)) + 1024:
+            self._compact()
+
+    # 引用计数
+
+    def _link(self, key, digest, size):
+        """
+        :return: key原来指向的摘要
+        """
+        old = self._digests.get(key)
+        self._digests[key] = digest
+        self._meta.pop(key, None)
+        self._refs[digest] = self._refs.get(digest, 0) + 1
+        self._sizes[digest] = size
+        self._logical_size += size
+        if old is not None:
+            self._release(old)
+        return old
+
+    def _unlink(self, key):
+        digest = self._digests.pop(key, None)
+        self._meta.pop(key, None)
+        if digest is not None:
+            self._release(digest)
+        return digest
+
+    def _release(self, digest):
+        """
+        :return: 引用数是否归零
+        """
+        self._logical_size -= self._sizes[digest]
+        self._refs[digest] -= 1
+        if self._refs[digest]:
+            return False
+        del self._refs[digest]
+        del self._sizes[digest]
+        return True
+
+    def _collect(self, digests):
+        """
+        从blobs中删除digests中已没有引用的值, 删除前先把日志写出
+        """
+        garbage = [digest for digest in set(digests)
+                   if digest is not None and digest not in self._refs]
+        if garbage:
+            if self._fp is not None:
+                self._fp.flush()
+            self._blobs.delete_many(garbage)
+
+    # 存储接口. blobs的写入和删除都在锁内进行, 避免刚释放的值被新的引用复用
+    # 时又被删除
+
+    def set(self, key, value):
+        digest = self._digest_func(value)
+        with self._lock:
+            if digest not in self._refs and not self._blobs.has(digest) \
+                    and not self._blobs.set(digest, value):
+                return False
+            old = self._link(key, digest, len(value))
+            self._append(self._pack(self._OP_SET, key, digest, len(value)))
+            self._collect([old])
+        return True
+
+    def set_many(self, items):
+        items = items.items() if isinstance(items, dict) else items
+        hashed = [(key, value, self._digest_func(value))
+                  for key, value in items]
+        with self._lock:
+            blobs = dict((digest, value) for _, value, digest in hashed
+                         if digest not in self._refs)
+            if self._blobs.set_many(blobs) < len(blobs):
+                # 部分写入失败, 只链接已保存的值
+                hashed = [(key, value, digest)
+                          for key, value, digest in hashed
+                          if digest not in blobs or self._blobs.has(digest)]
+            old = [self._link(key, digest, len(value))
+                   for key, value, digest in hashed]
+            self._append(b''.join(
+                self._pack(self._OP_SET, key, digest, len(value))
+                for key, value, digest in hashed), len(hashed))
+            self._collect(old)
+        return len(hashed)
+
+    def get(self, key, default=None):
+        digest = self._digests.get(key)
+        if digest is None:
+            return default
+        return self._blobs.get(digest, default)
+
+    def get_many(self, keys):
+        digests = dict((key, self._digests.get(key)) for key in keys)
+        found = self._blobs.get_many(set(d for d in digests.values()
+                                         if d is not None))
+        return dict((key, found[digest]) for key, digest in digests.items()
+                    if digest in found)
+
+    def has(self, key):
+        return key in self._digests
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        with self._lock:
+            removed = [key for key in keys if key in self._digests]
+            self._append(b''.join(self._pack(self._OP_DELETE, key)
+                                  for key in removed), len(removed))
+            self._collect([self._unlink(key) for key in removed])
+
+    def get_meta(self, key, default=None):
+        return self._meta.get(key, default)
+
+    def set_meta(self, key, meta):
+        with self._lock:
+            if key not in self._digests:
+                return False
+            self._meta[key] = meta
+            self._append(self._pack_meta(key, meta))
+            return True
+
+    def clear(self):
+        with self._lock:
+            digests = list(self._refs)
+            self._digests.clear()
+            self._refs.clear()
+            self._sizes.clear()
+            self._meta.clear()
+            self._logical_size = 0
+            if self._path is not None:
+                self._compact()
+            self._blobs.delete_many(digests)
+
+    def flush(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.flush()
+            flush = getattr(self._blobs, 'flush', None)
+            if flush is not None:
+                flush()
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None and not self._fp.closed:
+                self._fp.close()
+
+    @property
+    def count(self):
+        return len(self._digests)
+
+    @property
+    def size(self):
+        return self._blobs.size
+
+    @property
+    def unique_count(self):
+        return len(self._refs)
+
+    @property
+    def logical_size(self):
+        """
+        不去重时所有key的值的总大小
+        """
+        return self._logical_size
+
+    @property
+    def dedup_ratio(self):
+        """
+        logical_size / size, 没有数据时为1
+        """
+        size = self.size
+        return self._logical_size / float(size) if size else 1.0
+
+    def dedup_stats(self):
+        return {'count': self.count, 'unique_count': self.unique_count,
+                'size': self.size, 'logical_size': self.logical_size,
+                'saved': self.logical_size - self.size,
+                'ratio': round(self.dedup_ratio, 4)}
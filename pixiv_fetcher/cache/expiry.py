@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import threading
+import time
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+from pixiv_fetcher.utils.log import get_logger
+from pixiv_fetcher.utils.path import make_direct_open
+
+
+class TimingWheel(object):
+    """
+    单层时间轮: 每个槽对应tick秒, 超过一圈的条目留在槽中等下一圈;
+    添加/删除O(1), 推进时每个到期条目O(1)
+    """
+
+    def __init__(self, tick=1.0, size=3600, now=0.0):
+        self._tick = float(tick)
+        self._size = size
+        self._slots = [{} for _ in range(size)]
+        self._entries = {}
+        self._current = int(now // self._tick)
+
+    def add(self, key, expires):
+        self.remove(key)
+        tick_no = max(int(expires // self._tick), self._current)
+        slot = tick_no % self._size
+        self._slots[slot][key] = expires
+        self._entries[key] = (expires, slot)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, slot = entry
+        self._slots[slot].pop(key, None)
+        return expires
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        return None if entry is None else entry[0]
+
+    def advance(self, now):
+        """
+        :return: 到期的key列表
+        """
+        target = int(now // self._tick)
+        expired = []
+        if target < self._current:
+            return expired
+
+        steps = min(target - self._current + 1, self._size)
+        for tick_no in range(target - steps + 1, target + 1):
+            slot = self._slots[tick_no % self._size]
+            for key, expires in list(slot.items()):
+                if expires <= now:
+                    del slot[key]
+                    del self._entries[key]
+                    expired.append(key)
+        self._current = target
+        return expired
+
+    def items(self):
+        return [(k, e[0]) for k, e in self._entries.items()]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class _ExpiryJournal(object):
+    """
+    追加写的过期时间日志, 每条记录为 过期时间(double) + key长度 + key;
+    过期时间为0表示删除. 载入时重放, 日志过长时压缩
+    """
+
+    _header_fmt = '<dH'
+    _header_size = struct.calcsize(_header_fmt)
+
+    def __init__(self, path):
+        self._path = path
+        self._fp = None
+        self._records = 0
+
+    def load(self):
+        entries = {}
+        if os.path.isfile(self._path):
+            with open(self._path, 'rb') as fp:
+                while True:
+                    header = fp.read(self._header_size)
+                    if len(header) < self._header_size:
+                        break
+                    expires, key_len = struct.unpack(self._header_fmt, header)
+                    key = fp.read(key_len)
+                    if len(key) < key_len:
+                        # 写到一半的记录
+                        break
+                    if expires:
+                        entries[key] = expires
+                    else:
+                        entries.pop(key, None)
+        self.rewrite(entries.items())
+        return entries
+
+    def _pack(self, key, expires):
+        return struct.pack(self._header_fmt, expires or 0, len(key)) + key
+
+    def append(self, key, expires):
+        self._fp.write(self._pack(key, expires))
+        self._records += 1
+
+    def rewrite(self, items):
+        self.close()
+        tmp_path = self._path + '.tmp'
+        count = 0
+        with make_direct_open(tmp_path, 'wb') as fp:
+            for key, expires in items:
+                fp.write(self._pack(key, expires))
+                count += 1
+        os.rename(tmp_path, self._path)
+        self._fp = open(self._path, 'ab')
+        self._records = count
+
+    @property
+    def records(self):
+        return self._records
+
+    def flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+    def close(self):
+        if self._fp is not None and not self._fp.closed:
+            self._fp.close()
+
+
+class ExpiryIndex(object):
+    """
+    记录每个(已哈希的)key的过期时间; 指定path时过期时间写入日志文件, 重启后仍有效.
+    每次修改后flush日志, 日志过长时压缩, 不依赖ExpirySweeper
+    """
+
+    def __init__(self, path=None, tick=1.0, size=3600, clock=time.time):
+        self._clock = clock
+        self._wheel = TimingWheel(tick, size, clock())
+        self._lock = threading.RLock()
+
+        self._journal = None
+        if path is not None:
+            self._journal = _ExpiryJournal(path)
+            for key, expires in self._journal.load().items():
+                self._wheel.add(key, expires)
+
+    def set(self, key, expires):
+        with self._lock:
+            if expires is None:
+                self.discard(key)
+                return
+            self._wheel.add(key, expires)
+            self._append([(key, expires)])
+
+    def discard(self, key):
+        with self._lock:
+            if self._wheel.remove(key) is not None:
+                self._append([(key, None)])
+
+    def _append(self, records):
+        """
+        在锁内调用
+        """
+        if self._journal is None:
+            return
+        if self._journal.records > 2 * len(self._wheel) + 1024:
+            self._journal.rewrite(self._wheel.items())
+            return
+        for key, expires in records:
+            self._journal.append(key, expires)
+        self._journal.flush()
+
+    def get(self, key):
+        return self._wheel.get(key)
+
+    def is_expired(self, key, now=None):
+        expires = self._wheel.get(key)
+        if expires is None:
+            return False
+        return expires <= (self._clock() if now is None else now)
+
+    def advance(self, now=None):
+        """
+        :return: 到期的key列表, 这些key同时从索引中移除
+        """
+        with self._lock:
+            expired = self._wheel.advance(self._clock() if now is None
+                                          else now)
+            self._append([(key, None) for key in expired])
+            return expired
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.flush()
+                self._journal.close()
+
+    def __len__(self):
+        return len(self._wheel)
+
+
+class ExpirySweeper(object):
+    """
+    每interval秒清理一次各个缓存中已过期的条目; 清理在reactor线程中进行,
+    与请求处理不会同时修改缓存
+    """
+
+    def __init__(self, caches, interval=1.0, clock=reactor):
+        self._caches = list(caches)
+        self._interval = interval
+        self._loop = LoopingCall(self._sweep)
+        self._loop.clock = clock
+        self._log = get_logger(self)
+
+    def sweep(self):
+        total = 0
+        for cache in self._caches:
+            total += cache.expire()
+        if total:
+            self._log.debug(u'清理过期缓存: %d', total)
+        return total
+
+    def _sweep(self):
+        try:
+            self.sweep()
+        except Exception as e:
+            self._log.exception(e)
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    @property
+    def running(self):
+        return self._loop.running
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import time
+
+FRESH = 'fresh'
+STALE = 'stale'
+EXPIRED = 'expired'
+
+
+class FreshnessPolicy(object):
+    """
+    缓存条目的新鲜度: 写入后ttl秒内为FRESH, 之后stale_ttl秒内为STALE
+    (可直接返回, 同时在后台重新验证), 再之后为EXPIRED(需重新获取,
+    上游出错时仍可作为后备返回)
+    """
+
+    def __init__(self, ttl=None, stale_ttl=0):
+        """
+        :param ttl: None表示条目永远新鲜
+        :param stale_ttl: STALE窗口长度(秒), None表示无限长
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+    def make_meta(self, headers=None, now=None):
+        """
+        :param headers: 上游响应头
+        :type headers: twisted.web.http_headers.Headers
+        """
+        meta = {'stored': time.time() if now is None else now}
+        if headers is not None:
+            for name, field in (('Last-Modified', 'last_modified'),
+                                ('ETag', 'etag')):
+                values = headers.getRawHeaders(name)
+                if values:
+                    meta[field] = values[0]
+        return meta
+
+    @staticmethod
+    def refresh_meta(meta, now=None):
+        meta = dict(meta or {})
+        meta['stored'] = time.time() if now is None else now
+        return meta
+
+    def check(self, meta, now=None):
+        if self.ttl is None:
+            return FRESH
+        stored = meta.get('stored') if meta else None
+        if stored is None:
+            # 没有元数据的旧条目, 返回后重新验证一次
+            return STALE
+
+        age = (time.time() if now is None else now) - stored
+        if age < self.ttl:
+            return FRESH
+        if self.stale_ttl is None or age < self.ttl + self.stale_ttl:
+            return STALE
+        return EXPIRED
+
+    @staticmethod
+    def conditional_headers(meta):
+        """
+        :return: [(name, value)], 用于条件GET
+        """
+        headers = []
+        if meta:
+            if meta.get('etag'):
+                headers.append(('If-None-Match', meta['etag']))
+            if meta.get('last_modified'):
+                headers.append(('If-Modified-Since', meta['last_modified']))
+        return headers
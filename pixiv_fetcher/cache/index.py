@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import threading
+
+from pixiv_fetcher.utils.path import make_direct_open
+from pixiv_fetcher.utils.pixiv import parse_pximg_url
+
+
+class PidIndex(object):
+    """
+    作品ID(pid)到(已哈希的)缓存key的二级索引, 用于按作品批量清除缓存.
+    指定path时变更以追加日志的形式保存, 每次变更后写出, 重启后重放
+    """
+
+    _record_fmt = '<BQH'
+    _record_size = struct.calcsize(_record_fmt)
+
+    _OP_ADD = 1
+    _OP_REMOVE = 2
+
+    def __init__(self, path=None):
+        self._pids = {}
+        self._keys = {}
+        self._lock = threading.RLock()
+
+        self._path = path
+        self._fp = None
+        self._records = 0
+        if path is not None:
+            self._load()
+
+    @staticmethod
+    def pid_of(raw_key):
+        info = parse_pximg_url(raw_key)
+        return None if info is None else info.pid
+
+    def _load(self):
+        if os.path.isfile(self._path):
+            with open(self._path, 'rb') as fp:
+                while True:
+                    raw = fp.read(self._record_size)
+                    if len(raw) < self._record_size:
+                        break
+                    op, pid, key_len = struct.unpack(self._record_fmt, raw)
+                    key = fp.read(key_len)
+                    if len(key) < key_len:
+                        break
+                    if op == self._OP_ADD:
+                        self._add(pid, key)
+                    else:
+                        self._remove(key)
+        self._compact()
+
+    def _compact(self):
+        if self._fp is not None:
+            self._fp.close()
+        tmp_path = self._path + '.tmp'
+        with make_direct_open(tmp_path, 'wb') as fp:
+            for key, pid in self._keys.items():
+                fp.write(self._pack(self._OP_ADD, pid, key))
+        os.rename(tmp_path, self._path)
+        self._fp = open(self._path, 'ab')
+        self._records = len(self._keys)
+
+    def _pack(self, op, pid, key):
+        return struct.pack(self._record_fmt, op, pid, len(key)) + key
+
+    def _append(self, op, pid, key):
+        if self._fp is None:
+            return
+        self._fp.write(self._pack(op, pid, key))
+        self._records += 1
+        if self._records > 2 * len(self._keys) + 1024:
+            self._compact()
+
+    def _flush(self):
+        if self._fp is not None:
+            self._fp.flush()
+
+    def _add(self, pid, key):
+        old = self._keys.get(key)
+        if old == pid:
+            return False
+        if old is not None:
+            self._remove(key)
+        self._keys[key] = pid
+        self._pids.setdefault(pid, set()).add(key)
+        return True
+
+    def _remove(self, key):
+        pid = self._keys.pop(key, None)
+        if pid is None:
+            return None
+        keys = self._pids.get(pid)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._pids[pid]
+        return pid
+
+    def add(self, raw_key, key):
+        """
+        :param raw_key: 原始key(pximg路径), 解析不出pid时忽略
+        :param key: 缓存内部使用的(已哈希的)key
+        """
+        self.add_pid(self.pid_of(raw_key), key)
+
+    def add_pid(self, pid, key):
+        if pid is None:
+            return
+        with self._lock:
+            if self._add(pid, key):
+                self._append(self._OP_ADD, pid, key)
+                self._flush()
+
+    def pid_for(self, key):
+        return self._keys.get(key)
+
+    def discard(self, key):
+        with self._lock:
+            pid = self._remove(key)
+            if pid is not None:
+                self._append(self._OP_REMOVE, pid, key)
+                self._flush()
+
+    def keys_of(self, pid):
+        with self._lock:
+            return list(self._pids.get(pid, ()))
+
+    def pop(self, pid):
+        """
+        移除并返回pid下的所有key
+        """
+        with self._lock:
+            keys = self._pids.pop(pid, set())
+            for key in keys:
+                self._keys.pop(key, None)
+                self._append(self._OP_REMOVE, pid, key)
+            self._flush()
+            return list(keys)
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None and not self._fp.closed:
+                self._fp.close()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, pid):
+        return pid in self._pids
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+
+from twisted.internet import defer, reactor, task, threads
+
+from pixiv_fetcher.utils.log import get_logger
+from pixiv_fetcher.utils.path import make_direct_open
+
+_MAGIC = b'PFSS'
+_VERSION = 1
+_header_fmt = '<4sBL'
+_header_size = struct.calcsize(_header_fmt)
+_key_fmt = '<H'
+_key_size = struct.calcsize(_key_fmt)
+
+
+def save_snapshot(cache, path, limit=None):
+    """
+    把缓存中最热的limit个(已哈希的)key按热度顺序写入快照文件, 只保存key,
+    数据在恢复时从下一层缓存读取
+
+    :type cache: pixiv_fetcher.cache.Cache
+    :return: 写入的key数
+    """
+    keys = cache.hot_keys(limit)
+    tmp_path = path + '.tmp'
+    with make_direct_open(tmp_path, 'wb') as fp:
+        fp.write(struct.pack(_header_fmt, _MAGIC, _VERSION, len(keys)))
+        for key in keys:
+            fp.write(struct.pack(_key_fmt, len(key)) + key)
+    os.rename(tmp_path, path)
+    return len(keys)
+
+
+def load_snapshot(path):
+    """
+    :return: 按热度从高到低排列的key, 文件不存在或格式不对时为空列表
+    """
+    if not os.path.isfile(path):
+        return []
+    keys = []
+    with open(path, 'rb') as fp:
+        header = fp.read(_header_size)
+        if len(header) < _header_size:
+            return []
+        magic, version, count = struct.unpack(_header_fmt, header)
+        if magic != _MAGIC or version != _VERSION:
+            return []
+        for _ in range(count):
+            raw = fp.read(_key_size)
+            if len(raw) < _key_size:
+                break
+            key_len, = struct.unpack(_key_fmt, raw)
+            key = fp.read(key_len)
+            if len(key) < key_len:
+                break
+            keys.append(key)
+    return keys
+
+
+class SnapshotRestorer(object):
+    """
+    按快照顺序把条目从source(磁盘层)读回target(内存层), 与正常请求并行:
+    读取在线程池中进行, 写入target在reactor线程中进行; 目标层已满(恢复的
+    条目被立即淘汰)时停止
+    """
+
+    def __init__(self, target, source, keys, pause=0.0, clock=reactor):
+        """
+        :type target: pixiv_fetcher.cache.Cache
+        :type source: pixiv_fetcher.cache.Cache
+        :param keys: load_snapshot的结果
+        :param pause: 每恢复一个条目后的等待时间(秒), 用于限制磁盘读取速度
+        """
+        self._target = target
+        self._source = source
+        self._keys = keys
+        self._pause = pause
+        self._clock = clock
+        self._stopped = False
+        self._log = get_logger(self)
+
+        self.restored = 0
+        self.skipped = 0
+        self.done = None
+
+    def _import(self, key, entry):
+        """
+        :return: 是否继续恢复
+        """
+        if entry is None:
+            self.skipped += 1
+            return True
+        if not self._target.import_entry(key, *entry):
+            self._log.debug(u'目标缓存已满, 停止恢复')
+            return False
+        self.restored += 1
+        return True
+
+    def _finish(self):
+        self._log.info(u'从快照恢复%d个条目, 跳过%d个', self.restored,
+                       self.skipped)
+        return self.restored
+
+    def restore(self):
+        """
+        在当前线程中同步恢复, 不能与reactor线程中的访问并行
+
+        :return: 恢复的条目数
+        """
+        for key in self._keys:
+            if self._stopped or \
+                    not self._import(key, self._source.export_entry(key)):
+                break
+        return self._finish()
+
+    @defer.inlineCallbacks
+    def _run(self):
+        for key in self._keys:
+            if self._stopped:
+                break
+            try:
+                entry = yield threads.deferToThread(
+                    self._source.export_entry, key)
+            except Exception as e:
+                self._log.exception(e)
+                break
+            if self._stopped or not self._import(key, entry):
+                break
+            if self._pause:
+                yield task.deferLater(self._clock, self._pause, lambda: None)
+        defer.returnValue(self._finish())
+
+    def start(self):
+        """
+        :return: 恢复结束时以恢复的条目数回调的Deferred
+        """
+        if self.done is None:
+            self.done = self._run()
+        return self.done
+
+    def stop(self):
+        self._stopped = True
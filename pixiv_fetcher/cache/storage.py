@@ -1,11 +1,50 @@
 # -*- coding: utf-8 -*-
+import binascii
+import json
 import os
+import re
+import sqlite3
 import struct
 import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
 from weakref import WeakValueDictionary
 
+from pixiv_fetcher.utils.log import get_logger
 from pixiv_fetcher.utils.path import make_direct_open
 
+SYNC_NONE = 'none'
+SYNC_PERIODIC = 'periodic'
+SYNC_ALWAYS = 'always'
+
+
+def _file_size(path):
+    """
+    :return: 文件大小, 不存在时为-1
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+
+def _fsync(path):
+    """
+    fsync文件或目录(使其中的重命名持久化), 不存在或不支持时忽略
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
 
 class BaseStorage(object):
 
@@ -24,6 +63,35 @@ class BaseStorage(object):
     def clear(self):
         raise NotImplemented()
 
+    def get_meta(self, key, default=None):
+        return default
+
+    def set_meta(self, key, meta):
+        return False
+
+    def get_many(self, keys):
+        """
+        :return: {key: value}, 不包含不存在的key
+        """
+        results = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def set_many(self, items):
+        """
+        :param items: [(key, value)]或dict
+        :return: 与逐个调用set时返回True的次数相同
+        """
+        items = items.items() if isinstance(items, dict) else items
+        return sum(1 for key, value in items if self.set(key, value))
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.delete(key)
+
     @property
     def count(self):
         raise NotImplemented()
@@ -41,6 +109,7 @@ class SimpleStorage(BaseStorage):
             self.key = key
             self.value = value
             self.size = size
+            self.meta = None
             self.lock = threading.RLock()
 
         def __enter__(self):
@@ -73,6 +142,7 @@ class SimpleStorage(BaseStorage):
                 self._total_size = self._total_size - entry.size + value_size
                 entry.value = value
                 entry.size = value_size
+                entry.meta = None
 
         return False
 
@@ -83,6 +153,19 @@ class SimpleStorage(BaseStorage):
     def has(self, key):
         return key in self._data
 
+    def get_meta(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry.meta is None:
+            return default
+        return entry.meta
+
+    def set_meta(self, key, meta):
+        entry = self._data.get(key)
+        if entry is None:
+            return False
+        entry.meta = meta
+        return True
+
     def delete(self, key, verbose=True):
         if verbose:
             entry = self._data.pop(key, None)
@@ -109,41 +192,110 @@ class SimpleStorage(BaseStorage):
         return self._total_size
 
 
+_p_unsafe_file_name = re.compile(r'[\x00/]')
+
+
+def safe_path(key):
+    """
+    DiskStorage默认的path_func: 能直接作为文件名的key原样使用, 其余(例如
+    Cache哈希后含有NUL或'/'的md5摘要)转为十六进制
+    """
+    if key in ('', '.', '..') or _p_unsafe_file_name.search(key) or \
+            key in GroupCommitDiskStorage._RESERVED_FILES or \
+            key.endswith((DiskStorage.META_SUFFIX, '.tmp')):
+        return binascii.hexlify(key)
+    return key
+
+
 class DiskStorage(BaseStorage):
 
     INFO_FILE = 'data.bin'
+    META_SUFFIX = '.meta'
+    _RESERVED_FILES = (INFO_FILE,)
 
     class _Info(object):
+        """
+        count/size头部. 两个槽位交替写入, 每个槽位带序号和CRC32: 写到一半
+        崩溃时另一个槽位仍然完整, 加载时取序号最大的有效槽位.
+        旧版本的头部(<Q size, <Q count)在加载时转换
+        """
 
-        _int_fmt = '<Q'
-        _int_length = 8
+        MAGIC = b'PFI2'
+        _slot_fmt = '<QQQ'  # seq, size, count
+        _slot_length = struct.calcsize(_slot_fmt) + 4
+        _legacy_fmt = '<QQ'
 
         def __init__(self, p):
             self._info_file = make_direct_open(p, 'r+b', buffering=0)
             self._total_size = 0
             self._total_count = 0
+            self.seq = 0
             self._lock = threading.RLock()
 
+        @classmethod
+        def _unpack_slot(cls, raw):
+            body, crc = raw[:-4], raw[-4:]
+            if len(raw) != cls._slot_length or \
+                    struct.pack('<I', zlib.crc32(body) & 0xffffffff) != crc:
+                return None
+            return struct.unpack(cls._slot_fmt, body)
+
         @classmethod
         def load_file(cls, file_path):
             obj = cls(file_path)
             with obj._lock:
                 obj._info_file.seek(0)
-                raw = obj._info_file.read(cls._int_length * 2)
-                try:
-                    raw_size = raw[:cls._int_length]
-                    raw_count = raw[cls._int_length:]
-                    obj._total_size = struct.unpack(cls._int_fmt, raw_size)[0]
-                    obj._total_count = struct.unpack(cls._int_fmt, raw_count)[0]
-                except struct.error:
-                    raise StandardError(repr(raw))
+                raw = obj._info_file.read(len(cls.MAGIC) +
+                                          cls._slot_length * 2)
+                if raw.startswith(cls.MAGIC):
+                    raw = raw[len(cls.MAGIC):]
+                    slots = [cls._unpack_slot(raw[i:i + cls._slot_length])
+                             for i in (0, cls._slot_length)]
+                    slots = [slot for slot in slots if slot is not None]
+                    if not slots:
+                        raise StandardError(repr(raw))
+                    obj.seq, obj._total_size, obj._total_count = max(slots)
+                else:
+                    try:
+                        size, count = struct.unpack(
+                            cls._legacy_fmt,
+                            raw[:struct.calcsize(cls._legacy_fmt)])
+                    except struct.error:
+                        raise StandardError(repr(raw))
+                    obj.store(size, count)
             return obj
 
-        def _write_num(self, i, n):
+        def store(self, size, count, sync=False):
+            """
+            写入序号较旧的槽位, 写完后它成为当前槽位
+
+            :param sync: 写入后fsync
+            """
+            with self._lock:
+                seq = self.seq + 1
+                body = struct.pack(self._slot_fmt, seq, size, count)
+                slot = body + struct.pack('<I', zlib.crc32(body) & 0xffffffff)
+                if not self.seq:
+                    self._info_file.seek(0)
+                    self._info_file.write(self.MAGIC)
+                self._info_file.seek(len(self.MAGIC) +
+                                     seq % 2 * self._slot_length)
+                self._info_file.write(slot)
+                if sync:
+                    os.fsync(self._info_file.fileno())
+                self.seq = seq
+                self._total_size = size
+                self._total_count = count
+
+        def update(self, count_delta, size_delta, sync=False):
+            """
+            一次写入同时更新count和size
+            """
+            if not count_delta and not size_delta:
+                return
             with self._lock:
-                self._info_file.seek(i * self._int_length)
-                bin_str = struct.pack(self._int_fmt, n)
-                self._info_file.write(bin_str)
+                self.store(self._total_size + size_delta,
+                           self._total_count + count_delta, sync)
 
         def reset(self):
             with self._lock:
@@ -157,8 +309,7 @@ class DiskStorage(BaseStorage):
 
         @size.setter
         def size(self, v):
-            self._write_num(0, v)
-            self._total_size = v
+            self.store(v, self._total_count)
 
         @property
         def count(self):
@@ -166,12 +317,14 @@ class DiskStorage(BaseStorage):
 
         @count.setter
         def count(self, v):
-            self._write_num(1, v)
-            self._total_count = v
+            self.store(self._total_size, v)
 
     def __init__(self, path, path_func=None):
+        """
+        :param path_func: key到文件名的转换, 默认为safe_path
+        """
         self._storage_path = os.path.join(path, "cache")
-        self._path_func = path_func or (lambda _: _)
+        self._path_func = path_func or safe_path
 
         self._file_locks = WeakValueDictionary()
         self._load_info_file()
@@ -182,10 +335,34 @@ class DiskStorage(BaseStorage):
             try:
                 self._info = self._Info.load_file(info_path)
             except StandardError:
+                # 两个槽位都损坏, 重新统计
                 self._info = self._Info(info_path)
+                self.recount()
         else:
             self._info = self._Info(info_path)
 
+    def _scan(self):
+        """
+        :return: 目录中数据文件的(count, size)
+        """
+        count = size = 0
+        for dir_path, _, file_names in os.walk(self._storage_path):
+            for file_name in file_names:
+                if file_name.endswith((self.META_SUFFIX, '.tmp')) or \
+                        dir_path == self._storage_path and \
+                        file_name in self._RESERVED_FILES:
+                    continue
+                count += 1
+                size += _file_size(os.path.join(dir_path, file_name))
+        return count, size
+
+    def recount(self):
+        """
+        扫描目录重新统计count/size并写入头部
+        """
+        count, size = self._scan()
+        self._info.store(size, count, sync=True)
+
     def _get_file_lock(self, path):
         return self._file_locks.setdefault(path, threading.RLock())
 
@@ -195,7 +372,11 @@ class DiskStorage(BaseStorage):
     def has(self, key):
         return os.path.isfile(self.full_path(key))
 
-    def set(self, key, value):
+    def _write(self, key, value, fsync=False):
+        """
+        :param fsync: 重命名前fsync临时文件
+        :return: (count变化, size变化), 写入失败时为None
+        """
         full_path = self.full_path(key)
         tmp_path = full_path+".tmp"
 
@@ -203,14 +384,69 @@ class DiskStorage(BaseStorage):
             try:
                 with make_direct_open(tmp_path, 'wb') as fp:
                     fp.write(value)
+                    if fsync:
+                        fp.flush()
+                        os.fsync(fp.fileno())
             except IOError:
-                return False
+                return None
             else:
-                self.delete(key)  # 防止文件存在导致移动失败
+                # 防止文件存在导致移动失败
+                count_delta, size_delta = self._remove(key)
                 os.rename(tmp_path, full_path)
-                self._info.count += 1
-                self._info.size += len(value)
-                return True
+                return count_delta + 1, size_delta + len(value)
+
+    def _remove(self, key):
+        full_path = self.full_path(key)
+        if os.path.isfile(full_path):
+            with self._get_file_lock(full_path):
+                if os.path.isfile(full_path):
+                    size = os.path.getsize(full_path)
+                    os.remove(full_path)
+                    if os.path.isfile(full_path + self.META_SUFFIX):
+                        os.remove(full_path + self.META_SUFFIX)
+                    return -1, -size
+        return 0, 0
+
+    def set(self, key, value):
+        delta = self._write(key, value)
+        if delta is None:
+            return False
+        self._info.update(*delta)
+        return True
+
+    def set_many(self, items):
+        items = items.items() if isinstance(items, dict) else items
+        count_delta = size_delta = written = 0
+        for key, value in items:
+            delta = self._write(key, value)
+            if delta is not None:
+                count_delta += delta[0]
+                size_delta += delta[1]
+                written += 1
+        self._info.update(count_delta, size_delta)
+        return written
+
+    def get_meta(self, key, default=None):
+        meta_path = self.full_path(key) + self.META_SUFFIX
+        try:
+            with open(meta_path, 'rb') as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return default
+
+    def set_meta(self, key, meta):
+        full_path = self.full_path(key)
+        meta_path = full_path + self.META_SUFFIX
+        with self._get_file_lock(full_path):
+            if not os.path.isfile(full_path):
+                return False
+            try:
+                with make_direct_open(meta_path + '.tmp', 'wb') as fp:
+                    json.dump(meta, fp)
+            except IOError:
+                return False
+            os.rename(meta_path + '.tmp', meta_path)
+            return True
 
     def get(self, key, default=None):
         full_path = self.full_path(key)
@@ -221,18 +457,35 @@ class DiskStorage(BaseStorage):
                         return fp.read()
         return default
 
+    def get_many(self, keys):
+        """
+        按文件路径排序后依次读取, 同一目录中的文件相邻; 直接打开文件,
+        不存在时跳过, 不再逐个检查文件是否存在
+        """
+        results = {}
+        for full_path, key in sorted((self.full_path(k), k) for k in keys):
+            with self._get_file_lock(full_path):
+                try:
+                    with open(full_path, 'rb') as fp:
+                        results[key] = fp.read()
+                except IOError:
+                    pass
+        return results
+
     def clear(self):
         os.rmdir(self._storage_path)
         self._info.reset()
 
     def delete(self, key):
-        full_path = self.full_path(key)
-        if os.path.isfile(full_path):
-            with self._get_file_lock(full_path):
-                if os.path.isfile(full_path):
-                    self._info.size -= os.path.getsize(full_path)
-                    self._info.count -= 1
-                    os.remove(full_path)
+        self._info.update(*self._remove(key))
+
+    def delete_many(self, keys):
+        count_delta = size_delta = 0
+        for key in keys:
+            delta = self._remove(key)
+            count_delta += delta[0]
+            size_delta += delta[1]
+        self._info.update(count_delta, size_delta)
 
     @property
     def size(self):
@@ -241,3 +494,676 @@ class DiskStorage(BaseStorage):
     @property
     def count(self):
         return self._info.count
+
+
+class _PendingOp(object):
+
+    __slots__ = ('value', 'meta', 'delta', 'written', 'failed')
+
+    def __init__(self, value, delta):
+        self.value = value  # None表示删除
+        self.meta = None
+        self.delta = delta  # 入队时计入count/size的(count变化, size变化)
+        self.written = False
+        self.failed = False
+
+
+class GroupCommitDiskStorage(DiskStorage):
+    """
+    由后台写线程分组提交的DiskStorage, 待写的值可以立即读到; 写线程是守护
+    线程, 退出前应调用close()
+
+    durability:
+      - SYNC_NONE: 不fsync, 进程崩溃时丢失尚未写出的操作
+      - SYNC_PERIODIC: 每sync_interval秒fsync并提交头部
+      - SYNC_ALWAYS: 提交并fsync头部后set/delete才返回, 写入失败时set返回False
+    """
+
+    JOURNAL_FILE = 'journal.bin'
+    _RESERVED_FILES = (DiskStorage.INFO_FILE, JOURNAL_FILE)
+
+    _record_fmt = '<QII'  # 基于的头部序号, 内容长度, CRC32
+    _entry_fmt = '<qH'  # 原大小(不存在为-1), 路径长度
+
+    def __init__(self, path, path_func=None, durability=SYNC_PERIODIC,
+                 sync_interval=1.0, max_batch=256):
+        """
+        :param sync_interval: SYNC_PERIODIC下两次fsync的最大间隔(秒)
+        :param max_batch: 每批最多写出的操作数, SYNC_ALWAYS下不限制
+        """
+        if durability not in (SYNC_NONE, SYNC_PERIODIC, SYNC_ALWAYS):
+            raise ValueError('Unknown durability: %r' % durability)
+        DiskStorage.__init__(self, path, path_func)
+        self._durability = durability
+        self._sync_interval = sync_interval
+        self._max_batch = max_batch
+        self._log = get_logger(self)
+
+        journal_path = os.path.join(self._storage_path, self.JOURNAL_FILE)
+        self._journal = make_direct_open(journal_path, 'a+b', buffering=0)
+        self._recover()
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._pending = OrderedDict()
+        self._inflight = {}
+        self._count = self._info.count
+        self._size = self._info.size
+
+        self._seq = 0
+        self._applied_seq = 0
+        self._checkpoint_seq = 0
+        self._delta = (0, 0)
+        self._dirty = set()
+        self._unsynced = False
+        self._sync_requested = False
+        self._closing = False
+        self._last_sync = time.time()
+
+        self.coalesced = 0
+        self.batches = 0
+        self.checkpoints = 0
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='DiskWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    # 日志
+
+    def _journal_append(self, entries):
+        """
+        :param entries: [(相对路径, 原大小)]
+        """
+        payload = []
+        for rel_path, size in entries:
+            if not isinstance(rel_path, bytes):
+                rel_path = rel_path.encode('utf-8')
+            payload.append(struct.pack(self._entry_fmt, size, len(rel_path)))
+            payload.append(rel_path)
+        payload = b''.join(payload)
+        self._journal.write(struct.pack(
+            self._record_fmt, self._info.seq, len(payload),
+            zlib.crc32(payload) & 0xffffffff) + payload)
+        if self._durability != SYNC_NONE:
+            os.fsync(self._journal.fileno())
+
+    def _journal_read(self):
+        """
+        :return: [(头部序号, [(相对路径, 原大小)])], 末尾写了一半的记录被忽略
+        """
+        self._journal.seek(0)
+        data = self._journal.read()
+        records = []
+        head_length = struct.calcsize(self._record_fmt)
+        entry_length = struct.calcsize(self._entry_fmt)
+        offset = 0
+        while offset + head_length <= len(data):
+            seq, length, crc = struct.unpack_from(self._record_fmt, data,
+                                                  offset)
+            offset += head_length
+            payload = data[offset:offset + length]
+            offset += length
+            if len(payload) != length or \
+                    zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            entries = []
+            pos = 0
+            while pos < length:
+                size, path_length = struct.unpack_from(self._entry_fmt,
+                                                       payload, pos)
+                pos += entry_length
+                rel_path = payload[pos:pos + path_length]
+                pos += path_length
+                if not isinstance(rel_path, str):
+                    rel_path = rel_path.decode('utf-8')
+                entries.append((rel_path, size))
+            records.append((seq, entries))
+        return records
+
+    def _recover(self):
+        """
+        头部提交前崩溃时, 按日志中文件的原大小和现在的大小修正count/size
+        """
+        original = {}
+        for seq, entries in self._journal_read():
+            if seq != self._info.seq:
+                continue  # 已提交
+            for rel_path, size in entries:
+                original.setdefault(rel_path, size)
+
+        if original:
+            count_delta = size_delta = 0
+            for rel_path, size in original.items():
+                current = _file_size(os.path.join(self._storage_path,
+                                                  rel_path))
+                count_delta += (current >= 0) - (size >= 0)
+                size_delta += max(current, 0) - max(size, 0)
+            self._info.store(self._info.size + size_delta,
+                             self._info.count + count_delta, sync=True)
+            self._log.warn(u'按日志恢复了%d个文件的统计', len(original))
+        self._journal.truncate(0)
+
+    # 调用方
+
+    def _current_size(self, key):
+        op = self._pending.get(key) or self._inflight.get(key)
+        if op is not None:
+            return -1 if op.value is None else len(op.value)
+        return _file_size(self.full_path(key))
+
+    def _enqueue(self, key, value):
+        """
+        在锁内调用
+
+        :rtype: _PendingOp, 删除不存在的key时为None
+        """
+        old_size = self._current_size(key)
+        if value is None and old_size < 0:
+            return None
+        new_size = -1 if value is None else len(value)
+        count_delta = (new_size >= 0) - (old_size >= 0)
+        size_delta = max(new_size, 0) - max(old_size, 0)
+        self._count += count_delta
+        self._size += size_delta
+
+        old = self._pending.pop(key, None)
+        if old is not None:
+            self.coalesced += 1
+            count_delta += old.delta[0]
+            size_delta += old.delta[1]
+        op = self._pending[key] = _PendingOp(value,
+                                             (count_delta, size_delta))
+        self._seq += 1
+        return op
+
+    def _submit(self, ops):
+        """
+        :param ops: [(key, value)], value为None表示删除
+        :return: 进入待写表的操作数, SYNC_ALWAYS下不包括写入失败的
+        """
+        with self._lock:
+            if self._closing:
+                raise ValueError('Storage is closed')
+            submitted = [op for op in (self._enqueue(key, value)
+                                       for key, value in ops)
+                         if op is not None]
+            if submitted:
+                seq = self._seq
+                self._wakeup.notify()
+                if self._durability == SYNC_ALWAYS:
+                    while self._checkpoint_seq < seq:
+                        self._committed.wait()
+            return sum(not op.failed for op in submitted)
+
+    def set(self, key, value):
+        return self._submit([(key, value)]) == 1
+
+    def set_many(self, items):
+        items = items.items() if isinstance(items, dict) else items
+        return self._submit(items)
+
+    def delete(self, key):
+        self._submit([(key, None)])
+
+    def delete_many(self, keys):
+        self._submit([(key, None) for key in keys])
+
+    def _find(self, key):
+        with self._lock:
+            return self._pending.get(key) or self._inflight.get(key)
+
+    def get(self, key, default=None):
+        op = self._find(key)
+        if op is not None:
+            return default if op.value is None else op.value
+        return DiskStorage.get(self, key, default)
+
+    def get_many(self, keys):
+        results = {}
+        missing = []
+        for key in keys:
+            op = self._find(key)
+            if op is None:
+                missing.append(key)
+            elif op.value is not None:
+                results[key] = op.value
+        results.update(DiskStorage.get_many(self, missing))
+        return results
+
+    def has(self, key):
+        op = self._find(key)
+        if op is not None:
+            return op.value is not None
+        return DiskStorage.has(self, key)
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            op = self._pending.get(key) or self._inflight.get(key)
+            if op is not None and not op.written:
+                if op.value is None or op.meta is None:
+                    return default
+                return op.meta
+            return DiskStorage.get_meta(self, key, default)
+
+    def set_meta(self, key, meta):
+        with self._lock:
+            op = self._pending.get(key) or self._inflight.get(key)
+            if op is not None and not op.written:
+                if op.value is None:
+                    return False
+                op.meta = meta
+                return True
+            return DiskStorage.set_meta(self, key, meta)
+
+    def flush(self):
+        """
+        等待此前的所有操作写出并提交头部(SYNC_PERIODIC下立即fsync)
+        """
+        with self._lock:
+            target = self._seq
+            while self._checkpoint_seq < target or self._unsynced:
+                if not self._thread.is_alive():
+                    break
+                self._sync_requested = True
+                self._wakeup.notify()
+                self._committed.wait(1)
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._journal.close()
+
+    def clear(self):
+        self.flush()
+        DiskStorage.clear(self)
+        with self._lock:
+            self._count = self._size = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def count(self):
+        return self._count
+
+    # 写线程
+
+    def _checkpoint_due(self):
+        if not self._unsynced:
+            return False
+        return self._durability != SYNC_PERIODIC or self._sync_requested \
+            or self._closing \
+            or time.time() - self._last_sync >= self._sync_interval
+
+    def _take(self):
+        limit = None if self._durability == SYNC_ALWAYS else self._max_batch
+        batch = []
+        while self._pending and (limit is None or len(batch) < limit):
+            key, op = self._pending.popitem(last=False)
+            self._inflight[key] = op
+            batch.append((key, op))
+        if batch and not self._pending:
+            self._applied_seq = self._seq
+        return batch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._checkpoint_due():
+                    if self._closing:
+                        return
+                    timeout = None
+                    if self._unsynced:
+                        timeout = max(self._last_sync + self._sync_interval -
+                                      time.time(), 0.001)
+                    self._wakeup.wait(timeout)
+                batch = self._take()
+                applied_seq = self._applied_seq
+            # 写出失败也要提交检查点, 否则SYNC_ALWAYS的调用方一直等待
+            try:
+                if batch:
+                    self._apply(batch)
+            except Exception as e:
+                self._log.exception(e)
+            try:
+                with self._lock:
+                    due = self._checkpoint_due()
+                if due:
+                    self._checkpoint(applied_seq)
+            except Exception as e:
+                self._log.exception(e)
+
+    def _settle(self, key, op, path, original, delta):
+        """
+        在锁内调用: 标记操作已写出并用实际变化修正count/size
+
+        :param original: 写出前的文件大小
+        :param delta: 写出的(count变化, size变化), 失败时为None
+        :return: 实际的(count变化, size变化)
+        """
+        op.written = True
+        if delta is None:
+            # 失败时文件可能已被删除, 按现在的大小计算
+            op.failed = True
+            current = _file_size(path)
+            delta = ((current >= 0) - (original >= 0),
+                     max(current, 0) - max(original, 0))
+        elif op.meta is not None:
+            DiskStorage.set_meta(self, key, op.meta)
+        self._count += delta[0] - op.delta[0]
+        self._size += delta[1] - op.delta[1]
+        return delta
+
+    def _apply(self, batch):
+        entries = [(key, op, self.full_path(key)) for key, op in batch]
+        originals = [_file_size(path) for _, _, path in entries]
+
+        always = self._durability == SYNC_ALWAYS
+        count_delta = size_delta = 0
+        files, dirs = set(), set()
+        try:
+            try:
+                self._journal_append([
+                    (self._path_func(key), size)
+                    for (key, _, _), size in zip(entries, originals)])
+                journaled = True
+            except EnvironmentError as e:
+                # 没有日志的写入在头部提交前崩溃后无法修正count/size
+                self._log.exception(e)
+                journaled = False
+
+            for (key, op, path), original in zip(entries, originals):
+                delta = None
+                if journaled:
+                    try:
+                        if op.value is None:
+                            delta = self._remove(key)
+                        else:
+                            delta = self._write(key, op.value, fsync=always)
+                    except EnvironmentError as e:
+                        self._log.exception(e)
+                    if delta is not None and op.value is not None:
+                        files.add(path)
+                    dirs.add(os.path.dirname(path))
+                with self._lock:
+                    delta = self._settle(key, op, path, original, delta)
+                count_delta += delta[0]
+                size_delta += delta[1]
+            if always:
+                for dir_path in dirs:
+                    _fsync(dir_path)
+        finally:
+            with self._lock:
+                for (key, op, path), original in zip(entries, originals):
+                    if not op.written:
+                        delta = self._settle(key, op, path, original, None)
+                        count_delta += delta[0]
+                        size_delta += delta[1]
+                    if self._inflight.get(key) is op:
+                        del self._inflight[key]
+                self._delta = (self._delta[0] + count_delta,
+                               self._delta[1] + size_delta)
+                if self._durability == SYNC_PERIODIC:
+                    self._dirty |= files | dirs
+                self._unsynced = True
+                self.batches += 1
+
+    def _checkpoint(self, applied_seq):
+        with self._lock:
+            count_delta, size_delta = self._delta
+            dirty = self._dirty
+            self._delta = (0, 0)
+            self._dirty = set()
+            self._unsynced = False
+
+        try:
+            # 先让文件和重命名落盘, 再提交头部
+            for path in dirty:
+                _fsync(path)
+            try:
+                self._info.store(self._info.size + size_delta,
+                                 self._info.count + count_delta,
+                                 sync=self._durability != SYNC_NONE)
+            except Exception:
+                # 头部没有提交: 变化并入下一次检查点, 日志保留以便崩溃后恢复
+                with self._lock:
+                    self._delta = (self._delta[0] + count_delta,
+                                   self._delta[1] + size_delta)
+                    self._dirty |= dirty
+                raise
+            self._journal.truncate(0)
+        finally:
+            with self._lock:
+                self._checkpoint_seq = max(self._checkpoint_seq, applied_seq)
+                self._last_sync = time.time()
+                self._sync_requested = False
+                self.checkpoints += 1
+                self._committed.notify_all()
+
+
+class SqliteStorage(BaseStorage):
+    """
+    以SQLite(WAL模式)保存数据和元数据. count/size由触发器在同一事务中维护,
+    不会与实际数据不一致; set_many/delete_many及transaction()中的操作是原子的.
+
+    Python 3.11+的sqlite3支持增量BLOB读写, 大于blob_threshold的值分块读写,
+    避免在SQLite内部再复制一份; 其他版本整体绑定
+    """
+
+    DB_FILE = 'cache.db'
+
+    _SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS entries (
+        key BLOB PRIMARY KEY,
+        value BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        meta TEXT
+    );
+    CREATE TABLE IF NOT EXISTS info (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        count INTEGER NOT NULL,
+        size INTEGER NOT NULL
+    );
+    INSERT OR IGNORE INTO info VALUES (0, 0, 0);
+    CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+    BEGIN
+        UPDATE info SET count = count + 1, size = size + NEW.size;
+    END;
+    CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+    BEGIN
+        UPDATE info SET count = count - 1, size = size - OLD.size;
+    END;
+    CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+    BEGIN
+        UPDATE info SET size = size - OLD.size + NEW.size;
+    END;
+    '''
+
+    # SQL文本固定, 由sqlite3模块的语句缓存复用预编译语句
+    _SQL_UPDATE = 'UPDATE entries SET value = ?, size = ?, meta = NULL ' \
+                  'WHERE key = ?'
+    _SQL_INSERT = 'INSERT INTO entries (key, value, size) VALUES (?, ?, ?)'
+    _SQL_UPDATE_ZERO = 'UPDATE entries SET value = zeroblob(?), size = ?, ' \
+                       'meta = NULL WHERE key = ?'
+    _SQL_INSERT_ZERO = 'INSERT INTO entries (key, value, size) ' \
+                       'VALUES (?, zeroblob(?), ?)'
+    _SQL_ROWID = 'SELECT rowid, size FROM entries WHERE key = ?'
+    _SQL_GET = 'SELECT value FROM entries WHERE key = ?'
+    _SQL_HAS = 'SELECT 1 FROM entries WHERE key = ?'
+    _SQL_DELETE = 'DELETE FROM entries WHERE key = ?'
+    _SQL_GET_META = 'SELECT meta FROM entries WHERE key = ?'
+    _SQL_SET_META = 'UPDATE entries SET meta = ? WHERE key = ?'
+    _SQL_INFO = 'SELECT count, size FROM info'
+
+    _MAX_VARIABLES = 500
+
+    def __init__(self, path, blob_threshold=1 << 20, chunk_size=1 << 16,
+                 synchronous='NORMAL', cached_statements=64):
+        """
+        :param path: 数据库所在目录
+        :param synchronous: PRAGMA synchronous, WAL模式下NORMAL只在检查点时
+                            fsync, 断电可能丢失最近的事务但不会损坏数据库
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._db_path = os.path.join(path, self.DB_FILE)
+        self._blob_threshold = blob_threshold
+        self._chunk_size = chunk_size
+        self._blob_io = hasattr(sqlite3.Connection, 'blobopen')
+
+        self._conn = sqlite3.connect(self._db_path, isolation_level=None,
+                                     check_same_thread=False,
+                                     cached_statements=cached_statements)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=%s' % synchronous)
+        self._conn.executescript(self._SCHEMA)
+
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def transaction(self):
+        """
+        嵌套使用时只有最外层提交
+        """
+        with self._lock:
+            if not self._depth:
+                self._conn.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield self._conn
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self._conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if not self._depth:
+                self._conn.execute('COMMIT')
+
+    def _write_blob(self, key, value):
+        rowid = self._conn.execute(self._SQL_ROWID, (key,)).fetchone()[0]
+        with self._conn.blobopen('entries', 'value', rowid) as blob:
+            for i in range(0, len(value), self._chunk_size):
+                blob.write(value[i:i + self._chunk_size])
+
+    def _set(self, key, value):
+        key = sqlite3.Binary(key)
+        size = len(value)
+        if self._blob_io and size >= self._blob_threshold:
+            cursor = self._conn.execute(self._SQL_UPDATE_ZERO,
+                                        (size, size, key))
+            if not cursor.rowcount:
+                self._conn.execute(self._SQL_INSERT_ZERO, (key, size, size))
+            self._write_blob(key, value)
+        else:
+            value = sqlite3.Binary(value)
+            cursor = self._conn.execute(self._SQL_UPDATE, (value, size, key))
+            if not cursor.rowcount:
+                self._conn.execute(self._SQL_INSERT, (key, value, size))
+
+    def set(self, key, value):
+        with self.transaction():
+            self._set(key, value)
+        return True
+
+    def set_many(self, items):
+        items = items.items() if isinstance(items, dict) else items
+        written = 0
+        with self.transaction():
+            for key, value in items:
+                self._set(key, value)
+                written += 1
+        return written
+
+    def _read_blob(self, rowid, size):
+        chunks = []
+        with self._conn.blobopen('entries', 'value', rowid,
+                                 readonly=True) as blob:
+            for _ in range(0, size, self._chunk_size):
+                chunks.append(blob.read(self._chunk_size))
+        return b''.join(chunks)
+
+    def get(self, key, default=None):
+        key = sqlite3.Binary(key)
+        with self._lock:
+            if self._blob_io:
+                row = self._conn.execute(self._SQL_ROWID, (key,)).fetchone()
+                if row is None:
+                    return default
+                if row[1] >= self._blob_threshold:
+                    return self._read_blob(*row)
+
+            row = self._conn.execute(self._SQL_GET, (key,)).fetchone()
+        return default if row is None else bytes(row[0])
+
+    def get_many(self, keys):
+        keys = list(keys)
+        results = {}
+        with self._lock:
+            for i in range(0, len(keys), self._MAX_VARIABLES):
+                chunk = keys[i:i + self._MAX_VARIABLES]
+                sql = 'SELECT key, value FROM entries WHERE key IN (%s)' \
+                      % ','.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    sql, [sqlite3.Binary(k) for k in chunk])
+                for key, value in rows:
+                    results[bytes(key)] = bytes(value)
+        return results
+
+    def has(self, key):
+        with self._lock:
+            cursor = self._conn.execute(self._SQL_HAS, (sqlite3.Binary(key),))
+            return cursor.fetchone() is not None
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(self._SQL_GET_META,
+                                     (sqlite3.Binary(key),)).fetchone()
+        if row is None or row[0] is None:
+            return default
+        try:
+            return json.loads(row[0])
+        except ValueError:
+            return default
+
+    def set_meta(self, key, meta):
+        with self.transaction():
+            cursor = self._conn.execute(self._SQL_SET_META,
+                                        (json.dumps(meta),
+                                         sqlite3.Binary(key)))
+            return cursor.rowcount > 0
+
+    def delete(self, key):
+        with self.transaction():
+            self._conn.execute(self._SQL_DELETE, (sqlite3.Binary(key),))
+
+    def delete_many(self, keys):
+        with self.transaction():
+            self._conn.executemany(self._SQL_DELETE,
+                                   [(sqlite3.Binary(k),) for k in keys])
+
+    def clear(self):
+        with self.transaction():
+            self._conn.execute('DELETE FROM entries')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _info(self):
+        with self._lock:
+            return self._conn.execute(self._SQL_INFO).fetchone()
+
+    @property
+    def size(self):
+        return self._info()[1]
+
+    @property
+    def count(self):
+        return self._info()[0]
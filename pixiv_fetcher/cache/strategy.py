@@ -15,6 +15,10 @@ class BaseStrategy(object):
     def reset(self, key):
         raise NotImplemented()
 
+    def reset_many(self, keys):
+        for key in keys:
+            self.reset(key)
+
     def handle_set(self, key, value):
         raise NotImplemented()
 
@@ -24,6 +28,18 @@ class BaseStrategy(object):
     def handle_missing(self, key):
         pass
 
+    def handle_restore(self, key, value):
+        """
+        从快照恢复的条目, 默认与set相同
+        """
+        self.handle_set(key, value)
+
+    def hot_keys(self, limit=None):
+        """
+        :return: 按热度从高到低排列的key, 用于生成快照
+        """
+        return []
+
     def remove_keys(self, storage):
         raise NotImplemented()
 
@@ -37,6 +53,7 @@ class DoNothingStrategy(BaseStrategy):
         pass
 
     record_get = handle_set
+    handle_hit = handle_set
     reset = handle_set
     remove_keys = handle_set
     is_excess = handle_set
@@ -67,6 +84,14 @@ class FifoMemoryStrategy(BaseStrategy):
         while self.is_excess(storage) and self._keys:
             storage.delete(self._keys.pop(0))
 
+    def handle_restore(self, key, value):
+        # 按热度从高到低恢复, 越晚恢复的越先淘汰
+        if key not in self._keys:
+            self._keys.insert(0, key)
+
+    def hot_keys(self, limit=None):
+        return self._keys[::-1][:limit]
+
 
 class LruMemoryStrategy(BaseStrategy):
     """
@@ -80,7 +105,9 @@ class LruMemoryStrategy(BaseStrategy):
         self._log = get_logger(self)
 
     def reset(self, key):
-        raise NotImplemented()
+        with self._lock:
+            while key in self._keys:
+                self._keys.remove(key)
 
     def handle_set(self, key, value):
         with self._lock:
@@ -92,6 +119,16 @@ class LruMemoryStrategy(BaseStrategy):
     def handle_hit(self, key, value):
         self.handle_set(key, value)
 
+    def handle_restore(self, key, value):
+        # 恢复的条目排在启动后访问过的条目之后
+        with self._lock:
+            if key not in self._keys:
+                self._keys.append(key)
+
+    def hot_keys(self, limit=None):
+        with self._lock:
+            return self._keys[:limit]
+
     def remove_keys(self, storage):
         while self.is_excess(storage) and self._keys:
             with self._lock:
@@ -242,9 +279,37 @@ class DiskRecord(object):
     def pop(self, key):
         with self._lock:
             idx, value = self.search(key)
+            if idx == -1:
+                return None
             self.pop_idx(idx)
             return value
 
+    def pop_many(self, keys):
+        """
+        一次遍历删除多个key对应的行. 行按顺序连续存放(淘汰顺序依赖行的位置),
+        又没有key到行的索引, 查找和移动后面的行都是O(总行数); 这里只读一遍,
+        只重写第一个删除的行之后的部分, 而不是每个key各做一次pop
+
+        :return: 删除的行数
+        """
+        packed = set(self._pack_key(key) for key in keys)
+        with self._lock:
+            num = self.length()
+            self._fp.seek(5)
+            data = self._fp.read(self._row_length * num)
+            rows = [data[i:i+self._row_length]
+                    for i in xrange(0, len(data), self._row_length)]
+            first = next((i for i, row in enumerate(rows)
+                          if row[:self._key_len] in packed), None)
+            if first is None:
+                return 0
+            kept = [row for row in rows[first:]
+                    if row[:self._key_len] not in packed]
+            self._fp.seek(5 + self._row_length * first)
+            self._fp.write(b''.join(kept))
+            self._write_length(first + len(kept))
+            return num - first - len(kept)
+
     def pop_idx(self, idx=-1):
         with self._lock:
             num = self.length()
@@ -320,3 +385,13 @@ class LfuDiskStrategy(BaseStrategy):
 
     def reset(self, key):
         self._record.pop(key)
+
+    def hot_keys(self, limit=None):
+        with self._lock:
+            num = self._record.length()
+            num = num if limit is None else min(num, limit)
+            return [self._record.get_idx(i)[0] for i in xrange(num)]
+
+    def reset_many(self, keys):
+        with self._lock:
+            self._record.pop_many(keys)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import bisect
+import hashlib
+import struct
+
+from twisted.internet import reactor
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from pixiv_fetcher.exceptions import PeerError
+from pixiv_fetcher.utils.log import get_logger
+
+PEER_HEADER = 'X-Pixiv-Fetcher-Peer'
+
+
+class HashRing(object):
+    """
+    一致性哈希环, 每个节点在环上有replicas个虚拟节点; 增删节点时只有相邻
+    区间的key改变归属
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self._replicas = replicas
+        self._points = []
+        self._owners = {}
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return struct.unpack('<Q', hashlib.md5(value).digest()[:8])[0]
+
+    def add(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self._replicas):
+            point = self._hash(('%s#%d' % (node, i)).encode('utf-8'))
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node):
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        points = [p for p, n in self._owners.items() if n == node]
+        for point in points:
+            del self._owners[point]
+        self._points = sorted(self._owners)
+
+    def get(self, key, exclude=()):
+        """
+        :param exclude: 跳过的节点, 顺时针取下一个节点
+        :return: key所属的节点, 没有可用节点时为None
+        """
+        if not self._points:
+            return None
+        start = bisect.bisect(self._points, self._hash(key))
+        total = len(self._points)
+        seen = set()
+        for i in range(total):
+            node = self._owners[self._points[(start + i) % total]]
+            if node in seen:
+                continue
+            if node not in exclude:
+                return node
+            seen.add(node)
+            if len(seen) == len(self._nodes):
+                break
+        return None
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+
+class PeerCluster(object):
+    """
+    多个代理节点组成的缓存集群: 每个key由哈希环上的一个节点负责, 本地缓存
+    未命中时先向负责的节点请求(带有PEER_HEADER, 对方不会再转发), 该节点
+    未命中时由它访问上游, 使同一图片只从上游下载一次.
+    请求节点失败后down_time秒内视为下线, key顺延给环上的下一个节点
+    """
+
+    def __init__(self, self_url, peers=(), replicas=100, timeout=5,
+                 down_time=30, pool_maxsize=4, agent=None, clock=reactor):
+        """
+        :param self_url: 本节点的地址, 例如 http://10.0.0.1:8080
+        :param peers: 所有节点的地址(可包括本节点)
+        """
+        self.self_url = self_url.rstrip('/')
+        self.timeout = timeout
+        self.down_time = down_time
+        self._replicas = replicas
+        self._clock = clock
+        self._down = {}
+        self._ring = HashRing(replicas=replicas)
+        self.set_peers(peers)
+
+        if agent is None:
+            pool = HTTPConnectionPool(clock)
+            pool.maxPersistentPerHost = pool_maxsize
+            agent = Agent(clock, pool=pool)
+        self._agent = agent
+        self._log = get_logger(self)
+
+        self.forwarded = 0
+        self.failures = 0
+
+    def set_peers(self, peers):
+        """
+        更新集群成员
+        """
+        peers = set(p.rstrip('/') for p in peers)
+        peers.add(self.self_url)
+        for node in self._ring.nodes:
+            if node not in peers:
+                self._ring.remove(node)
+                self._down.pop(node, None)
+        for node in peers:
+            self._ring.add(node)
+
+    @property
+    def peers(self):
+        return self._ring.nodes
+
+    def _down_nodes(self):
+        now = self._clock.seconds()
+        for node, until in list(self._down.items()):
+            if until <= now:
+                del self._down[node]
+        return self._down
+
+    def owner(self, key):
+        return self._ring.get(key, exclude=self._down_nodes())
+
+    def is_local(self, key):
+        owner = self.owner(key)
+        return owner is None or owner == self.self_url
+
+    @staticmethod
+    def is_peer_request(request):
+        return request.requestHeaders.hasHeader(PEER_HEADER)
+
+    def mark_down(self, node):
+        self._down[node] = self._clock.seconds() + self.down_time
+
+    def fetch(self, key, referer=None):
+        """
+        向负责key的节点请求, 响应带有body属性; 对方出错时该节点标记为下线,
+        Deferred以失败结束
+
+        :param key: 图片路径, 例如/img-original/img/...
+        :param referer: 转发客户端的Referer, 以便对方的filter_fun照常检查
+        """
+        node = self.owner(key)
+        headers = Headers({PEER_HEADER: [self.self_url]})
+        if referer:
+            headers.setRawHeaders('Referer', [referer])
+        self.forwarded += 1
+
+        dfd = self._agent.request('GET', node + key, headers)
+        timer = self._clock.callLater(self.timeout, dfd.cancel)
+
+        def _read(response):
+            body = readBody(response)
+
+            def _attach(data):
+                response.body = data
+                return response
+            return body.addCallback(_attach)
+
+        def _check(response):
+            if response.code >= 500:
+                raise PeerError(node, response.code)
+            return response
+
+        def _failed(reason):
+            self.failures += 1
+            self.mark_down(node)
+            self._log.warn(u'节点%s请求失败: %s', node,
+                           reason.getErrorMessage())
+            return reason
+
+        def _finally(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        dfd.addCallback(_read)
+        dfd.addCallback(_check)
+        dfd.addErrback(_failed)
+        dfd.addBoth(_finally)
+        return dfd
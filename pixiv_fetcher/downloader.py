@@ -1,52 +1,482 @@
-from twisted.internet import reactor
-from twisted.web.client import Agent, HTTPConnectionPool, readBody
+# -*- coding: utf-8 -*-
+import re
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import LoopingCall
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone, \
+    ResponseNeverReceived, readBody
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 
+from pixiv_fetcher.breaker import CircuitBreaker, STATE_OPEN
+from pixiv_fetcher.exceptions import ResponseChanged, CircuitOpenError
+from pixiv_fetcher.staging import StagingArea
+from pixiv_fetcher.scheduler import FetchScheduler, AIMDLimit, \
+    PRIORITY_INTERACTIVE, PRIORITY_WARMUP
+from pixiv_fetcher.tls import UpstreamTLSPolicy
+from pixiv_fetcher.tracing import NULL_TRACE
+from pixiv_fetcher.upstream import Endpoint, EndpointGroup, LatencyWindow
+from pixiv_fetcher.utils.log import get_logger
+
+_p_content_range = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+class _BodyCollector(Protocol):
+    """
+    收集响应体; 连接中途断开时保留已收到的部分, 并可把数据实时转发给sink
+    """
+
+    def __init__(self, sink=None, skip=0):
+        self.chunks = []
+        self.length = 0
+        self.deferred = defer.Deferred(self._cancel)
+        self._sink = sink
+        self._skip = skip
+
+    def _cancel(self, _):
+        abort = getattr(self.transport, 'abortConnection', None)
+        if abort is not None:
+            abort()
+
+    def connectionMade(self):
+        if self._sink is not None:
+            self._sink.attach(self.transport)
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        if self._sink is not None:
+            if self._skip:
+                # 重新从头下载时, 跳过已经发给sink的部分
+                skipped, data = data[:self._skip], data[self._skip:]
+                self._skip -= len(skipped)
+            if data:
+                self._sink.write(data)
+
+    def connectionLost(self, reason):
+        if self.deferred.called:
+            # 已被取消
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.deferred.callback(self.data)
+        else:
+            self.deferred.errback(reason)
+
+    @property
+    def data(self):
+        return b''.join(self.chunks)
+
+
+def _is_cancelled(reason):
+    if reason.check(defer.CancelledError):
+        return True
+    # 已经发出的请求被取消时, 失败包装为ResponseNeverReceived
+    return bool(reason.check(ResponseNeverReceived)) and all(
+        r.check(defer.CancelledError) for r in reason.value.reasons)
+
 
 class IllustrationDownloader(object):
 
-    def __init__(self, host, port=None, pool_maxsize=2, scheme='http://'):
+    def __init__(self, host, port=None, pool_maxsize=2, scheme='http://',
+                 scheduler=None, max_concurrency=None, endpoints=None,
+                 hedge_percentile=95, hedge_min_delay=0.05,
+                 hedge_min_samples=20, max_hedges=1, breaker=None,
+                 tls_policy=None, warm_connections=0, keepalive=240,
+                 warm_path='/', staging=None, max_resumes=3,
+                 max_queue=256):
+        """
+        :param endpoints: 同一站点的多个上游地址, 如 ['1.2.3.4', '5.6.7.8:8080'],
+            Host头始终为host
+        :param hedge_percentile: 首字节等待超过该百分位延迟时发出对冲请求
+        :param max_hedges: 每次请求最多的对冲请求数, 0表示关闭
+        :param breaker: 上游熔断器, 默认按错误率熔断
+        :type breaker: pixiv_fetcher.breaker.CircuitBreaker
+        :param tls_policy: 默认复用SSL上下文并恢复TLS会话, 以host校验证书;
+            不校验时传入UpstreamTLSPolicy(host, verify=False)
+        :param warm_connections: 每个上游地址保持的预热持久连接数,
+            调用start()后开始定期预热
+        :param keepalive: 空闲持久连接的保持时间(秒)
+        :param staging: 中断下载的暂存区, 用于Range续传
+        :type staging: pixiv_fetcher.staging.StagingArea
+        :param max_resumes: 同一次下载最多续传次数
+        :param max_queue: 默认调度器的排队请求数上限, 超出时请求以
+            SchedulerQueueFull失败(返回503), None表示不限
+        """
         self.scheme = scheme
         self.host = host
         self.port = port
+
+        endpoints = endpoints or [(host, port)]
+        self._endpoints = EndpointGroup(
+            [Endpoint.parse(e, port) for e in endpoints])
+        self._ttfb = LatencyWindow()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedges = max_hedges
+        self.hedged_count = 0
+
         self._pool = HTTPConnectionPool(reactor)
-        self._pool.maxPersistentPerHost = pool_maxsize
-        self.agent = Agent(reactor, pool=self._pool)
+        self._pool.maxPersistentPerHost = max(pool_maxsize, warm_connections)
+        self._pool.cachedConnectionTimeout = keepalive
+        self._tls_policy = tls_policy \
+            or UpstreamTLSPolicy(server_hostname=host)
+        self.agent = Agent(reactor, contextFactory=self._tls_policy,
+                           pool=self._pool)
 
-    def fetch(self, uri, headers=None):
+        if scheduler is None:
+            max_concurrency = max_concurrency or pool_maxsize * 4
+            limit = AIMDLimit(initial=pool_maxsize, max_limit=max_concurrency)
+            scheduler = FetchScheduler(limit, max_queue=max_queue,
+                                       error_func=self._is_error)
+        self._scheduler = scheduler
+        self._breaker = breaker or CircuitBreaker(error_func=self._is_error)
+        self._log = get_logger(self)
+
+        self._staging = staging if staging is not None else StagingArea()
+        self.max_resumes = max_resumes
+
+        self.warm_connections = warm_connections
+        self.warm_path = warm_path
+        self.keepalive = keepalive
+        self._warm_loop = None
+
+    @staticmethod
+    def _is_error(response):
+        return response.code >= 500 or response.code == 429
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def breaker(self):
+        return self._breaker
+
+    @property
+    def endpoints(self):
+        return self._endpoints
+
+    @property
+    def staging(self):
+        return self._staging
+
+    def fetch(self, uri, headers=None, priority=PRIORITY_INTERACTIVE,
+              client=None, sink=None, trace=None):
+        """
+        :param sink: 可选, 响应头到达时调用sink.start(response), 之后每段响应体
+            调用sink.write(data); 每个上游连接开始传输响应体时调用
+            sink.attach(producer), sink可借此暂停读取上游; 续传对sink透明
+        :param trace: 可选, 记录queue(排队), ttfb(连接及首字节), body阶段耗时
+        :type trace: pixiv_fetcher.tracing.Trace
+        """
+        trace = trace or NULL_TRACE
+        if self._breaker.state == STATE_OPEN:
+            return defer.fail(CircuitOpenError(self._breaker.retry_after))
+
+        # 熔断器只统计上游请求本身: 排队满不计为上游错误, 耗时不含排队时间
+        return self._scheduler.schedule(
+            lambda: self._breaker.call(self._fetch, uri, headers, sink, trace,
+                                       priority),
+            priority=priority, client=client)
+
+    def _fetch(self, uri, headers=None, sink=None, trace=NULL_TRACE,
+               priority=PRIORITY_INTERACTIVE):
+        trace.mark('queue')
         headers = Headers() if headers is None else headers.copy()
         headers.setRawHeaders(b'referer', ['https://www.pixiv.net/'])
         headers.setRawHeaders(b'host', [self.host])
 
-        if (self.port == 80 and self.scheme == 'http://') \
-                or (self.port == 443 and self.scheme == 'https://') \
-                or self.port is None:
-            url = self.scheme + self.host
+        if headers.hasHeader(b'range'):
+            # 客户端自己的Range请求原样转发, 不从暂存区续传
+            received, validator = b'', None
         else:
-            url = self.scheme + self.host + ':' + str(self.port)
+            received, validator = self._staging.load(uri)
+        dfd = self._download(uri, headers, received, validator, 0, sink, [0],
+                             trace, priority)
+        dfd.addErrback(self.on_failure)
+        return dfd
 
-        url = url + uri
+    @staticmethod
+    def _validator(response):
+        etag = response.headers.getRawHeaders(b'etag', [None])[0]
+        if etag and not etag.startswith('W/'):
+            return etag
+        return response.headers.getRawHeaders(b'last-modified', [None])[0]
 
-        dfd = self.agent.request('GET', url, headers)
-        dfd.addErrback(self.on_failure)
+    @staticmethod
+    def _resumed_offset(response):
+        content_range = response.headers.getRawHeaders(b'content-range', [''])
+        match = _p_content_range.match(content_range[0])
+        if response.code != 206 or match is None:
+            return None, None
+        total = match.group(3)
+        return int(match.group(1)), None if total == '*' else int(total)
+
+    def _download(self, uri, headers, received, validator, resumes, sink,
+                  streamed, trace=NULL_TRACE, priority=PRIORITY_INTERACTIVE):
+        """
+        received非空时以Range: bytes=N-和If-Range续传; 上游返回206则拼接,
+        返回200则从头下载. 中途断开时把已收到的数据存入暂存区并继续续传
+
+        :param streamed: [已发给sink的字节数]
+        """
+        request_headers = headers
+        if received and validator:
+            request_headers = headers.copy()
+            request_headers.setRawHeaders(b'range',
+                                          ['bytes=%d-' % len(received)])
+            request_headers.setRawHeaders(b'if-range', [validator])
+
+        def _on_response(response):
+            trace.mark('ttfb')
+            prefix = b''
+            if received and validator and response.code == 206:
+                offset, total = self._resumed_offset(response)
+                if offset != len(received):
+                    self._log.warn(u'续传范围不匹配 %s, 重新下载', uri)
+                    self._staging.discard(uri)
+                    readBody(response).addErrback(lambda _: None)
+                    return self._download(uri, headers, b'', validator,
+                                          resumes + 1, sink, streamed, trace,
+                                          priority)
 
-        def _wait_body(response):
-            body_dfd = readBody(response)
-            body_dfd.addCallback(lambda b: setattr(response, 'body', b))
-            body_dfd.addCallback(lambda _: response)
-            return body_dfd
+                prefix = received
+                response.code, response.phrase = 200, 'OK'
+                response.headers.removeHeader(b'content-range')
+                if total is not None:
+                    response.headers.setRawHeaders(b'content-length',
+                                                   [str(total)])
+                self._log.info(u'续传 %s, 从%d字节开始', uri, offset)
+            elif streamed[0] and response.code == 200 \
+                    and self._validator(response) != validator:
+                # 已经向sink发送了部分旧内容, 而上游内容已变化, 无法拼接;
+                # 读完响应体使连接回到连接池后再失败
+                return readBody(response).addBoth(
+                    lambda _: defer.fail(ResponseChanged(uri)))
 
-        dfd.addCallback(_wait_body)
+            ok = response.code == 200
+            if sink is not None and ok:
+                if not streamed[0]:
+                    sink.start(response)
+                if len(prefix) > streamed[0]:
+                    sink.write(prefix[streamed[0]:])
+                    streamed[0] = len(prefix)
 
+            skip = max(streamed[0] - len(prefix), 0)
+            collector = _BodyCollector(sink if ok else None, skip)
+            response.deliverBody(collector)
+
+            def _done(body):
+                trace.mark('body')
+                response.body = prefix + body
+                if ok:
+                    streamed[0] = max(streamed[0], len(response.body))
+                    self._staging.discard(uri)
+                return response
+
+            def _interrupted(reason):
+                data = prefix + collector.data
+                current = self._validator(response)
+                if not ok or not data or not current:
+                    return reason
+
+                if sink is not None:
+                    streamed[0] = max(streamed[0], len(data))
+                self._staging.save(uri, data, current)
+                if resumes >= self.max_resumes:
+                    self._log.warn(u'下载中断 %s, 已暂存%d字节', uri, len(data))
+                    return reason
+
+                self._log.warn(u'下载中断 %s (%d字节), 续传: %s', uri,
+                               len(data), reason.getErrorMessage())
+                trace.mark('body')
+                return self._download(uri, headers, data, current,
+                                      resumes + 1, sink, streamed, trace,
+                                      priority)
+
+            collector.deferred.addCallbacks(_done, _interrupted)
+            return collector.deferred
+
+        dfd = self._request(uri, request_headers, priority)
+        dfd.addCallback(_on_response)
         return dfd
 
-    def fetch_by_request(self, request):
+    def _hedge_delay(self):
+        if self.max_hedges <= 0 or len(self._ttfb) < self.hedge_min_samples:
+            return None
+        delay = self._ttfb.percentile(self.hedge_percentile)
+        if delay is None:
+            return self.hedge_min_delay
+        return max(delay, self.hedge_min_delay)
+
+    def _request(self, uri, headers, priority=PRIORITY_INTERACTIVE):
+        """
+        向健康得分最好的上游地址发出请求; 首字节(响应头)迟迟未到时向另一地址
+        发出对冲请求, 取先到者; 连接失败或5xx时转向尚未尝试的地址.
+        对冲请求同样经过调度器, 占用并发数; 排队期间已有结果则不再发出
+        """
+        attempts = {}
+        tried = []
+        timers = []
+        hedges = []
+
+        def _stop(winner=None):
+            for t in timers:
+                if t.active():
+                    t.cancel()
+            for h in hedges:
+                if not h.called:
+                    h.cancel()
+            for d in list(attempts):
+                if d is not winner:
+                    d.cancel()
+
+        def _cancel(_):
+            _stop()
+
+        result = defer.Deferred(_cancel)
+
+        def _launch(allow_retry=False):
+            endpoint = self._endpoints.choose(exclude=tried)
+            if endpoint is None and allow_retry:
+                endpoint = self._endpoints.choose()
+            if endpoint is None:
+                return None
+
+            tried.append(endpoint)
+            endpoint.inflight += 1
+            start = reactor.seconds()
+            url = endpoint.base_url(self.scheme) + uri
+            d = self.agent.request('GET', url, headers)
+            attempts[d] = endpoint
+            d.addCallbacks(_on_response, _on_error,
+                           callbackArgs=(d, endpoint, start),
+                           errbackArgs=(d, endpoint))
+            return d
+
+        def _on_response(response, d, endpoint, start):
+            attempts.pop(d, None)
+            endpoint.inflight -= 1
+
+            if result.called:
+                # 对冲请求中落败的一方, 读完响应体以便连接回到连接池
+                readBody(response).addErrback(lambda _: None)
+                return
+
+            if response.code >= 500 and (attempts or
+                                         _launch() is not None):
+                endpoint.record_failure()
+                self._log.warn(u'上游%s返回%d, 转向其他地址',
+                               endpoint.host, response.code)
+                readBody(response).addErrback(lambda _: None)
+                return
+
+            latency = reactor.seconds() - start
+            endpoint.record_success(latency)
+            self._ttfb.add(latency)
+            result.callback(response)
+            _stop(d)
+
+        def _on_error(reason, d, endpoint):
+            attempts.pop(d, None)
+            endpoint.inflight -= 1
+            if result.called or _is_cancelled(reason):
+                return
+
+            endpoint.record_failure()
+            self._log.warn(u'上游%s请求失败: %s', endpoint.host,
+                           reason.getErrorMessage())
+            if attempts or _launch() is not None:
+                return
+            result.errback(reason)
+
+        def _hedge(remaining):
+            if result.called or not attempts:
+                return
+            task = self._scheduler.schedule(lambda: _launch_hedge(remaining),
+                                            priority=priority)
+            task.addErrback(lambda _: None)
+            hedges.append(task)
+
+        def _launch_hedge(remaining):
+            if result.called or not attempts:
+                return None
+            d = _launch(allow_retry=True)
+            if d is not None:
+                self.hedged_count += 1
+                if remaining > 1:
+                    timers.append(reactor.callLater(delay, _hedge,
+                                                    remaining - 1))
+            return d
+
+        _launch()
+        delay = self._hedge_delay()
+        if delay is not None:
+            timers.append(reactor.callLater(delay, _hedge, self.max_hedges))
+
+        return result
+
+    def warm_up(self):
+        """
+        向每个上游地址并发发出warm_connections个HEAD请求, 使连接池中保持
+        相应数量已完成TCP/TLS握手的持久连接.
+        每个上游地址只占用调度器的一个并发数, 同一地址的HEAD请求同时发出,
+        否则逐个完成的请求会复用同一个连接
+        """
+        headers = Headers()
+        headers.setRawHeaders(b'host', [self.host])
+
+        def _report(results):
+            for ok, result in results:
+                if not ok:
+                    self._log.debug(u'预热连接失败: %s',
+                                    result.getErrorMessage())
+
+        def _warm(endpoint):
+            url = endpoint.base_url(self.scheme) + self.warm_path
+            dfds = [self.agent.request('HEAD', url, headers).addCallback(
+                readBody) for _ in range(self.warm_connections)]
+            return defer.DeferredList(dfds, consumeErrors=True) \
+                .addCallback(_report)
+
+        dfds = []
+        for endpoint in self._endpoints:
+            dfd = self._scheduler.schedule(lambda e=endpoint: _warm(e),
+                                           priority=PRIORITY_WARMUP)
+            dfd.addErrback(lambda f: self._log.debug(
+                u'预热连接失败: %s', f.getErrorMessage()))
+            dfds.append(dfd)
+        return defer.DeferredList(dfds)
+
+    def start(self):
+        """
+        warm_connections > 0时开始定期预热, 在空闲连接被连接池关闭之前重新预热
+        """
+        if self.warm_connections > 0:
+            self.start_warming(self.keepalive * 0.8)
+
+    def stop(self):
+        self.stop_warming()
+
+    def start_warming(self, interval):
+        if self._warm_loop is None or not self._warm_loop.running:
+            self._warm_loop = LoopingCall(self.warm_up)
+            self._warm_loop.start(interval, now=True)
+
+    def stop_warming(self):
+        if self._warm_loop is not None and self._warm_loop.running:
+            self._warm_loop.stop()
+
+    def fetch_by_request(self, request, sink=None, trace=None):
         uri = request.uri
         headers = request.requestHeaders
         if not uri.startswith('/'):
             uri = '/' + uri
 
-        return self.fetch(uri, headers)
+        return self.fetch(uri, headers, client=request.getClientIP(),
+                          sink=sink, trace=trace)
 
     def on_failure(self, reason):
         return reason
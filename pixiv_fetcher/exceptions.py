@@ -1,18 +1,25 @@
+# -*- coding: utf-8 -*-
 
 
 class HttpResponseException(Exception):
 
     _default_template = '''<h1>%(content)s</h1>'''
 
-    def __init__(self, code, phrase, content=None):
+    def __init__(self, code, phrase, content=None, headers=None):
+        """
+        :param headers: {name: [value]}, 随响应发送的额外响应头
+        """
         self.code = code
         self.phrase = phrase
+        self.headers = headers or {}
         self._content = content
         self.message = content
         self._template = lambda d: self._default_template % d
 
     def send_response(self, request):
         request.setResponseCode(self.code, self.phrase)
+        for name, values in self.headers.items():
+            request.responseHeaders.setRawHeaders(name, values)
         res = {'content': self._content, 'code': self.code, 'phrase': self.phrase}
         request.write(self.template(res))
         request.finish()
@@ -27,3 +34,81 @@ class HttpResponseException(Exception):
 
     def __str__(self):
         return '<%s[%s]@0x%x>' % (self.phrase, self.code, id(self))
+
+
+class SchedulerQueueFull(Exception):
+
+    def __init__(self, depth):
+        super(SchedulerQueueFull, self).__init__(depth)
+        self.depth = depth
+
+    def __str__(self):
+        return 'Fetch queue is full (%d queued)' % self.depth
+
+
+class CircuitOpenError(Exception):
+
+    def __init__(self, retry_after):
+        super(CircuitOpenError, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return 'Upstream circuit is open (retry after %.1fs)' % self.retry_after
+
+
+class ResponseChanged(Exception):
+
+    def __init__(self, uri):
+        super(ResponseChanged, self).__init__(uri)
+        self.uri = uri
+
+    def __str__(self):
+        return 'Upstream content changed while resuming %s' % self.uri
+
+
+class PeerError(Exception):
+
+    def __init__(self, node, code):
+        super(PeerError, self).__init__(node, code)
+        self.node = node
+        self.code = code
+
+    def __str__(self):
+        return 'Peer %s responded %d' % (self.node, self.code)
+
+
+class ResizeError(Exception):
+
+    def __init__(self, detail):
+        super(ResizeError, self).__init__(detail)
+        self.detail = detail
+
+    def __str__(self):
+        return 'Failed to resize image:\n%s' % self.detail
+
+
+class UnexpectedStatus(Exception):
+
+    def __init__(self, uri, code):
+        super(UnexpectedStatus, self).__init__(uri, code)
+        self.uri = uri
+        self.code = code
+
+    @property
+    def permanent(self):
+        return 400 <= self.code < 500 and self.code != 429
+
+    def __str__(self):
+        return '%s responded %d' % (self.uri, self.code)
+
+
+class PidResolveError(UnexpectedStatus):
+
+    def __init__(self, pid, code, message=None):
+        super(PidResolveError, self).__init__(pid, code)
+        self.pid = pid
+        self.message = message
+
+    def __str__(self):
+        return 'Failed to resolve pid %s (%d): %s' % (self.pid, self.code,
+                                                       self.message)
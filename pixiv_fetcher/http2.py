@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import re
+
+from twisted.internet import reactor, ssl
+from twisted.web import http, server
+
+from pixiv_fetcher.utils.log import get_logger
+
+# 需要安装可选依赖h2和priority (pip install twisted[http2])
+H2_ENABLED = http.H2_ENABLED
+if H2_ENABLED:
+    from twisted.web._http2 import H2Connection
+
+PREFACE = b'PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n'
+
+_p_pem_cert = re.compile(b'-----BEGIN CERTIFICATE-----.+?'
+                         b'-----END CERTIFICATE-----', re.S)
+
+
+class _ChannelProtocol(http._GenericHTTPChannelProtocol):
+    """
+    TLS连接按ALPN协商结果选择协议; 明文连接以HTTP/2连接前言开头时
+    (h2c prior knowledge)切换为HTTP/2, 否则按HTTP/1.1处理
+    """
+
+    _buffer = b''
+
+    def makeConnection(self, transport):
+        http._GenericHTTPChannelProtocol.makeConnection(self, transport)
+        # HTTP/2的帧(WINDOW_UPDATE, 各流交错的DATA)很小, Nagle算法与对方的
+        # 延迟确认叠加时每轮往返会多等几十毫秒
+        set_no_delay = getattr(transport, 'setTcpNoDelay', None)
+        if set_no_delay is not None:
+            set_no_delay(True)
+
+    def dataReceived(self, data):
+        channel = self._channel
+        if self._negotiatedProtocol is None and getattr(
+                channel.transport, 'negotiatedProtocol', None) is None:
+            data, self._buffer = self._buffer + data, b''
+            head = data[:len(PREFACE)]
+            if PREFACE.startswith(head):
+                if len(head) < len(PREFACE):
+                    self._buffer = data
+                    return
+                self._switch_to_h2()
+
+        result = http._GenericHTTPChannelProtocol.dataReceived(self, data)
+        if self._channel is not channel:
+            # 切换后原HTTP/1.1通道的空闲超时仍在计时, 需要取消
+            channel.setTimeout(None)
+        return result
+
+    def _switch_to_h2(self):
+        old = self._channel
+        old._networkProducer.unregisterProducer()
+
+        self._channel = H2Connection()
+        self._channel.requestFactory = self._requestFactory
+        self._channel.site = self._site
+        self._channel.factory = self._factory
+        self._channel.timeOut = self._timeOut
+        self._channel.callLater = self._callLater
+        self._channel.makeConnection(old.transport)
+        self._negotiatedProtocol = b'h2'
+
+
+def _channel_protocol_factory(self):
+    return _ChannelProtocol(http.HTTPChannel())
+
+
+class H2Site(server.Site):
+    """
+    同一端口同时支持HTTP/1.1和HTTP/2(明文h2c或TLS ALPN)的Site.
+    HTTP/2下一个连接上的多个请求各自是一个流, 各流按流量控制窗口发送,
+    窗口用尽时暂停该流注册的生产者(见resource._ResponseSink)
+
+    未安装h2时与Site相同
+    """
+
+    if H2_ENABLED:
+        protocol = _channel_protocol_factory
+
+
+def tls_options(cert_path, key_path=None, http2=True):
+    """
+    :param cert_path: PEM格式的证书文件, 可包含中间证书
+    :param key_path: PEM格式的私钥文件, 未指定时从cert_path读取
+    :return: 通过ALPN协商h2或http/1.1的服务端TLS选项
+    """
+    from OpenSSL import crypto
+
+    with open(cert_path, 'rb') as fp:
+        cert_data = fp.read()
+    key_data = cert_data
+    if key_path is not None:
+        with open(key_path, 'rb') as fp:
+            key_data = fp.read()
+
+    certs = [crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+             for pem in _p_pem_cert.findall(cert_data)]
+    if not certs:
+        raise ValueError('No certificate found in %s' % cert_path)
+    key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_data)
+
+    protocols = [b'http/1.1']
+    if http2 and H2_ENABLED:
+        protocols.insert(0, b'h2')
+    return ssl.CertificateOptions(privateKey=key, certificate=certs[0],
+                                  extraCertChain=certs[1:],
+                                  acceptableProtocols=protocols)
+
+
+def listen_http2(site, port, interface='', cert_path=None, key_path=None,
+                 reactor=reactor):
+    """
+    监听端口: 指定证书时为HTTPS(ALPN), 否则为明文(h2c)
+
+    :type site: H2Site
+    """
+    if not H2_ENABLED:
+        get_logger(site).warn(u'未安装h2, 只支持HTTP/1.1')
+    if cert_path is not None:
+        return reactor.listenSSL(port, site, tls_options(cert_path, key_path),
+                                 interface=interface)
+    return reactor.listenTCP(port, site, interface=interface)
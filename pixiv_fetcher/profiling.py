@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+
+class SamplingProfiler(object):
+    """
+    采样分析器: 后台线程每interval秒读取一次目标线程的调用栈, 结果以
+    collapsed stack格式(每行 "栈帧;栈帧;... 次数")输出, 可直接生成火焰图.
+    不需要在目标线程中插桩, 开销只与采样频率有关
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        """
+        :param thread_id: 被采样的线程, 默认为调用start()的线程
+        """
+        self.interval = interval
+        self._thread_id = thread_id
+        self._stacks = {}
+        self._samples = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._thread_id)
+        if frame is None:
+            return
+        names = []
+        while frame is not None:
+            names.append(self._frame_name(frame))
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+        self._samples += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        if self.running:
+            return
+        if self._thread_id is None:
+            self._thread_id = threading.current_thread().ident
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='SamplingProfiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def samples(self):
+        return self._samples
+
+    def collapsed(self):
+        items = sorted(self._stacks.items(), key=lambda i: -i[1])
+        return ''.join('%s %d\n' % item for item in items)
+
+
+class ReactorLagMonitor(object):
+    """
+    每interval秒调度一次回调, 实际执行时间与预期的差即reactor循环延迟
+    """
+
+    def __init__(self, interval=0.5, clock=reactor, alpha=0.2):
+        self.interval = interval
+        self._clock = clock
+        self._alpha = alpha
+        self._call = LoopingCall(self._tick)
+        self._call.clock = clock
+        self._expected = None
+        self.last = 0.0
+        self.average = 0.0
+        self.max = 0.0
+
+    def _tick(self):
+        now = self._clock.seconds()
+        if self._expected is not None:
+            lag = max(now - self._expected, 0.0)
+            self.last = lag
+            self.average += self._alpha * (lag - self.average)
+            self.max = max(self.max, lag)
+        self._expected = now + self.interval
+
+    def start(self):
+        if not self._call.running:
+            self._expected = None
+            self._call.start(self.interval, now=True)
+
+    def stop(self):
+        if self._call.running:
+            self._call.stop()
+
+    def as_dict(self):
+        return {'last': self.last, 'average': self.average, 'max': self.max}
+
+
+def thread_pool_stats(reactor_=reactor):
+    """
+    :return: reactor线程池的排队任务数及线程数, 线程池未创建时为None
+    """
+    pool = getattr(reactor_, 'threadpool', None)
+    if pool is None:
+        return None
+    stats = {'min': pool.min, 'max': pool.max,
+             'workers': len(getattr(pool, 'threads', ()))}
+    team = getattr(pool, '_team', None)
+    if team is not None:
+        statistics = team.statistics()
+        stats.update(queued=statistics.backloggedWorkCount,
+                     busy=statistics.busyWorkerCount,
+                     idle=statistics.idleWorkerCount)
+    return stats
+
+
+def process_memory():
+    """
+    :return: 进程当前的常驻内存(字节), 无法获取时为None
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def cache_memory(caches):
+    """
+    :param caches: {层名: Cache}
+    :return: {层名: {'count': 条目数, 'size': 数据字节数}}, 使用DedupStorage
+             的层另有dedup(见DedupStorage.dedup_stats)
+    """
+    results = {}
+    for name, cache in caches.items():
+        results[name] = {'count': cache.count, 'size': cache.size}
+        dedup_stats = getattr(cache.storage, 'dedup_stats', None)
+        if dedup_stats is not None:
+            results[name]['dedup'] = dedup_stats()
+    return results
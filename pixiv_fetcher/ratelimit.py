@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+from collections import OrderedDict
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+from pixiv_fetcher.exceptions import HttpResponseException
+
+
+class GcraLimiter(object):
+    """
+    GCRA(通用信元速率算法)限流: 每个key只保存一个理论到达时间(TAT),
+    平均每秒rate个请求, 最多突发burst个.
+
+    TAT已过去的key与新key等价, 可以直接删除; key按最近更新顺序保存在
+    OrderedDict中, 每次请求顺带从最旧的一端清理, 内存只与活跃客户端数有关
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time, max_sweep=8):
+        """
+        :param rate: 每秒允许的请求数
+        :param burst: 允许的突发请求数
+        :param max_sweep: 每次请求最多清理的过期key数
+        """
+        self._interval = 1.0 / rate
+        self._tolerance = self._interval * (burst - 1)
+        self._clock = clock
+        self._max_sweep = max_sweep
+        self._tats = OrderedDict()
+
+    def _sweep(self, now):
+        tats = self._tats
+        for _ in range(self._max_sweep):
+            if not tats:
+                break
+            key = next(iter(tats))
+            if tats[key] > now:
+                break
+            del tats[key]
+
+    def acquire(self, key, cost=1):
+        """
+        :return: (是否允许, 被拒绝时需等待的秒数)
+        """
+        now = self._clock()
+        self._sweep(now)
+
+        tat = max(self._tats.pop(key, now), now)
+        new_tat = tat + self._interval * cost
+        allow_at = new_tat - self._interval - self._tolerance
+        if allow_at > now:
+            self._tats[key] = tat
+            return False, allow_at - now
+
+        self._tats[key] = new_tat
+        return True, 0.0
+
+    def __len__(self):
+        return len(self._tats)
+
+
+def client_ip(request):
+    return request.getClientIP()
+
+
+def referer_host(request):
+    referer = request.getHeader('referer')
+    return urlparse(referer).netloc if referer else ''
+
+
+def client_ip_and_referer(request):
+    return '%s|%s' % (client_ip(request), referer_host(request))
+
+
+class RateLimitFilter(object):
+    """
+    按客户端限流, 超出时以429和Retry-After拒绝. 所有请求消耗hit预算,
+    缓存未命中需要访问上游的请求另外消耗miss预算:
+
+        limiter = RateLimitFilter(hit_rate=50, hit_burst=100,
+                                  miss_rate=2, miss_burst=10)
+        PixivImageProxyResource(..., filter_fun=limiter,
+                                miss_filter_fun=limiter.check_miss)
+    """
+
+    def __init__(self, hit_rate, hit_burst=1, miss_rate=None, miss_burst=1,
+                 key_func=client_ip, exempt=(), clock=time.time):
+        """
+        :param miss_rate: None表示不单独限制未命中请求
+        :param key_func: 请求的限流key, 可选client_ip, referer_host,
+                         client_ip_and_referer或自定义函数
+        :param exempt: 不限流的key, 例如集群中其他节点的IP
+        """
+        self._hits = GcraLimiter(hit_rate, hit_burst, clock)
+        self._misses = None
+        if miss_rate is not None:
+            self._misses = GcraLimiter(miss_rate, miss_burst, clock)
+        self._key_func = key_func
+        self._exempt = frozenset(exempt)
+
+        self.rejected_hits = 0
+        self.rejected_misses = 0
+
+    @staticmethod
+    def _reject(retry_after):
+        seconds = str(int(math.ceil(retry_after)))
+        return HttpResponseException(429, 'Too Many Requests',
+                                     'Too Many Requests',
+                                     headers={'Retry-After': [seconds]})
+
+    def __call__(self, request):
+        key = self._key_func(request)
+        if key in self._exempt:
+            return
+        allowed, retry_after = self._hits.acquire(key)
+        if not allowed:
+            self.rejected_hits += 1
+            raise self._reject(retry_after)
+
+    def check_miss(self, request):
+        if self._misses is None:
+            return
+        key = self._key_func(request)
+        if key in self._exempt:
+            return
+        allowed, retry_after = self._misses.acquire(key)
+        if not allowed:
+            self.rejected_misses += 1
+            raise self._reject(retry_after)
+
+    @property
+    def active_clients(self):
+        return len(self._hits)
@@ -1,23 +1,146 @@
+# -*- coding: utf-8 -*-
+import cProfile
 import datetime
+import json
 import logging
+import math
+import pstats
+import re
+import uuid
+from collections import OrderedDict
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
 
 from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IPushProducer
+from twisted.web.http_headers import Headers
 from twisted.web.proxy import ReverseProxyResource
-from twisted.web.resource import NoResource
+from twisted.web.resource import NoResource, Resource
 from twisted.web.server import NOT_DONE_YET
+from zope.interface import implementer
 
+from pixiv_fetcher.accesslog import CACHE_HIT, CACHE_STALE, CACHE_MISS, \
+    CACHE_PEER
+from pixiv_fetcher.cache.freshness import FreshnessPolicy, FRESH, STALE
 from pixiv_fetcher.downloader import IllustrationDownloader
-from pixiv_fetcher.exceptions import HttpResponseException
+from pixiv_fetcher.exceptions import HttpResponseException, \
+    SchedulerQueueFull, CircuitOpenError
+from pixiv_fetcher.profiling import SamplingProfiler, ReactorLagMonitor, \
+    thread_pool_stats, process_memory, cache_memory
+from pixiv_fetcher.scheduler import PRIORITY_PREFETCH
+from pixiv_fetcher.tracing import NULL_TRACE
 from pixiv_fetcher.utils.pixiv import parse_pximg_url
 from pixiv_fetcher.utils.time import datetime2gmt
 
 logger = logging.getLogger(__name__)
 
+# 批量请求中的路径不能含有空白和控制字符, 写入part头部时再做URL编码
+_p_unsafe_path = re.compile(r'[^\x21-\x7e]')
+_location_safe = "/:@!$&'()*+,;=-._~%?"
+
+
+@implementer(IPushProducer)
+class _ResponseSink(object):
+    """
+    上游响应边下载边写给客户端, 续传时对客户端透明.
+    作为推送型生产者注册到请求上, 客户端(或HTTP/2流的流量控制窗口)跟不上时
+    暂停读取上游连接, 避免整个响应堆积在发送缓冲区中
+    """
+
+    def __init__(self, request):
+        self._request = request
+        self._upstream = None
+        self._registered = False
+        self.started = False
+        self.disconnected = False
+        self.paused = False
+        request.notifyFinish().addErrback(self._connection_lost)
+
+    def _connection_lost(self, _):
+        self.disconnected = True
+        self._registered = False
+        # 客户端已断开, 上游继续下载以便写入缓存
+        self.resumeProducing()
+
+    def attach(self, producer):
+        """
+        :param producer: 上游响应体的传输, 续传时为新的连接
+        """
+        self._upstream = producer
+        if self.paused:
+            producer.pauseProducing()
+
+    def start(self, response):
+        if self.disconnected:
+            return
+        self.started = True
+        self._request.setResponseCode(response.code, response.phrase)
+        for key, values in response.headers.getAllRawHeaders():
+            self._request.responseHeaders.setRawHeaders(key, values)
+        if not response.headers.hasHeader(b'content-length') \
+                and isinstance(response.length, (int, long)):
+            self._request.setHeader(b'content-length', str(response.length))
+        self._request.registerProducer(self, True)
+        self._registered = True
+
+    def write(self, data):
+        if self.started and not self.disconnected:
+            self._request.write(data)
+
+    def close(self):
+        """
+        结束响应(finish或loseConnection)前调用
+        """
+        self._upstream = None
+        if self._registered:
+            self._registered = False
+            self._request.unregisterProducer()
+
+    def pauseProducing(self):
+        self.paused = True
+        if self._upstream is not None:
+            self._upstream.pauseProducing()
+
+    def resumeProducing(self):
+        self.paused = False
+        if self._upstream is not None:
+            self._upstream.resumeProducing()
+
+    def stopProducing(self):
+        self._connection_lost(None)
+
 
 class PixivImageProxyResource(ReverseProxyResource):
 
     def __init__(self, host, path, port=80, cache=None, pool_maxsize=4,
-                 downloader=None, filter_fun=None, reactor=reactor):
+                 downloader=None, filter_fun=None, reactor=reactor,
+                 endpoints=None, freshness=None, stream=False,
+                 access_log=None, tracer=None, cluster=None,
+                 miss_filter_fun=None, variants=None):
+        """
+        :param freshness: 缓存条目新鲜度策略, 默认条目永远新鲜
+        :type freshness: pixiv_fetcher.cache.freshness.FreshnessPolicy
+        :param stream: 缓存未命中时边从上游下载边返回给客户端, 上游中断时的
+            续传对客户端透明; 默认下载完整后再返回
+        :param access_log: 结构化访问日志, 需要先调用start()
+        :type access_log: pixiv_fetcher.accesslog.AccessLog
+        :param tracer: 记录每个请求各阶段耗时, 未指定时不跟踪
+        :type tracer: pixiv_fetcher.tracing.Tracer
+        :param cluster: 集群模式, 本地未命中时先向负责该图片的节点请求
+        :type cluster: pixiv_fetcher.cluster.PeerCluster
+        :param miss_filter_fun: 与filter_fun相同, 但只对缓存未命中(需要访问
+            上游或其他节点)的请求调用, 例如RateLimitFilter.check_miss
+        :param variants: 启用?w=宽度&fmt=jpeg|webp缩略图, 需要Pillow
+        :type variants: pixiv_fetcher.variants.VariantRenderer
+        """
         path = path[:-1] if path.endswith('/') else path
         paths = path.split('/')
 
@@ -26,10 +149,30 @@ class PixivImageProxyResource(ReverseProxyResource):
         self._sub_paths = paths[1:]
 
         self._downloader = downloader \
-            or IllustrationDownloader(host=host, pool_maxsize=pool_maxsize)
+            or IllustrationDownloader(host=host, pool_maxsize=pool_maxsize,
+                                      endpoints=endpoints)
 
         self._cache = cache
         self._filter = filter_fun
+        self._miss_filter = miss_filter_fun
+        self._freshness = freshness or FreshnessPolicy()
+        self._revalidating = set()
+        self._stream = stream
+        self._access_log = access_log
+        self._tracer = tracer
+        self._cluster = cluster
+        self._variants = variants
+
+    def _begin_trace(self, request):
+        trace = self._tracer.begin('%s %s' % (request.method, request.uri))
+
+        def _finished(result):
+            trace.mark('write')
+            trace.tag('status', request.code)
+            trace.finish()
+
+        request.notifyFinish().addBoth(_finished)
+        return trace
 
     def getChild(self, path, request):
         if not hasattr(request, 'path_depth'):
@@ -43,62 +186,274 @@ class PixivImageProxyResource(ReverseProxyResource):
 
         return self
 
+    @property
+    def cache(self):
+        return self._cache
+
+    def track_access(self, request):
+        if self._access_log is not None:
+            self._access_log.track(request)
+
+    def filter_access(self, request):
+        """
+        调用filter_fun, 拒绝时抛出HttpResponseException
+        """
+        if self._filter:
+            self._filter(request)
+
+    def filter_miss(self, request):
+        """
+        调用miss_filter_fun, 拒绝时抛出HttpResponseException
+        """
+        if self._miss_filter:
+            self._miss_filter(request)
+
+    def check_access(self, request):
+        """
+        调用filter_fun; 拒绝时发送错误响应
+
+        :return: 是否允许访问
+        """
+        if not self._filter:
+            return True
+        try:
+            self.filter_access(request)
+        except HttpResponseException as e:
+            e.send_response(request)
+            logger.warn('HTTP%d %s %s', e.code, e.phrase, request.client)
+            return False
+        except Exception as e:
+            logger.exception(e)
+            raise
+        return True
+
+    def fetch(self, path, client=None, trace=NULL_TRACE):
+        """
+        从上游获取path, 200响应写入缓存
+
+        :return: Deferred, 结果为带body属性的响应
+        """
+        dfd = self._downloader.fetch(path, client=client, trace=trace)
+        if self._cache:
+            dfd.addCallback(self._cache_response, path, trace)
+        return dfd
+
     def render(self, request):
         client = request.client
         uri = request.uri
 
-        logger.info('%s %s %s', request.method, uri, client)
+        self.track_access(request)
+        logger.debug('%s %s %s', request.method, uri, client)
+
+        trace = NULL_TRACE
+        if self._tracer is not None:
+            trace = self._begin_trace(request)
 
         if self._filter:
+            if not self.check_access(request):
+                return NOT_DONE_YET
+            trace.mark('filter')
+
+        if request.requestHeaders.hasHeader('If-Modified-Since'):
+            self._return_304(request)
+            logger.debug('HTTP304 %s', client)
+            return NOT_DONE_YET
+
+        if self._variants is not None:
             try:
-                self._filter(request)
+                spec = self._variants.parse(request)
             except HttpResponseException as e:
                 e.send_response(request)
                 logger.warn('HTTP%d %s %s', e.code, e.phrase, client)
                 return NOT_DONE_YET
-            except Exception as e:
-                logger.exception(e)
-                raise
+            if spec is not None:
+                self._render_variant(request, spec, trace)
+                return NOT_DONE_YET
 
-        if request.requestHeaders.hasHeader('If-Modified-Since'):
-            self._return_304(request)
-            logger.info('HTTP304 %s', client)
-            return NOT_DONE_YET
-        elif self._cache:
+        stale = None
+        if self._cache:
             data = self._cache.get(uri)
+            trace.mark('cache_get')
 
             if data:
-                self._return_data(request, data)
-                return NOT_DONE_YET
+                meta = None
+                if self._freshness.ttl is not None:
+                    meta = self._cache.get_meta(uri)
+                freshness = self._freshness.check(meta)
+                if freshness in (FRESH, STALE):
+                    request.cache_status = CACHE_HIT if freshness == FRESH \
+                        else CACHE_STALE
+                    self._return_data(request, data)
+                    if freshness == STALE:
+                        self._revalidate(uri, meta)
+                    return NOT_DONE_YET
+                stale = data
+
+        request.cache_status = CACHE_MISS
+        if not self._check_miss(request):
+            return NOT_DONE_YET
 
-        dfd = self._downloader.fetch_by_request(request)
+        if self._cluster is not None \
+                and not self._cluster.is_peer_request(request) \
+                and not self._cluster.is_local(uri):
+            self._fetch_from_peer(request, stale, trace)
+        else:
+            self._fetch_upstream(request, stale, trace)
+        return NOT_DONE_YET
 
+    def _check_miss(self, request):
+        try:
+            self.filter_miss(request)
+        except HttpResponseException as e:
+            e.send_response(request)
+            logger.warn('HTTP%d %s %s', e.code, e.phrase, request.client)
+            return False
+        return True
+
+    def _render_variant(self, request, spec, trace=NULL_TRACE):
+        """
+        变体单独缓存; 未命中时取原图(缓存或上游), 在进程池中缩放后缓存
+        """
+        path = request.path
+        key = spec.cache_key(path)
         if self._cache:
-            self._cache_response(request, dfd)
+            data = self._cache.get(key)
+            trace.mark('cache_get')
+            if data:
+                request.cache_status = CACHE_HIT
+                self._return_variant(data, request, spec)
+                return
+
+        request.cache_status = CACHE_MISS
+        if not self._check_miss(request):
+            return
+
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+
+        def _produce():
+            dfd = self._load_original(path, request, trace)
+            dfd.addCallback(self._variants.resize, spec)
+            dfd.addCallback(_resized)
+            return dfd
+
+        def _resized(data):
+            trace.mark('resize')
+            if self._cache:
+                self._cache.set(key, data)
+            return data
+
+        def _done(data):
+            if not disconnected:
+                self._return_variant(data, request, spec)
+
+        def _failed(reason):
+            if disconnected:
+                return
+            if reason.check(HttpResponseException):
+                reason.value.send_response(request)
+            else:
+                self._handle_failure(reason, request)
+
+        dfd = self._variants.produce(key, _produce)
+        dfd.addCallbacks(_done, _failed)
+
+    def _load_original(self, path, request, trace=NULL_TRACE):
+        if self._cache:
+            data = self._cache.get(path)
+            if data:
+                return defer.succeed(data)
 
-        dfd.addCallbacks(callback=self._return_response, callbackArgs=(request,),
-                         errback=self._handle_failure, errbackArgs=(request,))
+        def _body(response):
+            if response.code != 200:
+                raise HttpResponseException(response.code, response.phrase,
+                                            response.phrase)
+            return response.body
 
-        return NOT_DONE_YET
+        dfd = self.fetch(path, client=request.getClientIP(), trace=trace)
+        dfd.addCallback(_body)
+        return dfd
+
+    def _return_variant(self, data, request, spec):
+        request.setResponseCode(200, 'OK')
+        request.responseHeaders.setRawHeaders('Content-Type',
+                                              [spec.content_type])
+        self._send_cache_headers(request)
+        request.write(data)
+        request.finish()
 
-    def _cache_response(self, request, deferred):
-        dfd = defer.Deferred()
-        dfd.addCallback(lambda _: deferred)
+    def _fetch_upstream(self, request, stale=None, trace=NULL_TRACE):
+        sink = _ResponseSink(request) if self._stream else None
+        dfd = self._downloader.fetch_by_request(request, sink=sink,
+                                                trace=trace)
 
-        def _process(response):
+        if self._cache:
+            dfd.addCallback(self._cache_response, request.uri, trace)
+
+        dfd.addCallbacks(callback=self._return_response,
+                         callbackArgs=(request, stale, sink),
+                         errback=self._handle_failure,
+                         errbackArgs=(request, stale, sink))
+        return dfd
+
+    def _fetch_from_peer(self, request, stale=None, trace=NULL_TRACE):
+        """
+        向负责该图片的节点请求, 节点不可用时直接访问上游
+        """
+        def _done(response):
+            trace.mark('peer')
+            request.cache_status = CACHE_PEER
+            if self._cache:
+                self._cache_response(response, request.uri, trace)
+            return self._return_response(response, request, stale)
+
+        def _fallback(reason):
+            trace.mark('peer')
+            return self._fetch_upstream(request, stale, trace)
+
+        dfd = self._cluster.fetch(request.uri, request.getHeader('referer'))
+        dfd.addCallbacks(_done, _fallback)
+        return dfd
+
+    def _cache_response(self, response, key, trace=NULL_TRACE):
+        try:
             if response.code == 200:
                 body = getattr(response, 'body', None)
                 if body:
-                    key = request.uri
-                    self._cache.set(key, body)
+                    meta = self._freshness.make_meta(response.headers)
+                    self._cache.set(key, body, meta)
+                    trace.mark('cache_set')
+        except Exception as e:
+            logger.exception(e)
+        return response
+
+    def _revalidate(self, key, meta):
+        """
+        后台以条件GET重新验证STALE条目, 同一key同时只有一个
+        """
+        if key in self._revalidating:
+            return
+        self._revalidating.add(key)
+
+        headers = Headers()
+        for name, value in self._freshness.conditional_headers(meta):
+            headers.setRawHeaders(name, [value])
 
-        def _fail(reason, request):
-            logger.exception(reason)
-            return reason
+        def _done(response):
+            if response.code == 304:
+                self._cache.set_meta(key, self._freshness.refresh_meta(meta))
+            else:
+                self._cache_response(response, key)
 
-        dfd.addCallback(_process)
-        dfd.addErrback(_fail, request)
-        dfd.callback(None)
+        def _fail(reason):
+            logger.warn(u'重新验证失败: %s %s', key, reason.getErrorMessage())
+
+        def _finally(_):
+            self._revalidating.discard(key)
+
+        dfd = self._downloader.fetch(key, headers, priority=PRIORITY_PREFETCH)
+        dfd.addCallbacks(_done, _fail)
+        dfd.addBoth(_finally)
 
     def _send_cache_headers(self, request, last_modified=None):
         request.responseHeaders.setRawHeaders('Cache-Control', ['max-age=31536000'])
@@ -127,9 +482,31 @@ class PixivImageProxyResource(ReverseProxyResource):
         self._send_cache_headers(request)
         request.finish()
 
-    def _return_response(self, response, request):
+    def _return_stale(self, request, data):
+        request.cache_status = CACHE_STALE
+        logger.warn('Serving stale %s %s', request.uri, request.client)
+        request.responseHeaders.setRawHeaders(
+            'Warning', ['111 - "Revalidation Failed"'])
+        self._return_data(request, data)
+
+    def _return_response(self, response, request, stale=None, sink=None):
+        if sink is not None and sink.started:
+            logger.debug('HTTP%d %s %s', response.code, response.phrase,
+                         request.client)
+            sink.close()
+            if not sink.disconnected:
+                if response.code == 200:
+                    request.finish()
+                else:
+                    request.loseConnection()
+            return response
+
+        if stale is not None and response.code >= 500:
+            self._return_stale(request, stale)
+            return response
+
         client = request.client
-        logger.info('HTTP%d %s %s', response.code, response.phrase, client)
+        logger.debug('HTTP%d %s %s', response.code, response.phrase, client)
         request.setResponseCode(response.code, response.phrase)
 
         for key, values in response.headers.getAllRawHeaders():
@@ -140,9 +517,352 @@ class PixivImageProxyResource(ReverseProxyResource):
 
         return response
 
-    def _handle_failure(self, reason, request):
+    def _return_503(self, request, retry_after=None):
+        request.setResponseCode(503, b"Service Unavailable")
+        request.responseHeaders.addRawHeader(b"Content-Type", b"text/html")
+        if retry_after:
+            request.responseHeaders.setRawHeaders(
+                b"Retry-After", [str(int(math.ceil(retry_after)))])
+        request.write(b"<H1>Service Unavailable</H1>")
+        request.finish()
+
+    def _handle_failure(self, reason, request, stale=None, sink=None):
+        if sink is not None and sink.started:
+            # 响应头已经发出, 只能断开连接让客户端知道响应不完整
+            logger.warn(u'下载失败, 断开连接 %s: %s', request.client,
+                        reason.getErrorMessage())
+            sink.close()
+            if not sink.disconnected:
+                request.loseConnection()
+            return
+
+        if stale is not None:
+            self._return_stale(request, stale)
+            return
+
+        if reason.check(SchedulerQueueFull, CircuitOpenError):
+            logger.warn('HTTP503 %s %s', reason.getErrorMessage(),
+                        request.client)
+            retry_after = getattr(reason.value, 'retry_after', None)
+            self._return_503(request, retry_after)
+            return
+
         logger.exception(reason)
         request.setResponseCode(500, b"Internal Server Error")
         request.responseHeaders.addRawHeader(b"Content-Type", b"text/html")
         request.write(b"<H1>Internal Server Error</H1>")
         request.finish()
+
+
+class PixivBatchResource(Resource):
+    """
+    批量获取图片: GET ?path=...&path=... 或 POST 每行一个路径, 以multipart/mixed
+    返回. 先返回缓存命中的图片, 未命中的并发从上游获取, 完成一个返回一个.
+    每个part带有Content-Location(请求的路径, 经URL编码)和X-Status(200/400/502
+    等); 重复的路径只返回一次, 含空白或控制字符的路径返回400.
+    每个路径各调用一次filter_fun, 每个未命中的路径各调用一次miss_filter_fun,
+    被拒绝的路径返回对应状态(例如429)的part
+    """
+
+    isLeaf = True
+
+    def __init__(self, proxy, max_paths=100):
+        """
+        :type proxy: PixivImageProxyResource
+        """
+        Resource.__init__(self)
+        self._proxy = proxy
+        self._max_paths = max_paths
+
+    def _parse_paths(self, request):
+        paths = list(request.args.get('path', []))
+        if request.method == 'POST':
+            paths += request.content.read().splitlines()
+        paths = [p.strip() for p in paths if p.strip()]
+        paths = [p if p.startswith('/') else '/' + p for p in paths]
+        return list(OrderedDict.fromkeys(paths))
+
+    def render_GET(self, request):
+        client = request.client
+        self._proxy.track_access(request)
+        logger.debug('%s %s %s', request.method, request.uri, client)
+
+        if not self._proxy.check_access(request):
+            return NOT_DONE_YET
+
+        paths = self._parse_paths(request)
+        if not paths or len(paths) > self._max_paths:
+            e = HttpResponseException(400, 'Bad Request',
+                                      'Expected 1-%d paths' % self._max_paths)
+            e.send_response(request)
+            return NOT_DONE_YET
+
+        boundary = uuid.uuid4().hex
+        request.setResponseCode(200, 'OK')
+        request.responseHeaders.setRawHeaders(
+            'Content-Type', ['multipart/mixed; boundary=%s' % boundary])
+
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+
+        def _write_part(path, status, body=b'', content_type='text/plain'):
+            if disconnected:
+                return
+            request.write('--%s\r\nContent-Location: %s\r\n'
+                          'Content-Type: %s\r\nContent-Length: %d\r\n'
+                          'X-Status: %d\r\n\r\n'
+                          % (boundary, quote(path, _location_safe),
+                             content_type, len(body), status))
+            request.write(body)
+            request.write('\r\n')
+
+        def _admit(check):
+            """
+            :return: 被拒绝时为状态码
+            """
+            try:
+                check(request)
+            except HttpResponseException as e:
+                logger.warn('HTTP%d %s %s', e.code, e.phrase, client)
+                return e.code
+            return None
+
+        valid = []
+        for i, path in enumerate(paths):
+            # 第一个路径已由check_access计入
+            code = _admit(self._proxy.filter_access) if i else None
+            info = None
+            if code is None:
+                info = None if _p_unsafe_path.search(path) \
+                    else parse_pximg_url(path)
+                code = 400 if info is None else None
+            if code is None:
+                valid.append((path, info))
+            else:
+                _write_part(path, code)
+
+        cache = self._proxy.cache
+        hits = cache.get_many([p for p, _ in valid]) if cache else {}
+        for path, info in valid:
+            if path in hits:
+                _write_part(path, 200, hits[path], 'image/' + info.extension)
+
+        def _fetched(response, path, info):
+            if response.code == 200:
+                _write_part(path, 200, response.body,
+                            'image/' + info.extension)
+            else:
+                _write_part(path, response.code)
+
+        def _failed(reason, path):
+            logger.warn('Batch fetch failed %s: %s', path,
+                        reason.getErrorMessage())
+            _write_part(path, 502)
+
+        dfds = []
+        for path, info in valid:
+            if path in hits:
+                continue
+            code = _admit(self._proxy.filter_miss)
+            if code is not None:
+                _write_part(path, code)
+                continue
+            dfd = self._proxy.fetch(path, client=request.getClientIP())
+            dfd.addCallbacks(_fetched, _failed, callbackArgs=(path, info),
+                             errbackArgs=(path,))
+            dfds.append(dfd)
+
+        def _finish(_):
+            if not disconnected:
+                request.write('--%s--\r\n' % boundary)
+                request.finish()
+
+        defer.DeferredList(dfds).addCallback(_finish)
+        return NOT_DONE_YET
+
+    render_POST = render_GET
+
+
+class PixivPurgeResource(Resource):
+    """
+    按作品ID清除缓存(内存和磁盘各层): POST/DELETE ?pid=...&pid=... 或 POST
+    每行一个pid, 返回JSON {"pids": [...], "purged": 删除的条目数}
+    """
+
+    isLeaf = True
+
+    def __init__(self, cache, filter_fun, max_pids=1000):
+        """
+        :param cache: 带有pid索引的Cache或CombinationCache
+        :param filter_fun: 必需, 访问控制, 拒绝时抛出HttpResponseException
+        """
+        if filter_fun is None:
+            raise ValueError('filter_fun is required to restrict purging')
+        Resource.__init__(self)
+        self._cache = cache
+        self._filter = filter_fun
+        self._max_pids = max_pids
+
+    def _parse_pids(self, request):
+        values = request.args.get('pid', [])
+        if request.method == 'POST':
+            values += request.content.read().splitlines()
+        pids = []
+        for value in values:
+            pids.extend(int(v) for v in value.split(',') if v.strip())
+        return pids
+
+    def render_POST(self, request):
+        client = request.client
+        logger.info('%s %s %s', request.method, request.uri, client)
+
+        try:
+            self._filter(request)
+            try:
+                pids = self._parse_pids(request)
+            except ValueError:
+                pids = None
+            if not pids or len(pids) > self._max_pids:
+                raise HttpResponseException(
+                    400, 'Bad Request', 'Expected 1-%d pids' % self._max_pids)
+        except HttpResponseException as e:
+            e.send_response(request)
+            logger.warn('HTTP%d %s %s', e.code, e.phrase, client)
+            return NOT_DONE_YET
+
+        purged = self._cache.purge(pids)
+        logger.info('Purged %d entries of %r', purged, pids)
+        request.setResponseCode(200, 'OK')
+        request.responseHeaders.setRawHeaders('Content-Type',
+                                              ['application/json'])
+        return json.dumps({'pids': pids, 'purged': purged})
+
+    render_DELETE = render_POST
+
+
+class PixivAdminResource(Resource):
+    """
+    运维接口, 与PixivImageProxyResource并列挂载, 调用start()后开始统计reactor
+    循环延迟:
+
+    - GET /stats: JSON, 包括reactor循环延迟, 线程池排队数, 各缓存层内存,
+      调度器和熔断器状态
+    - GET /profile?seconds=N&format=collapsed|pstats: 对reactor线程分析N秒,
+      collapsed为采样得到的collapsed stack, pstats为cProfile按累计时间排序
+      的统计; 同时只能进行一次
+    """
+
+    isLeaf = True
+
+    def __init__(self, filter_fun, caches=None, downloader=None,
+                 lag_monitor=None, reactor=reactor, max_seconds=60):
+        """
+        :param filter_fun: 必需, 访问控制, 拒绝时抛出HttpResponseException
+        :param caches: {层名: Cache}, 例如{'memory': ..., 'disk': ...}
+        :type downloader: IllustrationDownloader
+        :param lag_monitor: 默认新建一个, 由start()/stop()启停
+        :type lag_monitor: pixiv_fetcher.profiling.ReactorLagMonitor
+        """
+        if filter_fun is None:
+            raise ValueError('filter_fun is required to restrict access')
+        Resource.__init__(self)
+        self._filter = filter_fun
+        self._caches = caches or {}
+        self._downloader = downloader
+        self._reactor = reactor
+        self._max_seconds = max_seconds
+        self._profiling = False
+
+        self._lag_monitor = lag_monitor or ReactorLagMonitor(clock=reactor)
+
+    def start(self):
+        self._lag_monitor.start()
+
+    def stop(self):
+        self._lag_monitor.stop()
+
+    def render_GET(self, request):
+        client = request.client
+        logger.info('%s %s %s', request.method, request.uri, client)
+
+        action = request.postpath[0] if request.postpath else ''
+        try:
+            self._filter(request)
+            if action in ('', 'stats'):
+                return self._render_stats(request)
+            if action == 'profile':
+                return self._render_profile(request)
+            raise HttpResponseException(404, 'Not Found', 'Not Found.')
+        except HttpResponseException as e:
+            e.send_response(request)
+            logger.warn('HTTP%d %s %s', e.code, e.phrase, client)
+            return NOT_DONE_YET
+
+    def stats(self):
+        stats = {
+            'reactor_lag': self._lag_monitor.as_dict(),
+            'thread_pool': thread_pool_stats(self._reactor),
+            'memory': {'rss': process_memory(),
+                       'caches': cache_memory(self._caches)},
+            'profiling': self._profiling,
+        }
+        if self._downloader is not None:
+            stats['scheduler'] = self._downloader.scheduler.state.as_dict()
+            stats['breaker'] = self._downloader.breaker.as_dict()
+        return stats
+
+    def _render_stats(self, request):
+        request.setResponseCode(200, 'OK')
+        request.responseHeaders.setRawHeaders('Content-Type',
+                                              ['application/json'])
+        return json.dumps(self.stats(), sort_keys=True)
+
+    def _render_profile(self, request):
+        try:
+            seconds = float(request.args.get('seconds', ['10'])[0])
+        except ValueError:
+            seconds = 0
+        fmt = request.args.get('format', ['collapsed'])[0]
+        if not 0 < seconds <= self._max_seconds \
+                or fmt not in ('collapsed', 'pstats'):
+            raise HttpResponseException(
+                400, 'Bad Request', 'Expected 0 < seconds <= %d and '
+                'format collapsed or pstats' % self._max_seconds)
+        if self._profiling:
+            raise HttpResponseException(409, 'Conflict',
+                                        'Profiling in progress')
+
+        self._profiling = True
+        if fmt == 'pstats':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = SamplingProfiler()
+            profiler.start()
+
+        disconnected = []
+        request.notifyFinish().addErrback(disconnected.append)
+
+        def _done():
+            self._profiling = False
+            if fmt == 'pstats':
+                profiler.disable()
+                stream = StringIO()
+                stats = pstats.Stats(profiler, stream=stream)
+                stats.sort_stats('cumulative').print_stats(100)
+                output = stream.getvalue()
+            else:
+                profiler.stop()
+                output = profiler.collapsed()
+            logger.info('Profiled %.1fs (%s) for %s', seconds, fmt,
+                        request.client)
+
+            if not disconnected:
+                request.setResponseCode(200, 'OK')
+                request.responseHeaders.setRawHeaders(
+                    'Content-Type', ['text/plain; charset=utf-8'])
+                request.write(output)
+                request.finish()
+
+        self._reactor.callLater(seconds, _done)
+        return NOT_DONE_YET
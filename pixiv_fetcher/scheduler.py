@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict, deque
+
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+from pixiv_fetcher.exceptions import CircuitOpenError, SchedulerQueueFull
+from pixiv_fetcher.utils.log import get_logger
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PREFETCH = 1
+PRIORITY_WARMUP = 2
+
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, PRIORITY_WARMUP)
+
+
+class AIMDLimit(object):
+    """
+    Additive increase / multiplicative decrease 并发上限.
+    每个窗口最多降低一次: 降低时仍在进行的请求(约为原上限个)的错误属于
+    同一次拥塞, 它们完成之前不再降低
+    """
+
+    def __init__(self, initial=2, min_limit=1, max_limit=8, increase=1.0,
+                 backoff=0.5, latency_threshold=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.latency_threshold = latency_threshold
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._cooldown = 0
+
+    def on_success(self, latency):
+        if self.latency_threshold is not None \
+                and latency > self.latency_threshold:
+            self._decrease()
+            return
+        if self._cooldown:
+            self._cooldown -= 1
+        # 每个窗口(约limit个请求)增加increase
+        limit = self._limit + self.increase / self._limit
+        self._limit = min(limit, float(self.max_limit))
+
+    def on_error(self):
+        self._decrease()
+
+    def _decrease(self):
+        if self._cooldown:
+            self._cooldown -= 1
+            return
+        self._cooldown = int(self._limit) - 1
+        self._limit = max(self._limit * self.backoff, float(self.min_limit))
+
+    @property
+    def value(self):
+        return int(self._limit)
+
+
+class _FairQueue(object):
+    """
+    每个客户端一个队列, 出队时在客户端之间轮转
+    """
+
+    def __init__(self):
+        self._clients = OrderedDict()
+        self._length = 0
+
+    def push(self, client, item):
+        queue = self._clients.get(client)
+        if queue is None:
+            queue = self._clients[client] = deque()
+        queue.append(item)
+        self._length += 1
+
+    def pop(self):
+        client, queue = self._clients.popitem(last=False)
+        item = queue.popleft()
+        if queue:
+            self._clients[client] = queue
+        self._length -= 1
+        return item
+
+    def discard(self, client, item):
+        queue = self._clients.get(client)
+        if queue is None:
+            return False
+        try:
+            queue.remove(item)
+        except ValueError:
+            return False
+        if not queue:
+            del self._clients[client]
+        self._length -= 1
+        return True
+
+    def __len__(self):
+        return self._length
+
+
+class _Task(object):
+
+    __slots__ = ('func', 'priority', 'client', 'deferred', 'enqueued',
+                 'started', 'running')
+
+    def __init__(self, func, priority, client, enqueued):
+        self.func = func
+        self.priority = priority
+        self.client = client
+        self.enqueued = enqueued
+        self.started = None
+        self.running = None
+        self.deferred = None
+
+
+class _SchedulerState(object):
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def record_wait(self, seconds):
+        self.wait_count += 1
+        self.wait_time_total += seconds
+        self.wait_time_max = max(self.wait_time_max, seconds)
+
+    def reset(self):
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+
+    @property
+    def queue_depth(self):
+        return self._scheduler.queue_depth()
+
+    @property
+    def running(self):
+        return self._scheduler.running
+
+    @property
+    def limit(self):
+        return self._scheduler.limit
+
+    @property
+    def wait_time_avg(self):
+        if not self.wait_count:
+            return 0.0
+        return self.wait_time_total / self.wait_count
+
+    def as_dict(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'queue_depth_by_priority': dict(
+                (p, self._scheduler.queue_depth(p)) for p in PRIORITIES),
+            'running': self.running,
+            'limit': self.limit,
+            'wait_count': self.wait_count,
+            'wait_time_avg': self.wait_time_avg,
+            'wait_time_max': self.wait_time_max,
+            'completed': self.completed,
+            'errors': self.errors,
+            'rejected': self.rejected,
+        }
+
+    def __str__(self):
+        return '[Queued: %d, Running: %d/%d, AvgWait: %.3fs, MaxWait: %.3fs]' \
+               % (self.queue_depth, self.running, self.limit,
+                  self.wait_time_avg, self.wait_time_max)
+
+
+class FetchScheduler(object):
+    """
+    上游请求调度: 硬并发上限, 按优先级出队, 同一优先级内按客户端公平轮转,
+    并根据上游延迟和错误以AIMD方式调整实际并发数
+    """
+
+    def __init__(self, limit=None, max_queue=None, error_func=None,
+                 clock=reactor):
+        """
+        :param limit:
+        :type limit: AIMDLimit
+        :param max_queue: 排队请求数上限, 超出时以SchedulerQueueFull失败
+        :param error_func: 判断成功结果是否应视为上游错误, 结果为None时不调用
+        """
+        self._limit = limit or AIMDLimit()
+        self._max_queue = max_queue
+        self._error_func = error_func
+        self._clock = clock
+
+        self._queues = dict((p, _FairQueue()) for p in PRIORITIES)
+        self._running = 0
+        self._state = _SchedulerState(self)
+        self._log = get_logger(self)
+
+    def schedule(self, func, priority=PRIORITY_INTERACTIVE, client=None):
+        """
+        :param func: 无参数函数, 返回Deferred
+        :return: Deferred, 结果与func返回的Deferred相同
+        """
+        if priority not in self._queues:
+            raise ValueError('Unknown priority: %r' % (priority,))
+
+        if self._max_queue is not None \
+                and self.queue_depth() >= self._max_queue \
+                and self._running >= self.limit:
+            self._state.rejected += 1
+            return defer.fail(SchedulerQueueFull(self.queue_depth()))
+
+        task = _Task(func, priority, client, self._clock.seconds())
+        task.deferred = defer.Deferred(lambda _: self._cancel(task))
+        self._queues[priority].push(client, task)
+        self._pump()
+        return task.deferred
+
+    def _cancel(self, task):
+        if task.running is not None:
+            task.running.cancel()
+        else:
+            self._queues[task.priority].discard(task.client, task)
+
+    def _next_task(self):
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            if queue:
+                return queue.pop()
+        return None
+
+    def _pump(self):
+        while self._running < self.limit:
+            task = self._next_task()
+            if task is None:
+                break
+            self._start(task)
+
+    def _start(self, task):
+        now = self._clock.seconds()
+        task.started = now
+        self._state.record_wait(now - task.enqueued)
+        self._running += 1
+
+        dfd = defer.maybeDeferred(task.func)
+        task.running = dfd
+        dfd.addBoth(self._finish, task)
+
+    def _finish(self, result, task):
+        self._running -= 1
+        latency = self._clock.seconds() - task.started
+
+        if isinstance(result, Failure):
+            is_error = not result.check(defer.CancelledError)
+        elif self._error_func is not None and result is not None:
+            is_error = self._error_func(result)
+        else:
+            is_error = False
+
+        if isinstance(result, Failure) and result.check(CircuitOpenError):
+            # 熔断器拒绝时没有请求上游, 不调整并发上限
+            pass
+        elif is_error:
+            self._state.errors += 1
+            self._limit.on_error()
+            self._log.debug(u'上游错误, 并发上限降为%d', self.limit)
+        else:
+            self._limit.on_success(latency)
+        self._state.completed += 1
+
+        if not task.deferred.called:
+            if isinstance(result, Failure):
+                task.deferred.errback(result)
+            else:
+                task.deferred.callback(result)
+        self._pump()
+
+    def queue_depth(self, priority=None):
+        if priority is not None:
+            return len(self._queues[priority])
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def limit(self):
+        return self._limit.value
+
+    @property
+    def max_queue(self):
+        return self._max_queue
+
+    @property
+    def state(self):
+        return self._state
+
+    def __str__(self):
+        return '<%s@0x%x %s>' % (self.__class__.__name__, id(self), self.state)
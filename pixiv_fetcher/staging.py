@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from pixiv_fetcher.utils.path import make_direct_open
+
+
+class StagingArea(object):
+    """
+    暂存中断下载的部分响应体及其校验值(ETag/Last-Modified), 以便之后用
+    Range + If-Range续传; 未指定path时保存在内存中, 最多max_entries个,
+    总共不超过max_bytes字节, 超出时先丢弃最早暂存的
+    """
+
+    PART_SUFFIX = '.part'
+    VALIDATOR_SUFFIX = '.validator'
+
+    def __init__(self, path=None, max_entries=64, max_bytes=64 * 1024 * 1024):
+        self._path = path
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def _file_path(self, key):
+        return os.path.join(self._path, hashlib.md5(key).hexdigest())
+
+    def load(self, key):
+        """
+        :return: (data, validator), 没有暂存时为('', None)
+        """
+        if self._path is None:
+            with self._lock:
+                return self._entries.get(key, (b'', None))
+
+        path = self._file_path(key)
+        try:
+            with open(path + self.VALIDATOR_SUFFIX, 'rb') as fp:
+                validator = fp.read()
+            with open(path + self.PART_SUFFIX, 'rb') as fp:
+                return fp.read(), validator
+        except IOError:
+            return b'', None
+
+    def save(self, key, data, validator):
+        if not data or not validator:
+            self.discard(key)
+            return
+
+        if self._path is None:
+            with self._lock:
+                self._pop(key)
+                self._entries[key] = (data, validator)
+                self._bytes += len(data)
+                while len(self._entries) > self._max_entries \
+                        or self._bytes > self._max_bytes:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted)
+            return
+
+        path = self._file_path(key)
+        with make_direct_open(path + self.PART_SUFFIX, 'wb') as fp:
+            fp.write(data)
+        with make_direct_open(path + self.VALIDATOR_SUFFIX, 'wb') as fp:
+            fp.write(validator)
+
+    def discard(self, key):
+        if self._path is None:
+            with self._lock:
+                self._pop(key)
+            return
+
+        path = self._file_path(key)
+        for suffix in (self.VALIDATOR_SUFFIX, self.PART_SUFFIX):
+            if os.path.isfile(path + suffix):
+                os.remove(path + suffix)
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    @property
+    def size(self):
+        """
+        内存中暂存的字节数
+        """
+        return self._bytes
+
+    def __len__(self):
+        if self._path is None:
+            return len(self._entries)
+        if not os.path.isdir(self._path):
+            return 0
+        return len([n for n in os.listdir(self._path)
+                    if n.endswith(self.PART_SUFFIX)])
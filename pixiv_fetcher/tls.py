@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+from OpenSSL import SSL
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.internet.ssl import CertificateOptions, optionsForClientTLS
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _UnverifiedOptions(object):
+    """
+    不校验证书, 只发送SNI
+    """
+
+    def __init__(self, hostname):
+        self._hostname = hostname.encode('idna')
+        self._context = CertificateOptions(verify=False).getContext()
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = SSL.Connection(self._context, None)
+        connection.set_app_data(tlsProtocol)
+        connection.set_tlsext_host_name(self._hostname)
+        return connection
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ResumingConnectionCreator(object):
+    """
+    复用同一个SSL上下文创建连接, 并把上一次握手得到的会话设置到新连接上,
+    使后续连接走会话恢复而不是完整握手
+    """
+
+    def __init__(self, options):
+        self._options = options
+        self._last_connection = None
+        self._session = None
+        self.sessions_offered = 0
+
+    def _latest_session(self):
+        if self._last_connection is not None:
+            # 上一个连接握手失败时没有会话, 沿用更早的会话
+            session = self._last_connection.get_session()
+            if session is not None:
+                self._session = session
+        return self._session
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        session = self._latest_session()
+        connection = self._options.clientConnectionForTLS(tlsProtocol)
+        if session is not None:
+            connection.set_session(session)
+            self.sessions_offered += 1
+        self._last_connection = connection
+        return connection
+
+
+@implementer(IPolicyForHTTPS)
+class UpstreamTLSPolicy(object):
+    """
+    上游HTTPS策略: 每个(主机, 端口)只构建一次SSL上下文, 并支持TLS会话恢复
+
+    server_hostname用于SNI和证书校验, 使按IP访问的上游地址仍以图片站点域名校验.
+    默认校验证书和主机名; 上游使用自签名证书或只能以IP访问时传入verify=False
+    """
+
+    def __init__(self, server_hostname=None, trust_root=None, verify=True):
+        self._server_hostname = server_hostname
+        self._trust_root = trust_root
+        self._verify = verify
+        self._creators = {}
+
+    def creatorForNetloc(self, hostname, port):
+        key = (hostname, port)
+        creator = self._creators.get(key)
+        if creator is None:
+            name = self._server_hostname or hostname
+            if isinstance(name, bytes):
+                name = name.decode('ascii')
+            if self._verify:
+                options = optionsForClientTLS(name, trustRoot=self._trust_root)
+            else:
+                options = _UnverifiedOptions(name)
+            creator = self._creators[key] = _ResumingConnectionCreator(options)
+        return creator
+
+    @property
+    def sessions_offered(self):
+        return sum(c.sessions_offered for c in self._creators.values())
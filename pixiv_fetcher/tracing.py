@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import time
+
+from pixiv_fetcher.utils.log import get_logger
+
+
+class _NullTrace(object):
+    """
+    未启用跟踪时使用, 所有操作为空
+    """
+
+    def mark(self, stage):
+        pass
+
+    def tag(self, key, value):
+        pass
+
+    def finish(self):
+        pass
+
+    def __nonzero__(self):
+        return False
+
+    __bool__ = __nonzero__
+
+
+NULL_TRACE = _NullTrace()
+
+
+class Trace(object):
+    """
+    一次请求的跟踪记录: 处理流程是顺序的, 每次mark(stage)记录自上一次mark
+    (或开始)以来的耗时作为该阶段的耗时
+    """
+
+    def __init__(self, name, tracer, clock=time.time):
+        self.name = name
+        self.tags = {}
+        self.stages = []
+        self.duration = None
+        self._tracer = tracer
+        self._clock = clock
+        self.start = self._last = clock()
+
+    def mark(self, stage):
+        now = self._clock()
+        self.stages.append((stage, now - self._last))
+        self._last = now
+
+    def tag(self, key, value):
+        self.tags[key] = value
+
+    def finish(self):
+        if self.duration is not None:
+            return
+        self.duration = self._clock() - self.start
+        self._tracer.export(self)
+
+    def __str__(self):
+        stages = ' '.join('%s=%.1fms' % (s, d * 1000) for s, d in self.stages)
+        tags = ''.join(' %s=%s' % item for item in sorted(self.tags.items()))
+        return '%s %.1fms [%s]%s' % (self.name, (self.duration or 0) * 1000,
+                                     stages, tags)
+
+
+class Tracer(object):
+
+    def __init__(self, exporters=(), clock=time.time):
+        """
+        :param exporters: 跟踪完成时依次调用exporter.export(trace)
+        """
+        self._exporters = list(exporters)
+        self._clock = clock
+        self._log = get_logger(self)
+
+    def add_exporter(self, exporter):
+        self._exporters.append(exporter)
+
+    def begin(self, name):
+        return Trace(name, self, self._clock)
+
+    def export(self, trace):
+        for exporter in self._exporters:
+            try:
+                exporter.export(trace)
+            except Exception as e:
+                self._log.exception(e)
+
+
+class BaseExporter(object):
+
+    def export(self, trace):
+        raise NotImplementedError()
+
+
+class SlowRequestPrinter(BaseExporter):
+    """
+    打印耗时超过threshold秒的请求的各阶段耗时
+    """
+
+    def __init__(self, threshold=1.0, logger=None):
+        self.threshold = threshold
+        self._log = logger or get_logger(self)
+
+    def export(self, trace):
+        if trace.duration >= self.threshold:
+            self._log.warn(u'慢请求: %s', trace)
+
+
+class StageHistogram(BaseExporter):
+    """
+    按阶段聚合耗时直方图, bounds为各桶上界(秒)
+    """
+
+    DEFAULT_BOUNDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                      1, 2.5, 5, 10)
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self._bounds = sorted(bounds)
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def _observe(self, stage, duration):
+        entry = self._stages.get(stage)
+        if entry is None:
+            entry = self._stages[stage] = [[0] * (len(self._bounds) + 1),
+                                           0, 0.0]
+        entry[0][bisect.bisect_left(self._bounds, duration)] += 1
+        entry[1] += 1
+        entry[2] += duration
+
+    def export(self, trace):
+        with self._lock:
+            for stage, duration in trace.stages:
+                self._observe(stage, duration)
+            self._observe('total', trace.duration)
+
+    def percentile(self, stage, p):
+        """
+        :return: 第p百分位所在桶的上界, 落在最后一个桶时为inf
+        """
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None or not entry[1]:
+                return None
+            target = entry[1] * p / 100.0
+            seen = 0
+            for i, count in enumerate(entry[0]):
+                seen += count
+                if seen >= target:
+                    break
+            return self._bounds[i] if i < len(self._bounds) else float('inf')
+
+    def as_dict(self):
+        with self._lock:
+            result = {}
+            for stage, (buckets, count, total) in self._stages.items():
+                labels = ['le_%g' % b for b in self._bounds] + ['le_inf']
+                result[stage] = {
+                    'count': count,
+                    'mean': total / count if count else 0.0,
+                    'buckets': dict(zip(labels, buckets)),
+                }
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
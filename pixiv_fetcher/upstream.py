@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import random
+from collections import deque
+
+
+class LatencyWindow(object):
+    """
+    最近N次上游首字节延迟, 用于计算对冲请求的触发时间
+    """
+
+    def __init__(self, size=256):
+        self._samples = deque(maxlen=size)
+
+    def add(self, latency):
+        self._samples.append(latency)
+
+    def percentile(self, p):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        idx = int(round((len(ordered) - 1) * p / 100.0))
+        return ordered[idx]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class Endpoint(object):
+    """
+    同一图片站点的一个上游地址(镜像或解析出的某个IP)
+    """
+
+    def __init__(self, host, port=None, alpha=0.2):
+        self.host = host
+        self.port = port
+        self.alpha = alpha
+
+        self.latency = None
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+
+    @classmethod
+    def parse(cls, value, default_port=None):
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, tuple):
+            return cls(*value)
+        host, sep, port = value.rpartition(':')
+        if sep and port.isdigit() and ']' not in port:
+            return cls(host, int(port))
+        return cls(value, default_port)
+
+    def base_url(self, scheme):
+        if (self.port == 80 and scheme == 'http://') \
+                or (self.port == 443 and scheme == 'https://') \
+                or self.port is None:
+            return scheme + self.host
+        return scheme + self.host + ':' + str(self.port)
+
+    def record_success(self, latency):
+        self.requests += 1
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        self.error_rate -= self.alpha * self.error_rate
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.error_rate += self.alpha * (1 - self.error_rate)
+
+    @property
+    def score(self):
+        """
+        越小越好; 尚无延迟数据的地址得分为0, 优先被尝试
+        """
+        latency = self.latency or 0.0
+        penalty = 1.0 - min(self.error_rate, 0.99)
+        return latency * (1 + self.inflight) / penalty + self.error_rate
+
+    def as_dict(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'inflight': self.inflight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'score': self.score,
+        }
+
+    def __str__(self):
+        return '<%s %s:%s score=%.3f>' % (self.__class__.__name__, self.host,
+                                          self.port, self.score)
+
+
+class EndpointGroup(object):
+    """
+    按健康得分选择上游地址; 以explore的概率随机选择, 使被降权的地址有机会恢复
+    """
+
+    def __init__(self, endpoints, explore=0.05):
+        if not endpoints:
+            raise ValueError('At least one endpoint is required')
+        self._endpoints = list(endpoints)
+        self.explore = explore
+
+    def choose(self, exclude=()):
+        candidates = [e for e in self._endpoints if e not in exclude]
+        if not candidates:
+            return None
+        if len(candidates) > 1 and random.random() < self.explore:
+            return random.choice(candidates)
+        return min(candidates, key=lambda e: e.score)
+
+    @property
+    def endpoints(self):
+        return tuple(self._endpoints)
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def __iter__(self):
+        return iter(self._endpoints)
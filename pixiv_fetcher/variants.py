@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import traceback
+from collections import namedtuple
+from io import BytesIO
+
+from twisted.internet import reactor, defer
+
+from pixiv_fetcher.exceptions import HttpResponseException, ResizeError
+from pixiv_fetcher.utils.log import get_logger
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = features = None
+
+CONTENT_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+class VariantSpec(namedtuple('VariantSpec', ['width', 'format', 'quality'])):
+
+    def cache_key(self, path):
+        """
+        变体作为单独的缓存条目; 前缀加在路径前面, 仍能从中解析出pid,
+        按作品清除缓存时一并清除
+        """
+        return '/_w%d_q%d_%s%s' % (self.width, self.quality, self.format,
+                                    path)
+
+    @property
+    def content_type(self):
+        return CONTENT_TYPES[self.format]
+
+
+def resize_image(data, width, fmt, quality):
+    """
+    在子进程中执行: 把图片缩小到不超过width像素宽并重新编码.
+    像素数超过Image.MAX_IMAGE_PIXELS时直接报错, 不只是警告
+    """
+    image = Image.open(BytesIO(data))
+    pixels = image.width * image.height
+    if Image.MAX_IMAGE_PIXELS and pixels > Image.MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(
+            'Image size (%d pixels) exceeds limit of %d pixels'
+            % (pixels, Image.MAX_IMAGE_PIXELS))
+    if image.width > width:
+        height = max(int(round(image.height * width / float(image.width))), 1)
+        image.draft('RGB', (width, height))
+        image = image.resize((width, height), Image.LANCZOS)
+
+    if fmt == 'jpeg' and image.mode != 'RGB':
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert('RGB')
+
+    output = BytesIO()
+    image.save(output, fmt.upper(), quality=quality)
+    return output.getvalue()
+
+
+def _call(func, args):
+    # Python 2的apply_async没有error_callback, 异常也作为结果返回
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class ProcessPool(object):
+    """
+    multiprocessing进程池, submit返回在reactor线程中触发的Deferred.
+    子进程意外退出时任务不会有结果, 超过timeout秒没有结果的任务以
+    ResizeError失败, 之后到达的结果被丢弃
+    """
+
+    def __init__(self, processes=None, timeout=60, reactor=reactor):
+        self._pool = self._create_pool(processes)
+        self._timeout = timeout
+        self._reactor = reactor
+
+    @staticmethod
+    def _create_pool(processes):
+        return multiprocessing.Pool(processes)
+
+    def submit(self, func, *args):
+        dfd = defer.Deferred()
+
+        def _fire(ok, value):
+            if dfd.called:
+                return
+            if timer.active():
+                timer.cancel()
+            if ok:
+                dfd.callback(value)
+            else:
+                dfd.errback(ResizeError(value))
+
+        def _done(result):
+            self._reactor.callFromThread(_fire, *result)
+
+        timer = self._reactor.callLater(
+            self._timeout, _fire, False,
+            'No result after %s seconds' % self._timeout)
+        self._pool.apply_async(_call, (func, args), callback=_done)
+        return dfd
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+class VariantRenderer(object):
+    """
+    生成缩小并重新编码的图片变体: ?w=宽度&fmt=jpeg|webp&q=质量.
+    宽度只允许widths中的值(向上取整), 质量取5的倍数, 防止任意参数绕过缓存;
+    图片处理在进程池中进行, 同一变体的并发请求只处理一次
+    """
+
+    DEFAULT_WIDTHS = (150, 240, 360, 480, 600, 720, 1080, 1200)
+
+    def __init__(self, pool=None, widths=DEFAULT_WIDTHS,
+                 formats=('jpeg', 'webp'), default_format='jpeg',
+                 default_quality=85):
+        """
+        :type pool: ProcessPool
+        """
+        if Image is None:
+            raise RuntimeError('Pillow is required for resized variants')
+        self._pool = pool or ProcessPool()
+        self._widths = sorted(widths)
+        self._formats = [f for f in formats
+                         if f != 'webp' or features.check('webp')]
+        self._default_format = default_format
+        self._default_quality = default_quality
+        self._pending = {}
+        self._log = get_logger(self)
+
+    def parse(self, request):
+        """
+        :return: VariantSpec, 没有请求变体时为None
+        :raise HttpResponseException: 参数不合法
+        """
+        args = request.args
+        if 'w' not in args and 'fmt' not in args:
+            return None
+        try:
+            width = int(args.get('w', [self._widths[-1]])[0])
+            quality = int(args.get('q', [self._default_quality])[0])
+        except ValueError:
+            raise HttpResponseException(400, 'Bad Request',
+                                        'Invalid variant parameters')
+        fmt = args.get('fmt', [self._default_format])[0].lower()
+        fmt = 'jpeg' if fmt == 'jpg' else fmt
+        if width <= 0 or not 1 <= quality <= 95 or fmt not in self._formats:
+            raise HttpResponseException(400, 'Bad Request',
+                                        'Invalid variant parameters')
+
+        width = next((w for w in self._widths if w >= width),
+                     self._widths[-1])
+        quality = max(int(round(quality / 5.0)) * 5, 5)
+        return VariantSpec(width, fmt, quality)
+
+    def resize(self, data, spec):
+        return self._pool.submit(resize_image, data, spec.width, spec.format,
+                                 spec.quality)
+
+    def produce(self, key, func):
+        """
+        同一key同时只调用一次func, 其他调用等待同一结果
+
+        :param func: 返回Deferred的函数
+        """
+        waiters = self._pending.get(key)
+        dfd = defer.Deferred()
+        if waiters is not None:
+            waiters.append(dfd)
+            return dfd
+
+        waiters = self._pending[key] = [dfd]
+
+        def _done(result):
+            del self._pending[key]
+            for waiter in waiters:
+                waiter.callback(result)
+
+        def _failed(reason):
+            del self._pending[key]
+            for waiter in waiters:
+                waiter.errback(reason)
+
+        defer.maybeDeferred(func).addCallbacks(_done, _failed)
+        return dfd
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def close(self):
+        self._pool.close()
@@ -0,0 +1,61 @@
+import json
+import tempfile
+import unittest
+
+from pixiv_fetcher.accesslog import AccessLog, CACHE_HIT, CACHE_MISS
+
+
+class TestAccessLog(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp()
+
+    def _read(self):
+        with open(self.path) as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_write_batches(self):
+        log = AccessLog(self.path, batch_size=2, clock=lambda: 100.0)
+        log.log('GET', '/a.jpg', '127.0.0.1', 200, 10, CACHE_MISS, 0.0125)
+        log.log('GET', '/b.jpg', '127.0.0.1', 404, aborted=True)
+        log.log('GET', '/c.jpg', '127.0.0.1', 200)
+        self.assertEqual(log.flush(), 3)
+        self.assertEqual(log.written, 3)
+
+        records = self._read()
+        self.assertEqual(records[0], {
+            'ts': 100.0, 'method': 'GET', 'uri': '/a.jpg',
+            'client': '127.0.0.1', 'status': 200, 'bytes': 10,
+            'cache': 'miss', 'duration': 12.5})
+        self.assertTrue(records[1]['aborted'])
+        self.assertNotIn('aborted', records[2])
+
+    def test_drop_when_full(self):
+        log = AccessLog(self.path, max_queue=2)
+        results = [log.log('GET', '/', None, 200) for _ in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(log.dropped, 1)
+        self.assertEqual(len(log), 2)
+
+    def test_hit_sample(self):
+        values = iter([0.1, 0.9])
+        log = AccessLog(self.path, hit_sample=0.5,
+                        random_func=lambda: next(values))
+        self.assertTrue(log.log('GET', '/', None, 200, cache=CACHE_HIT))
+        self.assertFalse(log.log('GET', '/', None, 200, cache=CACHE_HIT))
+        self.assertTrue(log.log('GET', '/', None, 200, cache=CACHE_MISS))
+        log.flush()
+        records = self._read()
+        self.assertEqual(records[0]['sample'], 0.5)
+        self.assertNotIn('sample', records[1])
+
+    def test_thread(self):
+        log = AccessLog(self.path, flush_interval=0.01)
+        log.start()
+        log.log('GET', '/', None, 200)
+        log.stop(1)
+        self.assertEqual(len(self._read()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
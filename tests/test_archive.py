@@ -0,0 +1,117 @@
+import json
+import os
+import tempfile
+
+from twisted.internet import reactor, defer
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from pixiv_fetcher.archive import Archiver, CacheTarget, DirectoryTarget, \
+    Journal, PidResolver, parse_item, ITEM_PATH, ITEM_PID
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import DiskStorage
+from pixiv_fetcher.downloader import IllustrationDownloader
+
+_path = '/img-original/img/2018/01/02/03/04/05/%d_p%d.jpg'
+
+
+class _Upstream(Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+        self.failures = {}
+
+    def render_GET(self, request):
+        self.requests.append(request.uri)
+        if request.uri.startswith('/ajax/illust/'):
+            pid = int(request.uri.split('/')[3])
+            urls = [{'urls': {'original': 'https://i.pximg.net' +
+                              _path % (pid, page)}} for page in range(3)]
+            return json.dumps({'error': False, 'body': urls})
+        if self.failures.get(request.uri):
+            code = self.failures[request.uri].pop(0)
+            request.setResponseCode(code)
+            return b'error'
+        return b'image:' + request.uri
+
+
+class TestParseItem(unittest.TestCase):
+
+    def test_parse(self):
+        path = _path % (1, 0)
+        self.assertEqual(parse_item('https://i.pximg.net' + path + '\n'),
+                         (ITEM_PATH, path))
+        self.assertEqual(parse_item(path[1:]), (ITEM_PATH, path))
+        self.assertEqual(parse_item(' 123 '), (ITEM_PID, 123))
+        self.assertEqual(parse_item('https://www.pixiv.net/artworks/456'),
+                         (ITEM_PID, 456))
+        self.assertIsNone(parse_item('# comment'))
+        self.assertIsNone(parse_item('https://example.com/index.html'))
+
+
+class TestArchiver(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = _Upstream()
+        self.port = reactor.listenTCP(0, server.Site(self.upstream),
+                                      interface='127.0.0.1')
+        port = self.port.getHost().port
+        self.downloader = IllustrationDownloader('127.0.0.1', port)
+        self.resolver = PidResolver(base_url='http://127.0.0.1:%d' % port)
+        self.root = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.root, 'journal')
+        self.journals = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for journal in self.journals:
+            journal.close()
+        yield self.downloader.agent._pool.closeCachedConnections()
+        yield self.resolver._agent._pool.closeCachedConnections()
+        yield self.port.stopListening()
+
+    def _archiver(self, target, **kwargs):
+        journal = Journal(self.journal_path)
+        self.journals.append(journal)
+        return Archiver(self.downloader, target, journal, self.resolver,
+                        concurrency=4, backoff=0.01, **kwargs)
+
+    @defer.inlineCallbacks
+    def test_directory_and_resume(self):
+        items = [parse_item(_path % (i, 0)) for i in range(5)]
+        items.append(parse_item('7'))
+        target = DirectoryTarget(self.root)
+        archiver = self._archiver(target)
+        stats = yield archiver.run(items)
+        self.journals[0].close()
+
+        self.assertEqual((stats.total, stats.done, stats.failed), (8, 8, 0))
+        with open(target.file_path(_path % (7, 2)), 'rb') as fp:
+            self.assertEqual(fp.read(), b'image:' + _path % (7, 2))
+
+        del self.upstream.requests[:]
+        stats = yield self._archiver(target).run(items)
+        self.assertEqual((stats.total, stats.skipped), (8, 8))
+        self.assertEqual(self.upstream.requests, [])
+
+    @defer.inlineCallbacks
+    def test_cache_and_retry(self):
+        cache = Cache(DiskStorage(self.root))
+        cached = _path % (1, 0)
+        cache.set(cached, b'cached')
+        flaky, missing = _path % (2, 0), _path % (3, 0)
+        self.upstream.failures = {flaky: [503, 503], missing: [404]}
+
+        archiver = self._archiver(CacheTarget(cache))
+        stats = yield archiver.run([parse_item(p)
+                                    for p in (cached, flaky, missing)])
+        self.assertEqual((stats.done, stats.skipped, stats.failed),
+                         (1, 1, 1))
+        self.assertEqual(stats.retries, 2)
+        self.assertEqual(cache.get(flaky), b'image:' + flaky)
+        self.assertEqual(self.upstream.requests.count(missing), 1)
+        self.assertNotIn(cached, self.upstream.requests)
@@ -0,0 +1,153 @@
+from twisted.internet import reactor, defer
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.client import Agent, readBody
+from twisted.web.resource import Resource
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.exceptions import HttpResponseException
+from pixiv_fetcher.ratelimit import RateLimitFilter
+from pixiv_fetcher.resource import PixivImageProxyResource, \
+    PixivBatchResource
+
+_path = '/img-original/img/2018/01/02/03/04/05/%d_p0.jpg'
+
+
+class _Upstream(Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.uris = []
+
+    def render_GET(self, request):
+        self.uris.append(request.uri)
+        if request.uri == _path % 404:
+            request.setResponseCode(404)
+            return b'not found'
+        return b'image:' + request.uri
+
+
+def _parse_multipart(content_type, body):
+    boundary = content_type.split('boundary=')[1]
+    parts = []
+    for raw in body.split('--' + boundary)[1:-1]:
+        head, _, content = raw[2:].partition('\r\n\r\n')
+        headers = dict(line.split(': ', 1) for line in head.split('\r\n'))
+        parts.append((headers, content[:-2]))
+    return parts
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = _Upstream()
+        self.upstream_port = reactor.listenTCP(
+            0, server.Site(self.upstream), interface='127.0.0.1')
+        self.downloader = IllustrationDownloader(
+            '127.0.0.1', self.upstream_port.getHost().port)
+        self.cache = Cache(SimpleStorage())
+        self.ports = [self.upstream_port]
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.downloader.agent._pool.closeCachedConnections()
+        for port in self.ports:
+            yield port.stopListening()
+
+    @defer.inlineCallbacks
+    def _get(self, query, filter_fun=None, max_paths=100,
+             miss_filter_fun=None):
+        proxy = PixivImageProxyResource(
+            '127.0.0.1', '', cache=self.cache, downloader=self.downloader,
+            filter_fun=filter_fun, miss_filter_fun=miss_filter_fun)
+        port = reactor.listenTCP(
+            0, server.Site(PixivBatchResource(proxy, max_paths)),
+            interface='127.0.0.1')
+        self.ports.append(port)
+
+        agent = Agent(reactor)
+        response = yield agent.request(
+            b'GET', 'http://127.0.0.1:%d/?%s' % (port.getHost().port, query))
+        body = yield readBody(response)
+        defer.returnValue((response, body))
+
+    @defer.inlineCallbacks
+    def test_hits_misses_and_errors(self):
+        self.cache.set(_path % 1, b'cached')
+        query = '&'.join('path=' + p for p in [
+            _path % 1, _path % 2, _path % 2, _path % 404, 'bad'])
+
+        response, body = yield self._get(query)
+        self.assertEqual(response.code, 200)
+        content_type = response.headers.getRawHeaders('content-type')[0]
+        parts = _parse_multipart(content_type, body)
+        statuses = dict((h['Content-Location'], (h['X-Status'], content))
+                        for h, content in parts)
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(statuses, {
+            _path % 1: ('200', b'cached'),
+            _path % 2: ('200', b'image:' + _path % 2),
+            _path % 404: ('404', b''),
+            '/bad': ('400', b''),
+        })
+
+        # the duplicate miss is fetched once and the result is cached
+        self.assertEqual(sorted(self.upstream.uris),
+                         [_path % 2, _path % 404])
+        self.assertEqual(self.cache.get(_path % 2), b'image:' + _path % 2)
+
+    @defer.inlineCallbacks
+    def test_header_injection(self):
+        injected = '/x%0d%0aX-Injected:%20yes' + _path % 3
+        response, body = yield self._get('path=' + injected)
+
+        self.assertNotIn(b'\r\nX-Injected', body)
+        content_type = response.headers.getRawHeaders('content-type')[0]
+        [(headers, _)] = _parse_multipart(content_type, body)
+        self.assertEqual(headers['X-Status'], '400')
+        self.assertEqual(headers['Content-Location'],
+                         '/x%0D%0AX-Injected:%20yes' + _path % 3)
+        self.assertEqual(self.upstream.uris, [])
+
+    @defer.inlineCallbacks
+    def test_filter_and_limit(self):
+        def _deny(request):
+            raise HttpResponseException(403, 'Forbidden')
+
+        response, _ = yield self._get('path=' + _path % 1, filter_fun=_deny)
+        self.assertEqual(response.code, 403)
+
+        query = '&'.join('path=' + _path % i for i in range(3))
+        response, _ = yield self._get(query, max_paths=2)
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.upstream.uris, [])
+
+    @defer.inlineCallbacks
+    def test_budget_per_path(self):
+        limiter = RateLimitFilter(0.01, 100, miss_rate=0.01, miss_burst=1)
+        query = '&'.join('path=' + _path % i for i in range(30))
+        response, body = yield self._get(query, filter_fun=limiter,
+                                         miss_filter_fun=limiter.check_miss)
+
+        content_type = response.headers.getRawHeaders('content-type')[0]
+        statuses = [h['X-Status'] for h, _ in
+                    _parse_multipart(content_type, body)]
+        self.assertEqual(sorted(statuses), ['200'] + ['429'] * 29)
+        self.assertEqual(len(self.upstream.uris), 1)
+        self.assertEqual(limiter.rejected_misses, 29)
+
+        self.cache.set(_path % 100, b'cached')
+        self.cache.set(_path % 101, b'cached')
+        limiter = RateLimitFilter(0.01, 2)
+        query = '&'.join('path=' + _path % i for i in (100, 101, 100, 102))
+        response, body = yield self._get(query, filter_fun=limiter)
+        content_type = response.headers.getRawHeaders('content-type')[0]
+        statuses = dict((h['Content-Location'], h['X-Status']) for h, _ in
+                        _parse_multipart(content_type, body))
+        self.assertEqual(statuses, {_path % 100: '200', _path % 101: '200',
+                                    _path % 102: '429'})
+        self.assertEqual(limiter.rejected_hits, 1)
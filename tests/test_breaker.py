@@ -0,0 +1,99 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from pixiv_fetcher.breaker import CircuitBreaker, STATE_CLOSED, STATE_OPEN, \
+    STATE_HALF_OPEN
+from pixiv_fetcher.exceptions import CircuitOpenError
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(window=10, min_requests=4,
+                                      error_threshold=0.5, reset_timeout=5,
+                                      half_open_max=2, clock=self.clock)
+        self.changes = []
+        self.breaker.add_listener(
+            lambda b, old, new: self.changes.append((old, new)))
+
+    def _trip(self):
+        for _ in range(2):
+            self.breaker.record_success()
+        for _ in range(2):
+            self.breaker.record_failure()
+
+    def test_open_on_error_rate(self):
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_window_expire(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.clock.advance(11)
+        self.breaker.record_success()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+
+    def test_fast_fail(self):
+        self._trip()
+        called = []
+        failed = []
+        dfd = self.breaker.call(lambda: called.append(1))
+        dfd.addErrback(failed.append)
+
+        self.assertFalse(called)
+        self.assertTrue(failed[0].check(CircuitOpenError))
+        self.assertEqual(failed[0].value.retry_after, 5)
+
+    def test_half_open_close(self):
+        self._trip()
+        self.clock.advance(5)
+        self.assertEqual(self.breaker.state, STATE_HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, STATE_CLOSED)
+        self.assertEqual(self.changes, [(STATE_CLOSED, STATE_OPEN),
+                                        (STATE_OPEN, STATE_HALF_OPEN),
+                                        (STATE_HALF_OPEN, STATE_CLOSED)])
+
+    def test_half_open_reopen(self):
+        self._trip()
+        self.clock.advance(5)
+        self.breaker.call(lambda: defer.fail(Exception('upstream'))) \
+            .addErrback(lambda _: None)
+        self.assertEqual(self.breaker.state, STATE_OPEN)
+        self.assertEqual(len(self.breaker.transitions), 3)
+
+    def test_cancel_releases_probe(self):
+        breaker = CircuitBreaker(min_requests=1, reset_timeout=1,
+                                 half_open_max=1, clock=self.clock)
+        breaker.record_failure()
+        self.clock.advance(1)
+        dfd = breaker.call(defer.Deferred)
+        dfd.addErrback(lambda f: f.trap(defer.CancelledError))
+        dfd.cancel()
+        self.assertTrue(breaker.allow())
+
+    def test_slow_calls(self):
+        breaker = CircuitBreaker(min_requests=2, slow_threshold=1.0,
+                                 clock=self.clock)
+        breaker.record_success(2.0)
+        breaker.record_success(3.0)
+        self.assertEqual(breaker.state, STATE_OPEN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import tempfile
+import unittest
+
+from pixiv_fetcher.cache import Cache, CombinationCache
+from pixiv_fetcher.cache.storage import SimpleStorage, DiskStorage
+
+
+class TestBulkStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.storages = [SimpleStorage(), DiskStorage(tempfile.mkdtemp())]
+
+    def test_set_get_delete_many(self):
+        items = dict(('key%d' % i, b'v' * i) for i in range(1, 11))
+        for storage in self.storages:
+            storage.set_many(items)
+            self.assertEqual(storage.count, 10)
+            self.assertEqual(storage.size, 55)
+
+            found = storage.get_many(['key1', 'key2', 'missing'])
+            self.assertEqual(found, {'key1': b'v', 'key2': b'vv'})
+
+            storage.set_many([('key1', b'vvvvv')])
+            self.assertEqual(storage.count, 10)
+            self.assertEqual(storage.size, 59)
+
+            storage.delete_many(['key1', 'key2', 'missing'])
+            self.assertEqual(storage.count, 8)
+            self.assertEqual(storage.size, 52)
+
+    def test_disk_info_persist(self):
+        path = tempfile.mkdtemp()
+        DiskStorage(path).set_many([('a', b'123'), ('b', b'45')])
+        storage = DiskStorage(path)
+        self.assertEqual((storage.count, storage.size), (2, 5))
+
+
+class TestBulkCache(unittest.TestCase):
+
+    def test_cache(self):
+        cache = Cache(SimpleStorage())
+        cache.set_many([('/a', b'1'), ('/b', b'2')])
+        self.assertEqual(cache.get_many(['/a', '/b', '/c']),
+                         {'/a': b'1', '/b': b'2'})
+        self.assertEqual(cache.state.hit_count, 2)
+        self.assertEqual(cache.state.missing_count, 1)
+
+        cache.delete_many(['/a'])
+        self.assertEqual(cache.get_many(['/a', '/b']), {'/b': b'2'})
+
+    def test_combination(self):
+        memory = Cache(SimpleStorage())
+        disk = Cache(DiskStorage(tempfile.mkdtemp()))
+        combination = CombinationCache(memory, disk)
+
+        disk.set_many([('/a', b'1'), ('/b', b'2')])
+        memory.set('/c', b'3')
+        self.assertEqual(combination.get_many(['/a', '/b', '/c', '/d']),
+                         {'/a': b'1', '/b': b'2', '/c': b'3'})
+        self.assertEqual(memory.count, 3)
+
+        combination.delete_many(['/a', '/b'])
+        self.assertEqual(combination.get_many(['/a', '/b']), {})
+
+    def test_combination_promote_meta_and_ttl(self):
+        memory = Cache(SimpleStorage(), default_ttl=60)
+        disk = Cache(SimpleStorage())
+        combination = CombinationCache(memory, disk)
+
+        disk.set('/a', b'1', meta={'etag': 'x'}, ttl=30)
+        disk.set('/b', b'2')
+        self.assertEqual(combination.get_many(['/a', '/b']),
+                         {'/a': b'1', '/b': b'2'})
+        self.assertEqual(memory.get_meta('/a'), {'etag': 'x'})
+        self.assertLessEqual(memory.ttl('/a'), 30)
+        # entries that never expire are not given memory's default_ttl
+        self.assertIsNone(memory.ttl('/b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
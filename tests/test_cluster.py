@@ -0,0 +1,128 @@
+
+from twisted.internet import reactor, defer
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.resource import Resource
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.cluster import HashRing, PeerCluster
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.resource import PixivImageProxyResource
+
+_path = '/img-original/img/2018/01/02/03/04/05/%d_p0.jpg'
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_stable(self):
+        keys = [_path % i for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((k, ring.get(k)) for k in keys)
+        self.assertEqual(set(before.values()), set(['a', 'b', 'c']))
+
+        ring.add('d')
+        moved = [k for k in keys if ring.get(k) != before[k]]
+        self.assertTrue(all(ring.get(k) == 'd' for k in moved))
+        self.assertTrue(150 < len(moved) < 400)
+
+        ring.remove('d')
+        self.assertEqual(dict((k, ring.get(k)) for k in keys), before)
+
+    def test_exclude(self):
+        ring = HashRing(['a', 'b'])
+        owner = ring.get('key')
+        other = 'b' if owner == 'a' else 'a'
+        self.assertEqual(ring.get('key', exclude=[owner]), other)
+        self.assertIsNone(ring.get('key', exclude=['a', 'b']))
+        self.assertIsNone(HashRing().get('key'))
+
+
+class _Upstream(Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render_GET(self, request):
+        self.requests.append(request.uri)
+        return b'image:' + request.uri
+
+
+class TestPeerCluster(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = _Upstream()
+        self.ports = [reactor.listenTCP(0, server.Site(self.upstream),
+                                        interface='127.0.0.1')]
+        upstream_port = self.ports[0].getHost().port
+
+        self.nodes = []
+        self.pools = []
+        for _ in range(3):
+            site = server.Site(Resource())
+            port = reactor.listenTCP(0, site, interface='127.0.0.1')
+            self.ports.append(port)
+            url = 'http://127.0.0.1:%d' % port.getHost().port
+
+            pool = HTTPConnectionPool(reactor)
+            cluster = PeerCluster(url, timeout=2, down_time=60,
+                                  agent=Agent(reactor, pool=pool))
+            downloader = IllustrationDownloader('127.0.0.1', upstream_port)
+            self.pools += [pool, downloader.agent._pool]
+            cache = Cache(SimpleStorage())
+            site.resource = PixivImageProxyResource(
+                '127.0.0.1', '', upstream_port, cache=cache,
+                downloader=downloader, cluster=cluster)
+            self.nodes.append((url, cache, cluster))
+
+        urls = [url for url, _, _ in self.nodes]
+        for _, _, cluster in self.nodes:
+            cluster.set_peers(urls)
+        self.agent = Agent(reactor)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for pool in self.pools:
+            yield pool.closeCachedConnections()
+        for port in self.ports:
+            yield port.stopListening()
+
+    @defer.inlineCallbacks
+    def _get(self, node, path):
+        response = yield self.agent.request(b'GET', node[0] + path)
+        body = yield readBody(response)
+        defer.returnValue((response.code, body))
+
+    @defer.inlineCallbacks
+    def test_owner_fetches_once(self):
+        path = _path % 1
+        owner_url = self.nodes[0][2].owner(path)
+        owner = [n for n in self.nodes if n[0] == owner_url][0]
+
+        for node in self.nodes:
+            code, body = yield self._get(node, path)
+            self.assertEqual((code, body), (200, b'image:' + path))
+
+        self.assertEqual(self.upstream.requests, [path])
+        self.assertEqual(owner[1].count, 1)
+
+    @defer.inlineCallbacks
+    def test_peer_down(self):
+        path = _path % 2
+        requester = self.nodes[0]
+        owner_url = requester[2].owner(path)
+        if owner_url == requester[0]:
+            requester = self.nodes[1]
+            owner_url = requester[2].owner(path)
+        owner_port = [p for p in self.ports[1:]
+                      if owner_url.endswith(':%d' % p.getHost().port)][0]
+        yield owner_port.stopListening()
+
+        code, body = yield self._get(requester, path)
+        self.assertEqual(code, 200)
+        self.assertEqual(self.upstream.requests, [path])
+        self.assertNotEqual(requester[2].owner(path), owner_url)
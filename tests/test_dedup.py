@@ -0,0 +1,101 @@
+import binascii
+import os
+import tempfile
+import unittest
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.dedup import DedupStorage
+from pixiv_fetcher.cache.storage import SimpleStorage, DiskStorage
+from pixiv_fetcher.cache.strategy import LruMemoryStrategy
+from pixiv_fetcher.profiling import cache_memory
+
+
+class _FailingStorage(SimpleStorage):
+
+    def __init__(self, rejected):
+        SimpleStorage.__init__(self)
+        self.rejected = rejected
+
+    def set(self, key, value):
+        if value == self.rejected:
+            return False
+        return SimpleStorage.set(self, key, value)
+
+
+class TestDedupStorage(unittest.TestCase):
+
+    def test_refcount(self):
+        blobs = SimpleStorage()
+        storage = DedupStorage(blobs)
+        storage.set_many([('a', b'12345'), ('b', b'12345'), ('c', b'678')])
+        self.assertEqual((storage.count, storage.unique_count), (3, 2))
+        self.assertEqual((storage.size, storage.logical_size), (8, 13))
+        self.assertAlmostEqual(storage.dedup_ratio, 13 / 8.0)
+
+        storage.delete('a')
+        self.assertEqual(storage.get('b'), b'12345')
+        self.assertEqual((storage.size, blobs.count), (8, 2))
+
+        # b now shares c's content: 12345 is released
+        storage.set('b', b'678')
+        self.assertEqual((storage.size, storage.logical_size), (3, 6))
+        self.assertEqual(blobs.count, 1)
+
+        storage.delete_many(['b', 'c', 'missing'])
+        self.assertEqual((storage.count, storage.size), (0, 0))
+        self.assertEqual(storage.dedup_ratio, 1.0)
+
+    def test_partial_set_many(self):
+        storage = DedupStorage(_FailingStorage(b'bad'))
+        storage.set('a', b'good')
+        self.assertEqual(storage.set_many([('a', b'bad'), ('b', b'good'),
+                                           ('c', b'bad')]), 1)
+        self.assertEqual(storage.get('a'), b'good')
+        self.assertFalse(storage.has('c'))
+        self.assertEqual((storage.count, storage.unique_count), (2, 1))
+
+    def test_eviction_by_unique_bytes(self):
+        strategy = LruMemoryStrategy(maxsize=10, maxcount=100)
+        cache = Cache(DedupStorage(SimpleStorage()), strategy=strategy)
+        for i in range(5):
+            cache.set('/mirror%d/1.jpg' % i, b'x' * 6)
+        self.assertEqual((cache.count, cache.size), (5, 6))
+
+        cache.set('/2.jpg', b'y' * 6)
+        self.assertEqual(cache.size, 6)
+        self.assertIsNone(cache.get('/mirror4/1.jpg'))
+        self.assertEqual(cache.get('/2.jpg'), b'y' * 6)
+
+        stats = cache_memory({'memory': cache})['memory']
+        self.assertEqual(stats['dedup']['logical_size'], 6)
+
+    def test_disk_persist(self):
+        root = tempfile.mkdtemp()
+        log_path = os.path.join(root, 'refs.log')
+
+        def _open():
+            return DedupStorage(DiskStorage(root, binascii.hexlify),
+                                path=log_path)
+
+        storage = _open()
+        cache = Cache(storage)
+        cache.set('/a.jpg', b'image', meta={'etag': 'x'})
+        cache.set('/b.jpg', b'image')
+        cache.set('/c.jpg', b'other')
+        cache.delete('/c.jpg')
+
+        # the log is flushed after every append, not only on close
+        writer, storage = storage, _open()
+        writer.close()
+        cache = Cache(storage)
+        self.assertEqual(cache.get('/b.jpg'), b'image')
+        self.assertEqual(cache.get_meta('/a.jpg'), {'etag': 'x'})
+        self.assertIsNone(cache.get_meta('/b.jpg'))
+        self.assertFalse(cache.has('/c.jpg'))
+        self.assertEqual(storage.dedup_stats(), {
+            'count': 2, 'unique_count': 1, 'size': 5, 'logical_size': 10,
+            'saved': 5, 'ratio': 2.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -62,6 +62,15 @@ class TestDiskRecord(unittest.TestCase):
         result = [self.dr.pop_idx(0)[1] for i in range(self.dr.length())]
         self.assertEqual(result, [4, 5, 2, 3])
 
+    def test_pop_many(self):
+        for i in range(1, 6):
+            self.dr.set(i, i * 10)
+        self.assertEqual(self.dr.pop_many([2, 4, 9]), 2)
+        self.assertEqual(self.dr.pop_many([9]), 0)
+        self.assertEqual(self.dr.length(), 3)
+        result = [self.dr.pop_idx(0)[1] for i in range(self.dr.length())]
+        self.assertEqual(result, [10, 30, 50])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,174 @@
+import errno
+import os
+import struct
+import tempfile
+import unittest
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import DiskStorage, GroupCommitDiskStorage, \
+    SYNC_NONE, SYNC_PERIODIC, SYNC_ALWAYS, _PendingOp, safe_path
+
+
+class TestInfoHeader(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.info_path = os.path.join(self.path, 'cache',
+                                      DiskStorage.INFO_FILE)
+
+    def test_torn_slot(self):
+        storage = DiskStorage(self.path)
+        storage.set('a', b'123')
+        storage.set('b', b'45')
+        seq = storage._info.seq
+
+        # the newest slot is half written: the previous one is used
+        with open(self.info_path, 'r+b') as fp:
+            fp.seek(4 + seq % 2 * DiskStorage._Info._slot_length + 10)
+            fp.write(b'\xff' * 8)
+        storage = DiskStorage(self.path)
+        self.assertEqual((storage.count, storage.size), (1, 3))
+
+    def test_both_slots_corrupted(self):
+        DiskStorage(self.path).set_many([('a', b'123'), ('b', b'45')])
+        with open(self.info_path, 'r+b') as fp:
+            fp.seek(4)
+            fp.write(b'\x00' * 56)
+        storage = DiskStorage(self.path)
+        self.assertEqual((storage.count, storage.size), (2, 5))
+
+    def test_legacy_header(self):
+        DiskStorage(self.path).set('a', b'123')
+        with open(self.info_path, 'wb') as fp:
+            fp.write(struct.pack('<QQ', 3, 1))
+        storage = DiskStorage(self.path)
+        self.assertEqual((storage.count, storage.size), (1, 3))
+        storage.set('b', b'45')
+        storage = DiskStorage(self.path)
+        self.assertEqual((storage.count, storage.size), (2, 5))
+
+    def test_default_path_func(self):
+        storage = DiskStorage(self.path)
+        keys = [b'ab\x00c', b'a/b', b'..', b'x.meta', DiskStorage.INFO_FILE,
+                b'plain\xff']
+        for i, key in enumerate(keys):
+            self.assertTrue(storage.set(key, b'%d' % i))
+        for i, key in enumerate(keys):
+            self.assertEqual(storage.get(key), b'%d' % i)
+        self.assertEqual(storage.count, len(keys))
+        self.assertEqual(safe_path(b'plain\xff'), b'plain\xff')
+
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+
+    def _storage(self, durability=SYNC_PERIODIC, **kwargs):
+        storage = GroupCommitDiskStorage(self.path, durability=durability,
+                                         **kwargs)
+        self.storages.append(storage)
+        return storage
+
+    def test_coalesce_and_read_pending(self):
+        storage = self._storage(sync_interval=60)
+        storage.set_many([('a', b'1'), ('b', b'22'), ('a', b'333')])
+        self.assertEqual(storage.coalesced, 1)
+        self.assertEqual(storage.get('a'), b'333')
+        self.assertEqual(storage.get_many(['a', 'b', 'missing']),
+                         {'a': b'333', 'b': b'22'})
+        self.assertEqual((storage.count, storage.size), (2, 5))
+
+        storage.delete('b')
+        storage.delete('missing')
+        self.assertFalse(storage.has('b'))
+        self.assertEqual((storage.count, storage.size), (1, 3))
+
+        storage.flush()
+        self.assertEqual(storage.get('a'), b'333')
+        self.assertIsNone(storage.get('b'))
+        self.assertEqual(storage.get_many(['a', 'b']), {'a': b'333'})
+        reopened = DiskStorage(self.path)
+        self.assertEqual((reopened.count, reopened.size), (1, 3))
+
+    def test_meta_and_cache(self):
+        storage = self._storage(SYNC_NONE)
+        cache = Cache(storage)
+        cache.set('/a', b'abc', meta={'etag': 'x'})
+        self.assertEqual(cache.get_meta('/a'), {'etag': 'x'})
+        storage.close()
+
+        storage = self._storage(SYNC_NONE)
+        self.assertEqual(Cache(storage).get_meta('/a'), {'etag': 'x'})
+        self.assertEqual((storage.count, storage.size), (1, 3))
+
+    def test_always(self):
+        storage = self._storage(SYNC_ALWAYS)
+        storage.set('a', b'123')
+        self.assertEqual(storage.checkpoints, 1)
+        reopened = DiskStorage(self.path)
+        self.assertEqual((reopened.count, reopened.size), (1, 3))
+
+    def test_journal_failure(self):
+        storage = self._storage(SYNC_ALWAYS)
+        journal_append = storage._journal_append
+
+        def _full(entries):
+            raise IOError(errno.ENOSPC, 'No space left on device')
+
+        storage._journal_append = _full
+        self.assertFalse(storage.set('a', b'123'))
+        self.assertEqual(storage.set_many([('b', b'1'), ('c', b'2')]), 0)
+        self.assertFalse(storage.has('a'))
+        self.assertEqual((storage.count, storage.size), (0, 0))
+
+        storage._journal_append = journal_append
+        self.assertTrue(storage.set('a', b'123'))
+        self.assertEqual((storage.count, storage.size), (1, 3))
+
+    def test_remove_failure(self):
+        storage = self._storage()
+        storage.set_many([('a', b'1'), ('b', b'22'), ('c', b'333')])
+        storage.flush()
+        remove = storage._remove
+
+        def _remove(key):
+            if key == 'b':
+                raise OSError(errno.EACCES, 'Permission denied')
+            return remove(key)
+
+        storage._remove = _remove
+        storage.delete_many(['a', 'b', 'c'])
+        storage.flush()
+        self.assertEqual(storage.get('b'), b'22')
+        self.assertFalse(storage.has('c'))
+        self.assertEqual((storage.count, storage.size), (1, 2))
+        reopened = DiskStorage(self.path)
+        self.assertEqual((reopened.count, reopened.size), (1, 2))
+
+    def test_recover_from_journal(self):
+        storage = self._storage()
+        storage.set_many([('a', b'123'), ('b', b'45')])
+        storage.close()
+
+        # a batch is applied but the process dies before the header commit
+        journal_path = os.path.join(self.path, 'cache',
+                                    GroupCommitDiskStorage.JOURNAL_FILE)
+        storage._journal = open(journal_path, 'a+b', 0)
+        storage._apply([('a', _PendingOp(b'1', (0, -2))),
+                        ('b', _PendingOp(None, (-1, -2))),
+                        ('c', _PendingOp(b'678901', (1, 6)))])
+        self.assertEqual(DiskStorage(self.path).count, 2)
+
+        storage = self._storage()
+        self.assertEqual((storage.count, storage.size), (2, 7))
+        self.assertEqual(storage.get('c'), b'678901')
+
+
+if __name__ == '__main__':
+    unittest.main()
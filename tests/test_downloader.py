@@ -0,0 +1,528 @@
+from OpenSSL import crypto
+from twisted.internet import reactor, defer, ssl
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+
+from pixiv_fetcher.breaker import CircuitBreaker, STATE_OPEN
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.exceptions import CircuitOpenError, SchedulerQueueFull, \
+    ResponseChanged
+from pixiv_fetcher.resource import PixivImageProxyResource
+from pixiv_fetcher.scheduler import FetchScheduler, AIMDLimit
+from pixiv_fetcher.staging import StagingArea
+from pixiv_fetcher.tls import UpstreamTLSPolicy
+
+_path = '/img-original/img/2018/01/02/03/04/05/1_p0.jpg'
+
+
+class _Upstream(Resource):
+
+    isLeaf = True
+
+    def __init__(self, name, delay=0, code=200):
+        Resource.__init__(self)
+        self.name = name
+        self.delay = delay
+        self.code = code
+        self.requests = 0
+        self.clients = []
+        self.aborted = defer.Deferred()
+
+    def render(self, request):
+        self.requests += 1
+        self.clients.append(request.getClientAddress().port)
+        if not self.delay:
+            return self._respond(request)
+
+        def _finish():
+            request.write(self._respond(request))
+            request.finish()
+
+        call = reactor.callLater(self.delay, _finish)
+
+        def _aborted(_):
+            call.cancel()
+            self.aborted.callback(self.name)
+
+        request.notifyFinish().addErrback(_aborted)
+        return server.NOT_DONE_YET
+
+    def _respond(self, request):
+        request.setResponseCode(self.code)
+        return b'image from ' + self.name.encode('ascii')
+
+
+class _ResumableUpstream(Resource):
+    """
+    Serves one body with an ETag and honours Range/If-Range; each entry of
+    cuts truncates one response after that many bytes
+    """
+
+    isLeaf = True
+
+    def __init__(self, body, etag='"v1"', cuts=(), ignore_range=False):
+        Resource.__init__(self)
+        self.body = body
+        self.etag = etag
+        self.cuts = list(cuts)
+        self.ignore_range = ignore_range
+        self.ranges = []
+
+    def render_GET(self, request):
+        range_ = request.getHeader('range')
+        if_range = request.getHeader('if-range')
+        self.ranges.append((range_, if_range))
+
+        body = self.body
+        start, end = 0, len(body) - 1
+        if range_ and not self.ignore_range \
+                and if_range in (None, self.etag):
+            first, last = range_[len('bytes='):].split('-')
+            start, end = int(first), int(last) if last else end
+            request.setResponseCode(206)
+            request.setHeader('content-range', 'bytes %d-%d/%d'
+                              % (start, end, len(body)))
+        body = body[start:end + 1]
+        request.setHeader('etag', self.etag)
+        request.setHeader('content-length', str(len(body)))
+
+        if self.cuts:
+            request.write(body[:self.cuts.pop(0)])
+            request.transport.loseConnection()
+            return server.NOT_DONE_YET
+        return body
+
+
+class _Sink(object):
+
+    def __init__(self):
+        self.started = 0
+        self.chunks = []
+
+    def start(self, response):
+        self.started += 1
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def attach(self, producer):
+        pass
+
+    @property
+    def data(self):
+        return b''.join(self.chunks)
+
+
+def _self_signed(hostname):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = hostname
+    cert.add_extensions([crypto.X509Extension(
+        b'subjectAltName', False, b'DNS:' + hostname.encode('ascii'))])
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return ssl.PrivateCertificate.load(
+        crypto.dump_certificate(crypto.FILETYPE_PEM, cert),
+        ssl.KeyPair.load(crypto.dump_privatekey(crypto.FILETYPE_PEM, key),
+                         crypto.FILETYPE_PEM), crypto.FILETYPE_PEM)
+
+
+class _UpstreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ports = []
+        self.downloaders = []
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for downloader in self.downloaders:
+            yield downloader.agent._pool.closeCachedConnections()
+        for port in self.ports:
+            yield port.stopListening()
+
+    def _listen(self, upstream):
+        port = reactor.listenTCP(0, server.Site(upstream),
+                                 interface='127.0.0.1')
+        self.ports.append(port)
+        return '127.0.0.1:%d' % port.getHost().port
+
+    def _downloader(self, endpoints, **kwargs):
+        downloader = IllustrationDownloader('127.0.0.1', endpoints=endpoints,
+                                            **kwargs)
+        # endpoints are tried in order
+        downloader.endpoints.explore = 0
+        self.downloaders.append(downloader)
+        return downloader
+
+
+class TestHedging(_UpstreamTestCase):
+
+    def _hedging(self, endpoints, **kwargs):
+        return self._downloader(endpoints, hedge_min_samples=0,
+                                hedge_min_delay=0.05, **kwargs)
+
+    @defer.inlineCallbacks
+    def test_hedge_wins(self):
+        slow = _Upstream('slow', delay=5)
+        fast = _Upstream('fast')
+        downloader = self._hedging([self._listen(slow), self._listen(fast)])
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from fast')
+        self.assertEqual(downloader.hedged_count, 1)
+        # the primary request is cancelled once the hedge wins
+        self.assertEqual((yield slow.aborted), 'slow')
+        self.assertEqual(downloader.scheduler.running, 0)
+
+    @defer.inlineCallbacks
+    def test_primary_wins(self):
+        primary = _Upstream('primary', delay=0.2)
+        hedge = _Upstream('hedge', delay=5)
+        downloader = self._hedging([self._listen(primary),
+                                    self._listen(hedge)])
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from primary')
+        self.assertEqual(downloader.hedged_count, 1)
+        self.assertEqual((yield hedge.aborted), 'hedge')
+
+    @defer.inlineCallbacks
+    def test_hedge_counts_against_scheduler(self):
+        primary = _Upstream('primary', delay=0.2)
+        hedge = _Upstream('hedge')
+        scheduler = FetchScheduler(AIMDLimit(initial=1, max_limit=1))
+        downloader = self._hedging([self._listen(primary),
+                                    self._listen(hedge)],
+                                   scheduler=scheduler)
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from primary')
+        # the hedge waited for a free slot and was dropped
+        self.assertEqual((downloader.hedged_count, hedge.requests), (0, 0))
+        self.assertEqual((scheduler.running, scheduler.queue_depth()), (0, 0))
+
+
+class TestFailover(_UpstreamTestCase):
+
+    @defer.inlineCallbacks
+    def test_5xx(self):
+        broken = _Upstream('broken', code=503)
+        healthy = _Upstream('healthy')
+        downloader = self._downloader([self._listen(broken),
+                                       self._listen(healthy)], max_hedges=0)
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from healthy')
+        endpoints = downloader.endpoints.endpoints
+        self.assertEqual([e.failures for e in endpoints], [1, 0])
+        self.assertEqual(broken.requests, 1)
+
+    @defer.inlineCallbacks
+    def test_connect_failure(self):
+        closed = reactor.listenTCP(0, server.Site(Resource()),
+                                   interface='127.0.0.1')
+        closed_port = closed.getHost().port
+        yield closed.stopListening()
+        healthy = _Upstream('healthy')
+        downloader = self._downloader(['127.0.0.1:%d' % closed_port,
+                                       self._listen(healthy)], max_hedges=0)
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from healthy')
+        self.assertEqual(downloader.endpoints.endpoints[0].failures, 1)
+
+    @defer.inlineCallbacks
+    def test_all_failed(self):
+        broken = _Upstream('broken', code=502)
+        downloader = self._downloader([self._listen(broken)], max_hedges=0)
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.code, 502)
+
+
+class TestBreaker(_UpstreamTestCase):
+
+    @defer.inlineCallbacks
+    def test_queue_full_is_not_upstream_error(self):
+        upstream = _Upstream('slow', delay=0.1)
+        scheduler = FetchScheduler(AIMDLimit(initial=1, max_limit=1),
+                                   max_queue=0)
+        breaker = CircuitBreaker(min_requests=1)
+        downloader = self._downloader([self._listen(upstream)],
+                                      scheduler=scheduler, breaker=breaker)
+
+        first = downloader.fetch(_path)
+        yield self.assertFailure(downloader.fetch(_path), SchedulerQueueFull)
+        yield first
+        stats = breaker.as_dict()
+        self.assertEqual((stats['requests'], stats['errors']), (1, 0))
+
+    @defer.inlineCallbacks
+    def test_open_fails_before_queueing(self):
+        upstream = _Upstream('broken', code=503)
+        breaker = CircuitBreaker(min_requests=2,
+                                 error_func=IllustrationDownloader._is_error)
+        downloader = self._downloader([self._listen(upstream)],
+                                      max_hedges=0, breaker=breaker)
+
+        for _ in range(2):
+            response = yield downloader.fetch(_path)
+            self.assertEqual(response.code, 503)
+        self.assertEqual(breaker.state, STATE_OPEN)
+
+        yield self.assertFailure(downloader.fetch(_path), CircuitOpenError)
+        self.assertEqual(upstream.requests, 2)
+        self.assertEqual(downloader.scheduler.state.completed, 2)
+
+
+class TestWarmUp(_UpstreamTestCase):
+
+    @defer.inlineCallbacks
+    def test_parallel_connections(self):
+        upstream = _Upstream('upstream')
+        # a limit of 1 must not serialize the HEADs onto one connection
+        scheduler = FetchScheduler(AIMDLimit(initial=1, max_limit=1))
+        downloader = self._downloader([self._listen(upstream)],
+                                      scheduler=scheduler, warm_connections=3)
+
+        yield downloader.warm_up()
+        self.assertEqual(upstream.requests, 3)
+        warmed = set(upstream.clients)
+        self.assertEqual(len(warmed), 3)
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from upstream')
+        self.assertIn(upstream.clients[-1], warmed)
+
+    @defer.inlineCallbacks
+    def test_explicit_start(self):
+        upstream = _Upstream('upstream')
+        downloader = self._downloader([self._listen(upstream)],
+                                      warm_connections=1, keepalive=100)
+        rounds = []
+        warm_up = downloader.warm_up
+        downloader.warm_up = lambda: rounds.append(warm_up()) or rounds[-1]
+        self.assertIsNone(downloader._warm_loop)
+
+        downloader.start()
+        self.assertTrue(downloader._warm_loop.running)
+        self.assertEqual(downloader._warm_loop.interval, 80)
+        downloader.stop()
+        self.assertFalse(downloader._warm_loop.running)
+        yield rounds[0]
+        self.assertEqual((len(rounds), upstream.requests), (1, 1))
+
+    def test_start_without_warm_connections(self):
+        downloader = self._downloader(['127.0.0.1:1'])
+        downloader.start()
+        self.assertIsNone(downloader._warm_loop)
+
+
+class TestTLS(_UpstreamTestCase):
+
+    def setUp(self):
+        super(TestTLS, self).setUp()
+        certificate = _self_signed('i.pximg.net')
+        self.upstream = _Upstream('tls')
+        port = reactor.listenSSL(0, server.Site(self.upstream),
+                                 certificate.options(), interface='127.0.0.1')
+        self.ports.append(port)
+        self.port = port.getHost().port
+        self.policy = UpstreamTLSPolicy(server_hostname='i.pximg.net',
+                                        trust_root=certificate)
+
+    def test_creator_per_netloc(self):
+        creator = self.policy.creatorForNetloc(b'127.0.0.1', self.port)
+        self.assertIs(self.policy.creatorForNetloc(b'127.0.0.1', self.port),
+                      creator)
+        self.assertIsNot(self.policy.creatorForNetloc(b'127.0.0.2', 443),
+                         creator)
+
+    @defer.inlineCallbacks
+    def test_verify_by_site_name_and_resume(self):
+        downloader = self._downloader(['127.0.0.1:%d' % self.port],
+                                      scheme='https://',
+                                      tls_policy=self.policy)
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from tls')
+        self.assertEqual(self.policy.sessions_offered, 0)
+
+        # a new connection offers the session of the previous handshake
+        yield downloader.agent._pool.closeCachedConnections()
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, b'image from tls')
+        self.assertEqual(self.policy.sessions_offered, 1)
+        self.assertEqual(len(set(self.upstream.clients)), 2)
+
+    @defer.inlineCallbacks
+    def test_reject_other_name(self):
+        policy = UpstreamTLSPolicy(server_hostname='example.com',
+                                   trust_root=self.policy._trust_root)
+        downloader = self._downloader(['127.0.0.1:%d' % self.port],
+                                      scheme='https://', tls_policy=policy,
+                                      max_hedges=0)
+        yield self.assertFailure(downloader.fetch(_path), Exception)
+        self.assertEqual(self.upstream.requests, 0)
+
+    @defer.inlineCallbacks
+    def test_verify_opt_out(self):
+        policy = UpstreamTLSPolicy(server_hostname='example.com',
+                                   verify=False)
+        downloader = self._downloader(['127.0.0.1:%d' % self.port],
+                                      scheme='https://', tls_policy=policy)
+
+        for _ in range(2):
+            response = yield downloader.fetch(_path)
+            self.assertEqual(response.body, b'image from tls')
+            yield downloader.agent._pool.closeCachedConnections()
+        self.assertEqual(policy.sessions_offered, 1)
+
+
+class TestResume(_UpstreamTestCase):
+
+    body = bytes(bytearray(range(256))) * 16
+
+    @defer.inlineCallbacks
+    def test_resume_with_range(self):
+        upstream = _ResumableUpstream(self.body, cuts=[1000])
+        downloader = self._downloader([self._listen(upstream)])
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual((response.code, response.body), (200, self.body))
+        self.assertEqual(response.headers.getRawHeaders('content-length'),
+                         [str(len(self.body))])
+        self.assertEqual(upstream.ranges,
+                         [(None, None), ('bytes=1000-', '"v1"')])
+        self.assertEqual(len(downloader.staging), 0)
+
+    @defer.inlineCallbacks
+    def test_changed_validator_restarts(self):
+        upstream = _ResumableUpstream(self.body, etag='"v2"')
+        downloader = self._downloader([self._listen(upstream)])
+        downloader.staging.save(_path, b'old', '"v1"')
+
+        response = yield downloader.fetch(_path)
+        self.assertEqual((response.code, response.body), (200, self.body))
+        self.assertEqual(upstream.ranges, [('bytes=3-', '"v1"')])
+        self.assertEqual(len(downloader.staging), 0)
+
+    @defer.inlineCallbacks
+    def test_restart_skips_streamed_bytes(self):
+        upstream = _ResumableUpstream(self.body, cuts=[1000],
+                                      ignore_range=True)
+        downloader = self._downloader([self._listen(upstream)])
+        sink = _Sink()
+
+        response = yield downloader.fetch(_path, sink=sink)
+        self.assertEqual(response.body, self.body)
+        self.assertEqual((sink.started, sink.data), (1, self.body))
+
+    @defer.inlineCallbacks
+    def test_changed_after_streaming(self):
+        upstream = _ResumableUpstream(self.body, cuts=[1000])
+        upstream.render_GET = self._change_after_first(upstream)
+        downloader = self._downloader([self._listen(upstream)])
+        sink = _Sink()
+
+        yield self.assertFailure(downloader.fetch(_path, sink=sink),
+                                 ResponseChanged)
+        self.assertEqual(sink.data, self.body[:1000])
+
+    @staticmethod
+    def _change_after_first(upstream):
+        render = upstream.render_GET
+
+        def _render(request):
+            try:
+                return render(request)
+            finally:
+                upstream.etag = '"v2"'
+        return _render
+
+    @defer.inlineCallbacks
+    def test_max_resumes(self):
+        upstream = _ResumableUpstream(self.body, cuts=[500, 500, 500])
+        downloader = self._downloader([self._listen(upstream)],
+                                      max_resumes=2)
+
+        yield self.assertFailure(downloader.fetch(_path), Exception)
+        self.assertEqual(len(upstream.ranges), 3)
+        self.assertEqual(downloader.staging.load(_path),
+                         (self.body[:1500], '"v1"'))
+
+        # the next fetch continues from the staged bytes
+        response = yield downloader.fetch(_path)
+        self.assertEqual(response.body, self.body)
+        self.assertEqual(upstream.ranges[-1], ('bytes=1500-', '"v1"'))
+
+    @defer.inlineCallbacks
+    def test_stream_exact_bytes(self):
+        upstream = _ResumableUpstream(self.body, cuts=[1000, 700])
+        downloader = self._downloader([self._listen(upstream)])
+        sink = _Sink()
+
+        response = yield downloader.fetch(_path, sink=sink)
+        self.assertEqual(response.body, self.body)
+        self.assertEqual((sink.started, sink.data), (1, self.body))
+        self.assertEqual([r for r, _ in upstream.ranges],
+                         [None, 'bytes=1000-', 'bytes=1700-'])
+
+    @defer.inlineCallbacks
+    def test_client_range_passed_through(self):
+        upstream = _ResumableUpstream(self.body)
+        downloader = self._downloader([self._listen(upstream)])
+        downloader.staging.save(_path, self.body[:100], '"v1"')
+        headers = Headers({'range': ['bytes=10-19']})
+
+        response = yield downloader.fetch(_path, headers)
+        self.assertEqual((response.code, response.body),
+                         (206, self.body[10:20]))
+        self.assertEqual(upstream.ranges, [('bytes=10-19', None)])
+        self.assertEqual(len(downloader.staging), 1)
+
+    @defer.inlineCallbacks
+    def test_proxy_range_not_cached(self):
+        upstream = _ResumableUpstream(self.body)
+        downloader = self._downloader([self._listen(upstream)])
+        cache = Cache(SimpleStorage())
+        resource = PixivImageProxyResource('127.0.0.1', '', cache=cache,
+                                           downloader=downloader)
+        proxy = self._listen(resource)
+
+        response = yield Agent(reactor).request(
+            b'GET', 'http://%s%s' % (proxy, _path),
+            Headers({'range': ['bytes=0-9']}))
+        body = yield readBody(response)
+        self.assertEqual((response.code, body), (206, self.body[:10]))
+        self.assertFalse(cache.has(_path))
+
+
+class TestStagingArea(unittest.TestCase):
+
+    def test_max_bytes(self):
+        staging = StagingArea(max_entries=10, max_bytes=10)
+        staging.save('a', b'1234', 'v')
+        staging.save('b', b'5678', 'v')
+        staging.save('a', b'123', 'v')
+        self.assertEqual((len(staging), staging.size), (2, 7))
+
+        # the oldest entries are evicted first
+        staging.save('c', b'9012', 'v')
+        self.assertEqual(staging.load('b'), (b'', None))
+        self.assertEqual((len(staging), staging.size), (2, 7))
+
+        staging.save('d', b'x' * 11, 'v')
+        self.assertEqual((len(staging), staging.size), (0, 0))
+        staging.discard('missing')
+        self.assertEqual(staging.size, 0)
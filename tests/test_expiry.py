@@ -0,0 +1,132 @@
+import os
+import tempfile
+import unittest
+
+from twisted.internet.task import Clock
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.expiry import TimingWheel, ExpiryIndex, \
+    ExpirySweeper
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.cache.strategy import LruMemoryStrategy
+
+
+class TestTimingWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = TimingWheel(tick=1, size=10, now=0)
+
+    def test_advance(self):
+        self.wheel.add('a', 3)
+        self.wheel.add('b', 5.5)
+        self.wheel.add('c', 25)
+
+        self.assertEqual(self.wheel.advance(2), [])
+        self.assertEqual(self.wheel.advance(4), ['a'])
+        self.assertEqual(self.wheel.advance(5), [])
+        self.assertEqual(self.wheel.advance(6), ['b'])
+        self.assertEqual(self.wheel.advance(15), [])
+        self.assertEqual(self.wheel.advance(100), ['c'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        self.wheel.add('a', 3)
+        self.wheel.add('a', 8)
+        self.assertEqual(self.wheel.advance(5), [])
+        self.assertEqual(self.wheel.get('a'), 8)
+        self.assertEqual(self.wheel.remove('a'), 8)
+        self.assertEqual(self.wheel.advance(9), [])
+
+    def test_past(self):
+        self.wheel.advance(5)
+        self.wheel.add('a', 1)
+        self.assertEqual(self.wheel.advance(5), ['a'])
+
+
+class TestExpiryIndex(unittest.TestCase):
+
+    def test_persist(self):
+        path = os.path.join(tempfile.mkdtemp(), 'expiry.bin')
+        index = ExpiryIndex(path, clock=lambda: 0)
+        index.set(b'a', 10)
+        index.set(b'b', 20)
+        index.set(b'c', 30)
+        index.discard(b'c')
+        self.assertEqual(index.advance(15), [b'a'])
+        index.close()
+
+        index = ExpiryIndex(path, clock=lambda: 15)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get(b'b'), 20)
+        self.assertTrue(index.is_expired(b'b', now=20))
+        index.close()
+
+    def test_journal_without_sweeper(self):
+        path = os.path.join(tempfile.mkdtemp(), 'expiry.bin')
+        index = ExpiryIndex(path, clock=lambda: 0)
+        for i in range(3000):
+            index.set(b'a', 10 + i)
+            index.discard(b'a')
+        index.set(b'b', 20)
+        self.assertLess(os.path.getsize(path), 2000 * 13)
+
+        # flushed without advance() or close()
+        reopened = ExpiryIndex(path, clock=lambda: 0)
+        self.assertEqual(reopened.get(b'b'), 20)
+        self.assertIsNone(reopened.get(b'a'))
+        reopened.close()
+        index.close()
+
+
+class TestCacheTTL(unittest.TestCase):
+
+    def test_lazy_and_sweep(self):
+        cache = Cache(SimpleStorage(),
+                      LruMemoryStrategy(maxsize=1024, maxcount=10),
+                      default_ttl=60)
+        cache.set('a', b'1', ttl=-1)
+        cache.set('b', b'2', ttl=-1)
+        cache.set('c', b'3')
+        cache.set('d', b'4', ttl=None)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.count, 3)
+        self.assertEqual(cache.expire(), 1)
+        self.assertEqual(cache.count, 2)
+        self.assertEqual(cache.get('c'), b'3')
+        self.assertGreater(cache.ttl('c'), 0)
+        # ttl=None opts out of default_ttl
+        self.assertIsNone(cache.ttl('d'))
+
+    def test_set_many_without_ttl(self):
+        cache = Cache(SimpleStorage(), default_ttl=60)
+        cache.set_many([('a', b'1')], ttl=None)
+        cache.set_many([('b', b'2')])
+        self.assertIsNone(cache.ttl('a'))
+        self.assertGreater(cache.ttl('b'), 0)
+
+    def test_sweeper(self):
+        clock = Clock()
+        cache = Cache(SimpleStorage(), default_ttl=60)
+        cache.set('a', b'1', ttl=-1)
+        cache.set('b', b'2')
+        sweeper = ExpirySweeper([cache], interval=5, clock=clock)
+        sweeper.start()
+        self.assertEqual(cache.count, 2)
+
+        clock.advance(5)
+        self.assertEqual(cache.count, 1)
+        sweeper.stop()
+        self.assertFalse(sweeper.running)
+
+    def test_delete(self):
+        cache = Cache(SimpleStorage(),
+                      LruMemoryStrategy(maxsize=1024, maxcount=10))
+        cache.set('a', b'1', ttl=10)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.ttl('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
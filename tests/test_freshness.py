@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+
+from pixiv_fetcher.cache import Cache, CombinationCache
+from pixiv_fetcher.cache.freshness import FreshnessPolicy, FRESH, STALE, \
+    EXPIRED
+from pixiv_fetcher.cache.storage import SimpleStorage, DiskStorage
+
+
+class TestFreshnessPolicy(unittest.TestCase):
+
+    def test_check(self):
+        policy = FreshnessPolicy(ttl=10, stale_ttl=5)
+        meta = {'stored': 100}
+        self.assertEqual(policy.check(meta, now=105), FRESH)
+        self.assertEqual(policy.check(meta, now=112), STALE)
+        self.assertEqual(policy.check(meta, now=116), EXPIRED)
+        self.assertEqual(policy.check(None, now=116), STALE)
+
+    def test_no_ttl(self):
+        policy = FreshnessPolicy()
+        self.assertEqual(policy.check({'stored': 0}), FRESH)
+
+    def test_conditional_headers(self):
+        meta = {'stored': 0, 'etag': '"abc"',
+                'last_modified': 'Wed, 01 Aug 2018 00:00:00 GMT'}
+        headers = dict(FreshnessPolicy.conditional_headers(meta))
+        self.assertEqual(headers['If-None-Match'], '"abc"')
+        self.assertEqual(headers['If-Modified-Since'], meta['last_modified'])
+        self.assertEqual(FreshnessPolicy.refresh_meta(meta, 5)['stored'], 5)
+
+
+class TestCacheMeta(unittest.TestCase):
+
+    def setUp(self):
+        self.memory = Cache(SimpleStorage())
+        self.disk = Cache(DiskStorage(tempfile.mkdtemp()))
+
+    def test_meta(self):
+        for cache in (self.memory, self.disk):
+            cache.set('/a.jpg', b'data', {'stored': 1})
+            self.assertEqual(cache.get_meta('/a.jpg'), {'stored': 1})
+            self.assertTrue(cache.set_meta('/a.jpg', {'stored': 2}))
+            self.assertEqual(cache.get_meta('/a.jpg'), {'stored': 2})
+
+            cache.set('/a.jpg', b'other')
+            self.assertIsNone(cache.get_meta('/a.jpg'))
+            self.assertFalse(cache.set_meta('/missing.jpg', {}))
+
+    def test_combination_promote(self):
+        combination = CombinationCache(self.memory, self.disk)
+        self.disk.set('/b.jpg', b'data', {'stored': 3})
+        self.assertEqual(combination.get('/b.jpg'), b'data')
+        self.assertEqual(combination.get('/b.jpg'), b'data')
+        self.assertEqual(self.memory.get_meta('/b.jpg'), {'stored': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import os
+import tempfile
+
+from OpenSSL import crypto
+from twisted.internet import reactor, defer, ssl
+from twisted.internet.protocol import ClientCreator, Protocol
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.client import Agent, readBody
+from twisted.web.resource import Resource
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.http2 import H2_ENABLED, H2Site, listen_http2
+from pixiv_fetcher.resource import PixivImageProxyResource, _ResponseSink
+
+if H2_ENABLED:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2.events import DataReceived, ResponseReceived, StreamEnded, \
+        StreamReset
+
+_path = '/img-original/img/2018/01/02/03/04/05/%d_p0.jpg'
+_large_path = '/img-original/img/2018/01/02/03/04/05/1_p1.jpg'
+_large_body = os.urandom(300 * 1024)
+
+
+class _Upstream(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        if request.uri == _large_path:
+            return _large_body
+        return b'image:' + request.uri
+
+
+class _H2Client(Protocol):
+
+    def __init__(self, paths, scheme='http'):
+        self._paths = paths
+        self._scheme = scheme
+        self._streams = {}
+        self.responses = {}
+        self.finished = defer.Deferred()
+
+    def connectionMade(self):
+        self._conn = H2Connection(H2Configuration(client_side=True))
+        self._conn.initiate_connection()
+        for path in self._paths:
+            stream_id = self._conn.get_next_available_stream_id()
+            self._conn.send_headers(stream_id, [
+                (':method', 'GET'), (':path', path),
+                (':scheme', self._scheme), (':authority', 'localhost')],
+                end_stream=True)
+            self._streams[stream_id] = path
+            self.responses[path] = [None, b'']
+        self.transport.write(self._conn.data_to_send())
+
+    def dataReceived(self, data):
+        for event in self._conn.receive_data(data):
+            if isinstance(event, ResponseReceived):
+                status = dict(event.headers)[b':status']
+                self.responses[self._streams[event.stream_id]][0] = \
+                    int(status)
+            elif isinstance(event, DataReceived):
+                self.responses[self._streams[event.stream_id]][1] += \
+                    event.data
+                self._conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, (StreamEnded, StreamReset)):
+                del self._streams[event.stream_id]
+                if not self._streams:
+                    self.finished.callback(self.responses)
+        self.transport.write(self._conn.data_to_send())
+
+
+def _write_certificate(path):
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    with open(path, 'wb') as fp:
+        fp.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        fp.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+
+class _Producer(object):
+
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class _Request(object):
+
+    def notifyFinish(self):
+        return defer.Deferred()
+
+
+class TestResponseSink(unittest.TestCase):
+
+    def test_backpressure(self):
+        sink = _ResponseSink(_Request())
+        first = _Producer()
+        sink.attach(first)
+        sink.pauseProducing()
+        self.assertTrue(first.paused)
+
+        second = _Producer()
+        sink.attach(second)
+        self.assertTrue(second.paused)
+        sink.resumeProducing()
+        self.assertFalse(second.paused)
+
+        sink.pauseProducing()
+        sink.stopProducing()
+        self.assertFalse(second.paused)
+        self.assertTrue(sink.disconnected)
+
+
+class TestHttp2(unittest.TestCase):
+
+    if not H2_ENABLED:
+        skip = 'h2 is not installed'
+
+    def setUp(self):
+        self.upstream = reactor.listenTCP(0, server.Site(_Upstream()),
+                                          interface='127.0.0.1')
+        upstream_port = self.upstream.getHost().port
+        self.downloader = IllustrationDownloader('127.0.0.1', upstream_port)
+        resource = PixivImageProxyResource(
+            '127.0.0.1', '', upstream_port, cache=Cache(SimpleStorage()),
+            downloader=self.downloader, stream=True)
+        self.site = H2Site(resource)
+        self.ports = [self.upstream]
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.downloader.agent._pool.closeCachedConnections()
+        for port in self.ports:
+            yield port.stopListening()
+
+    def _listen(self, **kwargs):
+        port = listen_http2(self.site, 0, interface='127.0.0.1', **kwargs)
+        self.ports.append(port)
+        return port.getHost().port
+
+    @defer.inlineCallbacks
+    def _get_h2(self, connect, paths, scheme='http'):
+        client = yield connect(_H2Client, paths, scheme)
+        responses = yield client.finished
+        client.transport.loseConnection()
+        defer.returnValue((client, responses))
+
+    @defer.inlineCallbacks
+    def test_h2c_multiplexing(self):
+        port = self._listen()
+        paths = [_path % i for i in range(20)] + [_large_path]
+        connect = lambda *args: ClientCreator(reactor, *args).connectTCP(
+            '127.0.0.1', port)
+
+        for _ in range(2):
+            _, responses = yield self._get_h2(connect, paths)
+            for path in paths[:-1]:
+                self.assertEqual(responses[path], [200, b'image:' + path])
+            self.assertEqual(responses[_large_path], [200, _large_body])
+
+    @defer.inlineCallbacks
+    def test_http11_on_same_port(self):
+        port = self._listen()
+        response = yield Agent(reactor).request(
+            b'GET', 'http://127.0.0.1:%d%s' % (port, _path % 1))
+        body = yield readBody(response)
+        self.assertEqual((response.code, body), (200, b'image:' + _path % 1))
+
+    @defer.inlineCallbacks
+    def test_tls_alpn(self):
+        cert_path = os.path.join(tempfile.mkdtemp(), 'server.pem')
+        _write_certificate(cert_path)
+        port = self._listen(cert_path=cert_path)
+        options = ssl.CertificateOptions(verify=False,
+                                         acceptableProtocols=[b'h2'])
+        connect = lambda *args: ClientCreator(reactor, *args).connectSSL(
+            '127.0.0.1', port, options)
+
+        path = _path % 3
+        client, responses = yield self._get_h2(connect, [path], 'https')
+        self.assertEqual(client.transport.negotiatedProtocol, b'h2')
+        self.assertEqual(responses[path], [200, b'image:' + path])
@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.web.test.requesthelper import DummyRequest
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.exceptions import HttpResponseException
+from pixiv_fetcher.profiling import SamplingProfiler, ReactorLagMonitor
+from pixiv_fetcher.resource import PixivAdminResource
+
+
+def _busy(stopped):
+    while not stopped.is_set():
+        sum(range(100))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_sampling_profiler(self):
+        stopped = threading.Event()
+        thread = threading.Thread(target=_busy, args=(stopped,))
+        thread.start()
+        profiler = SamplingProfiler(0.001, thread.ident)
+        profiler.start()
+        time.sleep(0.05)
+        profiler.stop()
+        stopped.set()
+        thread.join()
+
+        self.assertGreater(profiler.samples, 0)
+        self.assertIn('_busy', profiler.collapsed())
+
+    def test_lag_monitor(self):
+        clock = Clock()
+        monitor = ReactorLagMonitor(1, clock)
+        monitor.start()
+        clock.advance(1)
+        clock.advance(1.5)
+        self.assertAlmostEqual(monitor.last, 0.5)
+        self.assertAlmostEqual(monitor.max, 0.5)
+        monitor.stop()
+
+
+class TestAdminResource(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        cache = Cache(SimpleStorage())
+        cache.set('/a.jpg', b'1234')
+        self.resource = PixivAdminResource(lambda request: None,
+                                           caches={'memory': cache},
+                                           reactor=self.clock)
+
+    def _request(self, action, **args):
+        request = DummyRequest([action])
+        request.args = dict((k, [v]) for k, v in args.items())
+        return request
+
+    def test_stats(self):
+        stats = json.loads(self.resource.render(self._request('stats')))
+        self.assertEqual(stats['memory']['caches']['memory'],
+                         {'count': 1, 'size': 4})
+        self.assertIn('reactor_lag', stats)
+
+    def test_profile(self):
+        request = self._request('profile', seconds='1', format='pstats')
+        self.resource.render(request)
+        busy = self._request('profile', seconds='1')
+        self.resource.render(busy)
+        self.assertEqual(busy.responseCode, 409)
+
+        self.clock.advance(1)
+        self.assertEqual(request.finished, 1)
+        self.assertIn('function calls', ''.join(request.written))
+
+    def test_filter(self):
+        def _deny(request):
+            raise HttpResponseException(403, 'Forbidden')
+
+        resource = PixivAdminResource(filter_fun=_deny, reactor=self.clock)
+        request = self._request('stats')
+        resource.render(request)
+        self.assertEqual(request.responseCode, 403)
+
+        self.assertRaises(ValueError, PixivAdminResource, None)
+
+    def test_explicit_start(self):
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.resource.start()
+        self.clock.advance(0.5)
+        self.clock.advance(0.75)
+        stats = json.loads(self.resource.render(self._request('stats')))
+        self.assertAlmostEqual(stats['reactor_lag']['last'], 0.25)
+
+        self.resource.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+import unittest
+from io import BytesIO
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from pixiv_fetcher.cache import Cache, CombinationCache
+from pixiv_fetcher.cache.index import PidIndex
+from pixiv_fetcher.cache.storage import SimpleStorage, DiskStorage
+from pixiv_fetcher.cache.strategy import LfuDiskStrategy, LruMemoryStrategy
+from pixiv_fetcher.exceptions import HttpResponseException
+from pixiv_fetcher.resource import PixivPurgeResource
+
+_path = '/img-original/img/2018/01/02/03/04/05/%d_p%d.jpg'
+
+
+class TestPidIndex(unittest.TestCase):
+
+    def test_add_pop(self):
+        index = PidIndex()
+        index.add(_path % (1, 0), 'a')
+        index.add(_path % (1, 1), 'b')
+        index.add(_path % (2, 0), 'c')
+        index.add('/favicon.ico', 'd')
+        self.assertEqual(len(index), 3)
+        self.assertEqual(sorted(index.pop(1)), ['a', 'b'])
+        self.assertNotIn(1, index)
+
+        index.discard('c')
+        self.assertEqual(index.keys_of(2), [])
+
+    def test_persist(self):
+        path = tempfile.mktemp()
+        index = PidIndex(path)
+        index.add(_path % (1, 0), 'a')
+        index.add(_path % (2, 0), 'b')
+        index.discard('b')
+        index.close()
+
+        index = PidIndex(path)
+        self.assertEqual(index.keys_of(1), ['a'])
+        self.assertNotIn(2, index)
+
+    def test_eviction(self):
+        path = tempfile.mktemp()
+        strategy = LruMemoryStrategy(maxsize=1024, maxcount=2)
+        cache = Cache(SimpleStorage(), strategy, index=PidIndex(path))
+        for pid in range(1, 4):
+            cache.set(_path % (pid, 0), b'x')
+        self.assertEqual(cache.count, 2)
+
+        # the evicted key is dropped from the journal without close()
+        index = PidIndex(path)
+        self.assertEqual(len(index), 2)
+        self.assertNotIn(1, index)
+
+
+class TestPurge(unittest.TestCase):
+
+    def test_combination(self):
+        record_path = tempfile.mktemp()
+        open(record_path, 'wb').close()
+        memory = Cache(SimpleStorage(), index=PidIndex())
+        disk = Cache(DiskStorage(tempfile.mkdtemp()),
+                     LfuDiskStrategy(record_path, maxsize=2 ** 20,
+                                     maxcount=100),
+                     index=PidIndex(os.path.join(tempfile.mkdtemp(), 'pid')))
+        cache = CombinationCache(memory, disk)
+
+        cache.set(_path % (1, 0), b'10')
+        cache.set_many([(_path % (1, 1), b'11'), (_path % (2, 0), b'20')])
+        self.assertEqual(cache.purge([1, 3]), 4)
+        self.assertEqual((memory.count, disk.count), (1, 1))
+        self.assertIsNone(cache.get(_path % (1, 1)))
+        self.assertEqual(cache.get(_path % (2, 0)), b'20')
+        self.assertEqual(disk._strategy._record.length(), 1)
+
+    def test_without_index(self):
+        cache = Cache(SimpleStorage())
+        cache.set(_path % (1, 0), b'10')
+        self.assertEqual(cache.purge([1]), 0)
+
+
+def _require_token(request):
+    if request.getHeader('x-token') != 'secret':
+        raise HttpResponseException(403, 'Forbidden')
+
+
+class TestPurgeResource(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = Cache(SimpleStorage(), index=PidIndex())
+        for pid, page in ((1, 0), (1, 1), (2, 0)):
+            self.cache.set(_path % (pid, page), b'x')
+        self.resource = PixivPurgeResource(self.cache, _require_token,
+                                           max_pids=3)
+
+    def _request(self, body=b'', token='secret', method='POST', **args):
+        request = DummyRequest([])
+        request.method = method
+        request.args = dict((k, [v]) for k, v in args.items())
+        request.content = BytesIO(body)
+        if token is not None:
+            request.requestHeaders.setRawHeaders('x-token', [token])
+        return request
+
+    def test_purge(self):
+        result = self.resource.render(self._request(pid='1,3'))
+        self.assertEqual(json.loads(result), {'pids': [1, 3], 'purged': 2})
+        self.assertEqual(self.cache.count, 1)
+
+        result = self.resource.render(self._request(b'2\n'))
+        self.assertEqual(json.loads(result), {'pids': [2], 'purged': 1})
+
+    def test_delete(self):
+        request = self._request(method='DELETE', pid='2')
+        self.assertEqual(json.loads(self.resource.render(request))['purged'],
+                         1)
+
+    def test_denied(self):
+        for token in (None, 'wrong'):
+            request = self._request(pid='1', token=token)
+            self.resource.render(request)
+            self.assertEqual(request.responseCode, 403)
+        self.assertEqual(self.cache.count, 3)
+
+    def test_bad_request(self):
+        for args in ({'pid': 'x'}, {'pid': '1,2,3,4'}, {}):
+            request = self._request(**args)
+            self.resource.render(request)
+            self.assertEqual(request.responseCode, 400)
+        self.assertEqual(self.cache.count, 3)
+
+    def test_filter_required(self):
+        self.assertRaises(ValueError, PixivPurgeResource, self.cache, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+
+from twisted.web.test.requesthelper import DummyRequest
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.exceptions import HttpResponseException
+from pixiv_fetcher.ratelimit import GcraLimiter, RateLimitFilter, \
+    referer_host
+from pixiv_fetcher.resource import PixivImageProxyResource
+
+_path = '/img-original/img/2018/01/02/03/04/05/1_p0.jpg'
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class _Request(DummyRequest):
+
+    def __init__(self, ip='1.2.3.4', referer=None):
+        DummyRequest.__init__(self, [''])
+        self.uri = _path
+        self._ip = ip
+        if referer:
+            self.requestHeaders.setRawHeaders('referer', [referer])
+
+    def getClientIP(self):
+        return self._ip
+
+
+class TestGcraLimiter(unittest.TestCase):
+
+    def test_burst_and_rate(self):
+        clock = _Clock()
+        limiter = GcraLimiter(rate=2, burst=3, clock=clock)
+        self.assertEqual([limiter.acquire('a')[0] for _ in range(4)],
+                         [True, True, True, False])
+        allowed, retry_after = limiter.acquire('a')
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.5)
+
+        clock.now += 0.5
+        self.assertTrue(limiter.acquire('a')[0])
+        self.assertFalse(limiter.acquire('a')[0])
+        self.assertTrue(limiter.acquire('b')[0])
+
+    def test_idle_expiry(self):
+        clock = _Clock()
+        limiter = GcraLimiter(rate=10, burst=5, clock=clock)
+        for i in range(100):
+            limiter.acquire(i)
+        self.assertEqual(len(limiter), 100)
+        clock.now += 1
+        for _ in range(20):
+            limiter.acquire('active')
+            clock.now += 0.1
+        self.assertEqual(len(limiter), 1)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def test_filter(self):
+        clock = _Clock()
+        limiter = RateLimitFilter(1, 1, miss_rate=1, miss_burst=1,
+                                  exempt=['10.0.0.1'], clock=clock)
+        limiter(_Request())
+        with self.assertRaises(HttpResponseException) as ctx:
+            limiter(_Request())
+        self.assertEqual(ctx.exception.code, 429)
+        self.assertEqual(ctx.exception.headers, {'Retry-After': ['1']})
+
+        limiter(_Request('10.0.0.1'))
+        limiter(_Request('10.0.0.1'))
+        limiter.check_miss(_Request())
+        self.assertRaises(HttpResponseException, limiter.check_miss,
+                          _Request())
+        self.assertEqual((limiter.rejected_hits, limiter.rejected_misses),
+                         (1, 1))
+
+    def test_referer_host(self):
+        self.assertEqual(referer_host(_Request(referer='http://a.com/x')),
+                         'a.com')
+        self.assertEqual(referer_host(_Request()), '')
+
+    def test_miss_budget_in_resource(self):
+        limiter = RateLimitFilter(100, 100, miss_rate=1, miss_burst=1)
+        cache = Cache(SimpleStorage())
+        cache.set(_path, b'image')
+        resource = PixivImageProxyResource(
+            'i.pximg.net', '', cache=cache, filter_fun=limiter,
+            miss_filter_fun=limiter.check_miss)
+        limiter.check_miss(_Request())
+
+        hit = _Request()
+        resource.render(hit)
+        self.assertEqual(hit.written, [b'image'])
+
+        cache.delete(_path)
+        miss = _Request()
+        resource.render(miss)
+        self.assertEqual(miss.responseCode, 429)
+        self.assertTrue(miss.responseHeaders.hasHeader('retry-after'))
+
+
+if __name__ == '__main__':
+    unittest.main()
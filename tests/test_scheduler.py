@@ -0,0 +1,162 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from pixiv_fetcher.downloader import IllustrationDownloader
+from pixiv_fetcher.exceptions import CircuitOpenError, SchedulerQueueFull
+from pixiv_fetcher.scheduler import FetchScheduler, AIMDLimit, \
+    PRIORITY_INTERACTIVE, PRIORITY_PREFETCH, PRIORITY_WARMUP
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pending = []
+        self.order = []
+
+    def _make_scheduler(self, initial=1, max_limit=1, **kw):
+        limit = AIMDLimit(initial=initial, max_limit=max_limit)
+        return FetchScheduler(limit, clock=self.clock, **kw)
+
+    def _task(self, name):
+        def _run():
+            self.order.append(name)
+            dfd = defer.Deferred()
+            self.pending.append(dfd)
+            return dfd
+        return _run
+
+    def _finish_all(self):
+        while self.pending:
+            self.pending.pop(0).callback(None)
+
+    def test_hard_limit(self):
+        scheduler = self._make_scheduler(initial=2, max_limit=2)
+        for i in range(5):
+            scheduler.schedule(self._task(i))
+
+        self.assertEqual(scheduler.running, 2)
+        self.assertEqual(scheduler.queue_depth(), 3)
+
+        self._finish_all()
+        self.assertEqual(self.order, [0, 1, 2, 3, 4])
+        self.assertEqual(scheduler.running, 0)
+
+    def test_priority(self):
+        scheduler = self._make_scheduler()
+        scheduler.schedule(self._task('first'))
+        scheduler.schedule(self._task('warmup'), priority=PRIORITY_WARMUP)
+        scheduler.schedule(self._task('prefetch'), priority=PRIORITY_PREFETCH)
+        scheduler.schedule(self._task('interactive'),
+                           priority=PRIORITY_INTERACTIVE)
+
+        self._finish_all()
+        self.assertEqual(self.order,
+                         ['first', 'interactive', 'prefetch', 'warmup'])
+
+    def test_fair_queue(self):
+        scheduler = self._make_scheduler()
+        scheduler.schedule(self._task('a0'), client='a')
+        for i in range(1, 4):
+            scheduler.schedule(self._task('a%d' % i), client='a')
+        scheduler.schedule(self._task('b0'), client='b')
+        scheduler.schedule(self._task('b1'), client='b')
+
+        self._finish_all()
+        self.assertEqual(self.order, ['a0', 'a1', 'b0', 'a2', 'b1', 'a3'])
+
+    def test_cancel_queued(self):
+        scheduler = self._make_scheduler()
+        scheduler.schedule(self._task(0))
+        dfd = scheduler.schedule(self._task(1))
+        dfd.addErrback(lambda f: f.trap(defer.CancelledError))
+        dfd.cancel()
+
+        self.assertEqual(scheduler.queue_depth(), 0)
+        self._finish_all()
+        self.assertEqual(self.order, [0])
+
+    def test_wait_metrics(self):
+        scheduler = self._make_scheduler()
+        scheduler.schedule(self._task(0))
+        scheduler.schedule(self._task(1))
+        self.clock.advance(2)
+        self._finish_all()
+
+        state = scheduler.state
+        self.assertEqual(state.wait_count, 2)
+        self.assertEqual(state.wait_time_max, 2)
+        self.assertEqual(state.wait_time_avg, 1)
+
+    def test_downloader_default_max_queue(self):
+        downloader = IllustrationDownloader('127.0.0.1', 80)
+        self.assertEqual(downloader.scheduler.max_queue, 256)
+
+    def test_max_queue(self):
+        scheduler = self._make_scheduler(max_queue=1)
+        scheduler.schedule(self._task(0))
+        scheduler.schedule(self._task(1))
+        failed = []
+        scheduler.schedule(self._task(2)).addErrback(failed.append)
+
+        self.assertTrue(failed[0].check(SchedulerQueueFull))
+        self.assertEqual(scheduler.state.rejected, 1)
+
+    def test_aimd(self):
+        scheduler = self._make_scheduler(initial=4, max_limit=8)
+        dfds = [scheduler.schedule(self._task(i)) for i in range(4)]
+        dfds[0].addErrback(lambda _: None)
+        self.pending.pop(0).errback(Exception('upstream'))
+        self.assertEqual(scheduler.limit, 2)
+
+        self._finish_all()
+        for i in range(20):
+            scheduler.schedule(self._task(i))
+            self._finish_all()
+        self.assertGreater(scheduler.limit, 2)
+        self.assertLessEqual(scheduler.limit, 8)
+
+
+    def test_circuit_open_is_not_upstream_error(self):
+        scheduler = self._make_scheduler(initial=4, max_limit=8)
+        failed = []
+        for _ in range(3):
+            scheduler.schedule(
+                lambda: defer.fail(CircuitOpenError(5))).addErrback(
+                failed.append)
+        self.assertEqual(len(failed), 3)
+        self.assertEqual((scheduler.limit, scheduler.state.errors), (4, 0))
+
+
+class TestAIMDLimit(unittest.TestCase):
+
+    def test_latency_threshold(self):
+        limit = AIMDLimit(initial=4, max_limit=8, latency_threshold=1.0)
+        limit.on_success(0.5)
+        self.assertEqual(limit.value, 4)
+        limit.on_success(2.0)
+        self.assertEqual(limit.value, 2)
+
+    def test_decrease_once_per_window(self):
+        limit = AIMDLimit(initial=8, max_limit=8)
+        # a burst of errors from the 8 requests in flight halves it once
+        for _ in range(8):
+            limit.on_error()
+        self.assertEqual(limit.value, 4)
+        limit.on_error()
+        self.assertEqual(limit.value, 2)
+
+    def test_bounds(self):
+        limit = AIMDLimit(initial=1, min_limit=1, max_limit=2)
+        for _ in range(10):
+            limit.on_error()
+        self.assertEqual(limit.value, 1)
+        for _ in range(10):
+            limit.on_success(0)
+        self.assertEqual(limit.value, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import tempfile
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+from pixiv_fetcher.cache import Cache, CombinationCache
+from pixiv_fetcher.cache.index import PidIndex
+from pixiv_fetcher.cache.snapshot import save_snapshot, load_snapshot, \
+    SnapshotRestorer
+from pixiv_fetcher.cache.storage import SimpleStorage, DiskStorage
+from pixiv_fetcher.cache.strategy import LruMemoryStrategy, \
+    FifoMemoryStrategy
+
+_path = '/img-original/img/2018/01/02/03/04/05/%d_p0.jpg'
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot = os.path.join(tempfile.mkdtemp(), 'hot.snapshot')
+
+    def _memory(self, strategy_cls=LruMemoryStrategy, maxcount=100):
+        return Cache(SimpleStorage(), strategy_cls(2 ** 20, maxcount),
+                     index=PidIndex())
+
+    def test_hot_keys(self):
+        for strategy_cls in (LruMemoryStrategy, FifoMemoryStrategy):
+            memory = self._memory(strategy_cls)
+            for i in range(3):
+                memory.set(_path % i, b'v')
+            keys = memory.hot_keys(2)
+            self.assertEqual(save_snapshot(memory, self.snapshot, 2), 2)
+            self.assertEqual(load_snapshot(self.snapshot), keys)
+
+    @defer.inlineCallbacks
+    def test_restore(self):
+        disk = Cache(DiskStorage(tempfile.mkdtemp()), index=PidIndex())
+        memory = self._memory()
+        cache = CombinationCache(memory, disk)
+        for i in range(4):
+            cache.set(_path % i, b'v%d' % i)
+        cache.get(_path % 0)
+        self.assertEqual(cache.save_snapshot(self.snapshot, 3), 3)
+
+        memory = self._memory(maxcount=2)
+        cache = CombinationCache(memory, disk)
+        memory.set(_path % 9, b'live')
+        restorer = cache.restore_snapshot(self.snapshot)
+        restored = yield restorer.done
+        self.assertEqual((restored, restorer.restored), (1, 1))
+
+        self.assertEqual(memory.hot_keys(),
+                         [memory._hash_func(_path % 9),
+                          memory._hash_func(_path % 0)])
+        self.assertEqual(memory.purge([0]), 1)
+
+    @defer.inlineCallbacks
+    def test_stop_and_pause(self):
+        disk = Cache(DiskStorage(tempfile.mkdtemp()))
+        memory = self._memory()
+        for i in range(3):
+            disk.set(_path % i, b'v')
+        keys = [disk._hash_func(_path % i) for i in range(3)]
+
+        clock = task.Clock()
+        restorer = SnapshotRestorer(memory, disk, keys, pause=1.0,
+                                    clock=clock)
+        done = restorer.start()
+        while not memory.count:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(restorer.restored, 1)
+        restorer.stop()
+        clock.advance(1.0)
+        restored = yield done
+        self.assertEqual((restored, memory.count), (1, 1))
+
+    def test_missing_file(self):
+        self.assertEqual(load_snapshot(self.snapshot), [])
@@ -0,0 +1,74 @@
+import tempfile
+import unittest
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SqliteStorage
+
+
+class TestSqliteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = SqliteStorage(self.path, blob_threshold=16,
+                                     chunk_size=4)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_set_get(self):
+        storage = self.storage
+        self.assertTrue(storage.set(b'\x00key', b'\xff' * 10))
+        storage.set(b'large', b'0123456789' * 5)
+        self.assertEqual(storage.get(b'\x00key'), b'\xff' * 10)
+        self.assertEqual(storage.get(b'large'), b'0123456789' * 5)
+        self.assertIsNone(storage.get(b'missing'))
+        self.assertTrue(storage.has(b'large'))
+        self.assertEqual((storage.count, storage.size), (2, 60))
+
+        storage.set(b'large', b'abc')
+        self.assertEqual((storage.count, storage.size), (2, 13))
+        storage.delete(b'large')
+        storage.delete(b'missing')
+        self.assertEqual((storage.count, storage.size), (1, 10))
+
+    def test_meta(self):
+        storage = self.storage
+        self.assertFalse(storage.set_meta(b'a', {'etag': 'x'}))
+        storage.set(b'a', b'1')
+        self.assertTrue(storage.set_meta(b'a', {'etag': 'x'}))
+        self.assertEqual(storage.get_meta(b'a'), {'etag': 'x'})
+        storage.set(b'a', b'2')
+        self.assertIsNone(storage.get_meta(b'a'))
+
+    def test_many_and_persist(self):
+        self.storage.set_many([(b'k%d' % i, b'v' * i) for i in range(1, 11)])
+        self.storage.delete_many([b'k1', b'k2', b'missing'])
+        found = self.storage.get_many([b'k3', b'k4', b'k1'])
+        self.assertEqual(found, {b'k3': b'vvv', b'k4': b'vvvv'})
+        self.storage.close()
+
+        self.storage = SqliteStorage(self.path)
+        self.assertEqual((self.storage.count, self.storage.size), (8, 52))
+
+    def test_transaction_rollback(self):
+        self.storage.set(b'a', b'1')
+        try:
+            with self.storage.transaction():
+                self.storage.set(b'b', b'22')
+                self.storage.delete(b'a')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.storage.get(b'a'), b'1')
+        self.assertFalse(self.storage.has(b'b'))
+        self.assertEqual((self.storage.count, self.storage.size), (1, 1))
+
+    def test_cache(self):
+        cache = Cache(self.storage)
+        cache.set('/a.jpg', b'image', {'etag': 'x'})
+        self.assertEqual(cache.get('/a.jpg'), b'image')
+        self.assertEqual(cache.get_meta('/a.jpg'), {'etag': 'x'})
+
+
+if __name__ == '__main__':
+    unittest.main()
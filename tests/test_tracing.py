@@ -0,0 +1,75 @@
+import logging
+import unittest
+
+from pixiv_fetcher.tracing import Tracer, SlowRequestPrinter, \
+    StageHistogram, NULL_TRACE
+
+
+class _Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class _Handler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+        self.histogram = StageHistogram(bounds=(0.01, 0.1, 1))
+        self.handler = _Handler()
+        logger = logging.getLogger('test_tracing')
+        logger.addHandler(self.handler)
+        printer = SlowRequestPrinter(0.5, logger)
+        self.tracer = Tracer([self.histogram, printer], clock=self.clock)
+
+    def _request(self, *durations):
+        trace = self.tracer.begin('GET /a.jpg')
+        for stage, duration in durations:
+            self.clock.now += duration
+            trace.mark(stage)
+        trace.tag('status', 200)
+        trace.finish()
+        return trace
+
+    def test_stages(self):
+        trace = self._request(('cache_get', 0.005), ('ttfb', 0.2),
+                              ('body', 0.4))
+        self.assertEqual([s for s, _ in trace.stages],
+                         ['cache_get', 'ttfb', 'body'])
+        self.assertAlmostEqual(trace.duration, 0.605)
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertIn('ttfb=200.0ms', self.handler.messages[0])
+        self.assertIn('status=200', self.handler.messages[0])
+
+    def test_histogram(self):
+        for _ in range(9):
+            self._request(('cache_get', 0.001))
+        self._request(('cache_get', 0.05))
+        self.assertEqual(self.histogram.percentile('cache_get', 50), 0.01)
+        self.assertEqual(self.histogram.percentile('cache_get', 100), 0.1)
+        stats = self.histogram.as_dict()['cache_get']
+        self.assertEqual(stats['count'], 10)
+        self.assertEqual(stats['buckets']['le_0.01'], 9)
+        self.assertEqual(self.handler.messages, [])
+
+    def test_null_trace(self):
+        self.assertFalse(NULL_TRACE)
+        NULL_TRACE.mark('filter')
+        NULL_TRACE.finish()
+
+
+if __name__ == '__main__':
+    unittest.main()
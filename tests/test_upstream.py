@@ -0,0 +1,59 @@
+import unittest
+
+from pixiv_fetcher.upstream import Endpoint, EndpointGroup, LatencyWindow
+
+
+class TestEndpointGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.fast = Endpoint('fast')
+        self.slow = Endpoint('slow', 8080)
+        self.group = EndpointGroup([self.slow, self.fast], explore=0)
+
+    def test_parse(self):
+        ep = Endpoint.parse('1.2.3.4:8080')
+        self.assertEqual((ep.host, ep.port), ('1.2.3.4', 8080))
+        ep = Endpoint.parse('i.pximg.net', 443)
+        self.assertEqual((ep.host, ep.port), ('i.pximg.net', 443))
+        self.assertEqual(ep.base_url('https://'), 'https://i.pximg.net')
+        self.assertEqual(Endpoint.parse(('a', 81)).base_url('http://'),
+                         'http://a:81')
+
+    def test_prefer_fast(self):
+        for _ in range(5):
+            self.fast.record_success(0.1)
+            self.slow.record_success(1.0)
+        self.assertIs(self.group.choose(), self.fast)
+        self.assertIs(self.group.choose(exclude=[self.fast]), self.slow)
+        self.assertIsNone(self.group.choose(exclude=[self.fast, self.slow]))
+
+    def test_steer_away_from_errors(self):
+        for _ in range(5):
+            self.fast.record_success(0.1)
+            self.slow.record_success(0.2)
+        for _ in range(5):
+            self.fast.record_failure()
+        self.assertIs(self.group.choose(), self.slow)
+
+    def test_inflight(self):
+        self.fast.record_success(0.1)
+        self.slow.record_success(0.15)
+        self.fast.inflight = 3
+        self.assertIs(self.group.choose(), self.slow)
+
+
+class TestLatencyWindow(unittest.TestCase):
+
+    def test_percentile(self):
+        window = LatencyWindow(size=100)
+        self.assertIsNone(window.percentile(95))
+        for i in range(200):
+            window.add(i)
+        self.assertEqual(len(window), 100)
+        self.assertEqual(window.percentile(0), 100)
+        self.assertEqual(window.percentile(50), 150)
+        self.assertEqual(window.percentile(100), 199)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+from io import BytesIO
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from pixiv_fetcher.cache import Cache
+from pixiv_fetcher.cache.storage import SimpleStorage
+from pixiv_fetcher.exceptions import HttpResponseException, ResizeError
+from pixiv_fetcher.resource import PixivImageProxyResource
+from pixiv_fetcher.variants import Image, ProcessPool, VariantRenderer, \
+    VariantSpec, _call, resize_image
+
+_path = '/img-original/img/2018/01/02/03/04/05/1_p0.png'
+
+
+def _image(size=(1000, 500), mode='RGBA', fmt='PNG'):
+    output = BytesIO()
+    Image.new(mode, size, (255, 0, 0, 128)[:len(mode)]).save(output, fmt)
+    return output.getvalue()
+
+
+class _InlinePool(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def submit(self, func, *args):
+        self.calls += 1
+        return defer.maybeDeferred(func, *args)
+
+    def close(self):
+        pass
+
+
+class _Clock(task.Clock):
+
+    def callFromThread(self, func, *args):
+        func(*args)
+
+
+class _LostPool(object):
+    """
+    multiprocessing.Pool whose worker died: callbacks only run on demand
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def apply_async(self, func, args, callback):
+        self.callbacks.append(callback)
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class _LostProcessPool(ProcessPool):
+
+    @staticmethod
+    def _create_pool(processes):
+        return _LostPool()
+
+
+class _Response(object):
+
+    def __init__(self, code, phrase):
+        self.code = code
+        self.phrase = phrase
+        self.body = b''
+
+
+class _MissingDownloader(object):
+
+    def fetch(self, path, client=None, trace=None):
+        return defer.succeed(_Response(404, 'Not Found'))
+
+
+class _Request(DummyRequest):
+
+    def __init__(self, **args):
+        DummyRequest.__init__(self, [''])
+        self.path = _path
+        self.uri = _path
+        self.args = dict((k, [v]) for k, v in args.items())
+
+
+class TestVariants(unittest.TestCase):
+
+    if Image is None:
+        skip = 'Pillow is not installed'
+
+    def test_resize(self):
+        data = resize_image(_image(), 600, 'jpeg', 80)
+        image = Image.open(BytesIO(data))
+        self.assertEqual((image.format, image.size), ('JPEG', (600, 300)))
+
+        data = resize_image(_image((300, 300), 'RGB'), 600, 'webp', 80)
+        image = Image.open(BytesIO(data))
+        self.assertEqual((image.format, image.size), ('WEBP', (300, 300)))
+
+    def test_parse(self):
+        renderer = VariantRenderer(_InlinePool())
+        self.assertIsNone(renderer.parse(_Request()))
+        self.assertEqual(renderer.parse(_Request(w='500', q='82')),
+                         VariantSpec(600, 'jpeg', 80))
+        self.assertEqual(renderer.parse(_Request(w='9999', fmt='webp')),
+                         VariantSpec(1200, 'webp', 85))
+        self.assertRaises(HttpResponseException, renderer.parse,
+                          _Request(w='abc'))
+        self.assertRaises(HttpResponseException, renderer.parse,
+                          _Request(fmt='gif'))
+
+    def test_produce_dedup(self):
+        renderer = VariantRenderer(_InlinePool())
+        pending = defer.Deferred()
+        calls = []
+
+        def _func():
+            calls.append(1)
+            return pending
+
+        results = []
+        for _ in range(3):
+            renderer.produce('key', _func).addCallback(results.append)
+        self.assertEqual(renderer.pending, 1)
+        pending.callback(b'data')
+        self.assertEqual((calls, results), ([1], [b'data'] * 3))
+        self.assertEqual(renderer.pending, 0)
+
+    def test_resource(self):
+        pool = _InlinePool()
+        cache = Cache(SimpleStorage())
+        cache.set(_path, _image())
+        resource = PixivImageProxyResource(
+            'i.pximg.net', '', cache=cache,
+            variants=VariantRenderer(pool))
+
+        for _ in range(2):
+            request = _Request(w='600', fmt='webp')
+            resource.render(request)
+            self.assertEqual(request.responseHeaders.getRawHeaders(
+                'content-type'), ['image/webp'])
+            image = Image.open(BytesIO(b''.join(request.written)))
+            self.assertEqual(image.size, (600, 300))
+        self.assertEqual(pool.calls, 1)
+        self.assertEqual(cache.count, 2)
+
+    def test_upstream_error(self):
+        resource = PixivImageProxyResource(
+            'i.pximg.net', '', cache=Cache(SimpleStorage()),
+            downloader=_MissingDownloader(),
+            variants=VariantRenderer(_InlinePool()))
+        request = _Request(w='600')
+        resource.render(request)
+        self.assertEqual(request.responseCode, 404)
+        self.assertEqual(b''.join(request.written), b'<h1>Not Found</h1>')
+
+    def test_too_many_pixels(self):
+        self.patch(Image, 'MAX_IMAGE_PIXELS', 400000)
+        self.assertRaises(Image.DecompressionBombError, resize_image,
+                          _image(), 600, 'jpeg', 80)
+
+    def test_worker_lost(self):
+        clock = _Clock()
+        pool = _LostProcessPool(timeout=30, reactor=clock)
+        renderer = VariantRenderer(pool)
+        spec = VariantSpec(240, 'jpeg', 80)
+        dfd = renderer.produce('key', lambda: renderer.resize(b'data', spec))
+        self.assertEqual(renderer.pending, 1)
+
+        clock.advance(30)
+        self.assertEqual(renderer.pending, 0)
+        self.failureResultOf(dfd, ResizeError)
+
+        # a result arriving after the timeout is dropped
+        pool._pool.callbacks[0]((True, b'late'))
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+        dfd = pool.submit(resize_image)
+        pool._pool.callbacks[1]((True, b'resized'))
+        self.assertEqual(self.successResultOf(dfd), b'resized')
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_call_in_worker(self):
+        ok, data = _call(resize_image, (_image(), 240, 'jpeg', 80))
+        self.assertTrue(ok)
+        self.assertEqual(Image.open(BytesIO(data)).size, (240, 120))
+        ok, error = _call(resize_image, (b'junk', 240, 'jpeg', 80))
+        self.assertFalse(ok)
+        self.assertIn('Traceback', error)